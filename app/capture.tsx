@@ -24,7 +24,7 @@ import { useCameraPermissions } from 'expo-camera';
 import { Link, router } from 'expo-router';
 import { useSafeAreaInsets } from 'react-native-safe-area-context';
 
-import { analyzeReceiptFromUri, hasApi } from '@/lib/ai';
+import { analyzeReceiptFromUri, hasApi, withCategories } from '@/lib/ai';
 import { useSplitStore } from '@/store/useSplitStore';
 import { useTheme } from '@/providers/theme';
 
@@ -277,10 +277,13 @@ export default function CaptureReceipt() {
       const hasTaxItem = result.items.some((it: any) => String(it.description || '').toLowerCase() === 'tax');
       const hasTipItem = result.items.some((it: any) => String(it.description || '').toLowerCase() === 'tip');
 
-      const items = result.items.map((it: any, idx: number) => ({
+      // Backend usually tags categories; fill any gaps (server /categorize, keywords offline)
+      const parsedItems = await withCategories(result.items);
+      const items = parsedItems.map((it: any, idx: number) => ({
         id: it.id || `it_${Date.now()}_${idx}`,
         description: it.description ?? `Item ${idx + 1}`,
         amount: Number(it.amount ?? 0),
+        category: it.category,
         splitAmong: [],
       }));
 
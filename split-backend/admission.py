@@ -0,0 +1,133 @@
+# Admission control for analyze pipelines.
+#
+# At most max_active pipelines run at once; the rest wait in a bounded queue, lower
+# priority value first and FIFO within a priority. Rather than queue a request that
+# would time out anyway, it is shed straight away with a retry hint: when the queue is
+# full, or when its estimated wait plus a typical pipeline run exceeds the time the
+# client said it will wait. A queued request still waiting at its deadline is shed
+# too. The pipeline time is an EWMA of recent runs. Requests that need no upstream
+# work (cache hits, joining an identical in-flight pipeline) never get here.
+#
+# A budget of None means "will wait": such requests (background jobs) are neither
+# shed nor counted against max_queue.
+from typing import Callable, Optional
+import asyncio, heapq, itertools, math, time
+
+SHED_REASONS = ("queue_full", "budget", "deadline")
+
+
+class Shed(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    # One running pipeline's slot; release() hands it to the next waiter (idempotent)
+    def __init__(self, admission: "Admission", waited: float):
+        self.admission = admission
+        self.waited = waited
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.admission._release(time.monotonic() - self.started)
+
+
+class Admission:
+    def __init__(self, max_active: int = 24, max_queue: int = 64, max_wait_sec: float = 30.0,
+                 service_sec: float = 8.0, alpha: float = 0.2):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait_sec = max_wait_sec
+        self.service_sec = service_sec
+        self.alpha = alpha
+        self.active = 0
+        self.waiting = 0      # live entries in _heap
+        self.bounded = 0      # of which have a budget (count against max_queue)
+        self._heap: list = []  # (priority, seq, future); given-up futures are cancelled and skipped
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {r: 0 for r in SHED_REASONS}
+
+    def estimate_wait(self, priority: int = 0) -> float:
+        ahead = sum(1 for p, _, f in self._heap if p <= priority and not f.done())
+        if self.active < self.max_active and not ahead:
+            return 0.0
+        return (ahead + 1) * self.service_sec / self.max_active
+
+    def _shed(self, reason: str, wait: float) -> Shed:
+        self.shed[reason] += 1
+        return Shed(reason, max(1, min(120, math.ceil(wait))))
+
+    async def acquire(self, budget: Optional[float] = None, priority: int = 0,
+                      on_queued: Optional[Callable[[float, int], None]] = None) -> Ticket:
+        if self.active < self.max_active and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            return Ticket(self, 0.0)
+        wait = self.estimate_wait(priority)
+        if budget is not None:
+            if self.bounded >= self.max_queue:
+                raise self._shed("queue_full", wait)
+            if wait + self.service_sec > budget:
+                raise self._shed("budget", wait)
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), fut))
+        self.waiting += 1
+        self.bounded += budget is not None
+        self.queued += 1
+        if on_queued is not None:
+            on_queued(wait, self.waiting)
+        # Latest start that still leaves a typical run inside the budget
+        timeout = None if budget is None else min(max(0.0, budget - self.service_sec), self.max_wait_sec)
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait((fut,), timeout=timeout)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.bounded -= budget is not None
+                self._release(None)  # slot was handed over as the caller went away
+            else:
+                self._give_up(fut, budget)
+            raise
+        if not fut.done():
+            self._give_up(fut, budget)
+            raise self._shed("deadline", self.estimate_wait(priority))
+        self.bounded -= budget is not None
+        self.admitted += 1
+        return Ticket(self, time.monotonic() - t0)
+
+    def _give_up(self, fut: asyncio.Future, budget: Optional[float]) -> None:
+        fut.cancel()
+        self.waiting -= 1
+        self.bounded -= budget is not None
+
+    def _release(self, service_sec: Optional[float]) -> None:
+        if service_sec is not None:
+            self.service_sec += self.alpha * (service_sec - self.service_sec)
+        while self._heap:
+            _, _, fut = heapq.heappop(self._heap)
+            if not fut.done():
+                self.waiting -= 1
+                fut.set_result(None)  # the slot moves to this waiter; active is unchanged
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": self.waiting,
+            "max_queue": self.max_queue,
+            "service_sec": round(self.service_sec, 2),
+            "est_wait_sec": round(self.estimate_wait(), 2),
+            "admitted": self.admitted,
+            "queued_total": self.queued,
+            "shed": dict(self.shed),
+        }
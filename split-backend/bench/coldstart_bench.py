@@ -0,0 +1,94 @@
+# Cold start to first response: spawns the backend (one uvicorn worker) against
+# bench.stubs, waits until it is live and ready (/livez and /readyz; /health on trees
+# without them), then sends the first receipt right away and a second one after it.
+# STUB_CONNECT_MS (default here 300) charges each new upstream connection a handshake,
+# so a worker that has not warmed its pools pays it on its first receipt.
+#
+#   python -m bench.coldstart_bench                      # 5 cold starts, medians
+#   python -m bench.coldstart_bench --trials 10 --connect-ms 500 --json
+#
+# Columns: spawn -> live, spawn -> ready, first and second /analyze-receipt latency,
+# and spawn -> first response, the time a load balancer that waits for readiness
+# leaves a new worker out before its first answer.
+import argparse, asyncio, json, os, statistics, time
+import httpx
+
+from bench.load_test import _free_port, _spawn, _wait_up
+from bench.stubs import stub_image
+
+async def _poll(c: httpx.AsyncClient, paths: tuple, timeout: float = 30.0) -> tuple[float, str]:
+    # Time until the first of `paths` answers 200; a 404 moves on to the next path
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for path in paths:
+            try:
+                r = await c.get(path)
+            except httpx.TransportError:
+                break
+            if r.status_code == 200:
+                return time.perf_counter(), path
+            if r.status_code != 404:
+                break
+        await asyncio.sleep(0.01)
+    raise RuntimeError(f"{paths} did not answer 200")
+
+async def _trial(port: int, env: dict, k: int, scenario: str) -> dict:
+    t0 = time.perf_counter()
+    proc = _spawn("server:app", port, env)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as c:
+            live, _ = await _poll(c, ("/livez", "/health"))
+            ready, via = await _poll(c, ("/readyz", "/health"))
+            lat = []
+            for i in range(2):
+                img = stub_image("grocery", scenario, nonce=k * 10 + i + 1)
+                t = time.perf_counter()
+                r = await c.post("/analyze-receipt", files={"file": ("r.jpg", img, "image/jpeg")})
+                assert r.status_code == 200, r.text
+                lat.append(time.perf_counter() - t)
+        return {"live_ms": (live - t0) * 1000, "ready_ms": (ready - t0) * 1000, "ready_via": via,
+                "first_ms": lat[0] * 1000, "second_ms": lat[1] * 1000,
+                "to_first_response_ms": (ready - t0 + lat[0]) * 1000}
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--trials", type=int, default=5)
+    ap.add_argument("--connect-ms", type=float, default=300, help="stub handshake cost per new connection")
+    ap.add_argument("--latency-ms", type=float, default=150, help="stub latency per upstream call")
+    ap.add_argument("--scenario", default="azure_read_gpt", help="engine path of the first receipts")
+    ap.add_argument("--json", action="store_true", help="print the medians as JSON")
+    args = ap.parse_args()
+
+    stub_port = _free_port()
+    stub = f"http://127.0.0.1:{stub_port}"
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY") or "stub",
+        "OPENAI_BASE_URL": f"{stub}/v1",
+        "AZURE_DI_ENDPOINT": stub, "AZURE_DI_KEY": "stub",
+        "AZURE_VISION_ENDPOINT": stub, "AZURE_VISION_KEY": "stub",
+        "RATE_LIMIT": "0", "RESULT_CACHE_DB": "",
+        "STUB_CONNECT_MS": str(args.connect_ms), "STUB_LATENCY_MS": str(args.latency_ms),
+        "STUB_DI_RUN_MS": str(args.latency_ms), "DI_POLL_FIRST_DELAY_SEC": "0.1",
+    })
+    stubs = _spawn("bench.stubs:app", stub_port, env)
+    try:
+        asyncio.run(_wait_up(f"{stub}/docs"))
+        rows = [asyncio.run(_trial(_free_port(), env, k, args.scenario)) for k in range(args.trials)]
+    finally:
+        stubs.terminate()
+        stubs.wait()
+    med = {k: round(statistics.median(r[k] for r in rows)) for k in rows[0] if k.endswith("_ms")}
+    med["ready_via"] = rows[0]["ready_via"]
+    if args.json:
+        print(json.dumps(med, indent=1))
+        return
+    print(f"{args.trials} cold starts, medians (readiness from {med['ready_via']}):")
+    for k in ("live_ms", "ready_ms", "first_ms", "second_ms", "to_first_response_ms"):
+        print(f"  {k:<22} {med[k]:>6}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# End-to-end latency benchmark for /analyze-receipt against local stub upstreams.
+#
+#   python -m bench.load_test --requests 200 --concurrency 20
+#   python -m bench.load_test --mix azure_receipt=3,gpt_image=1 --compare bench/results/<file>.json
+#   python -m bench.load_test --size-kb 4096 --json      # large base64 JSON uploads (memory)
+#   python -m bench.load_test --requests 400 --concurrency 400 --budget-ms 10000   # burst; admission sheds
+#
+# Starts bench.stubs and server:app (single uvicorn worker each) unless --target
+# points at an already running backend (which must use the stubs as upstreams).
+# Uploads are stub images whose marker selects the fixture and the engine path that
+# wins (see bench/stubs.py). Reports throughput, p50/p95/p99 overall and per engine
+# path, how long failed requests (e.g. shed with 503) took to come back, the backend's
+# memory high-water mark and /health latency during the burst.
+# Each run is saved as JSON under bench/results/ (tagged with the git commit) for
+# comparison between commits.
+from typing import Optional
+import argparse, asyncio, base64, json, os, socket, subprocess, sys, time
+import httpx
+
+from bench.stubs import FIXTURES, SCENARIOS, stub_image
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(HERE, "bench", "results")
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _spawn(module: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--port", str(port), "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+
+async def _wait_up(url: str, timeout: float = 15.0) -> None:
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.time() < deadline:
+            try:
+                await c.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up")
+
+def _rss_hwm_mb(pid: Optional[int]) -> Optional[float]:
+    # Peak resident set size of the backend process (Linux only)
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def _pcts(xs: list[float]) -> dict:
+    s = sorted(xs)
+    if not s:
+        return {"count": 0}
+    at = lambda q: round(s[min(len(s) - 1, int(len(s) * q))], 3)
+    return {"count": len(s), "p50_sec": at(0.5), "p95_sec": at(0.95), "p99_sec": at(0.99), "max_sec": round(s[-1], 3)}
+
+def _parse_mix(spec: Optional[str]) -> list[str]:
+    # "azure_receipt=3,gpt_image=1" -> weighted round-robin schedule of scenarios
+    if not spec:
+        return list(SCENARIOS)
+    out = []
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise SystemExit(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        out += [name] * int(weight or 1)
+    return out
+
+async def run(target: str, n: int, concurrency: int, mix: list[str], fixtures: list[str],
+              size_kb: int = 64, as_json: bool = False, budget_ms: Optional[int] = None) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    by_engine: dict[str, list[float]] = {}
+    latencies: list[float] = []
+    failed: list[float] = []
+    errors: dict[str, int] = {}
+    health: list[float] = []
+    done = asyncio.Event()
+
+    headers = {"X-Deadline-Ms": str(budget_ms)} if budget_ms else None
+    limits = httpx.Limits(max_connections=max(100, concurrency))  # else a burst queues in the client pool
+    async with httpx.AsyncClient(base_url=target, timeout=300, headers=headers, limits=limits) as c:
+        async def one(i: int) -> None:
+            # Distinct bytes per request so the result cache / single-flight do not short-circuit
+            body = stub_image(fixtures[i % len(fixtures)], mix[i % len(mix)], nonce=i, size=size_kb * 1024)
+            if as_json:
+                upload = {"json": {"image_base64": base64.b64encode(body).decode()}}
+            else:
+                upload = {"files": {"file": (f"r{i}.jpg", body, "image/jpeg")}}
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    r = await c.post("/analyze-receipt", **upload)
+                    status = str(r.status_code)
+                except httpx.TransportError:
+                    status = "transport"
+                dt = time.perf_counter() - t0
+            latencies.append(dt)
+            if status != "200":
+                errors[status] = errors.get(status, 0) + 1
+                failed.append(dt)
+                return
+            by_engine.setdefault(r.json().get("engine") or "unknown", []).append(dt)
+
+        async def probe() -> None:
+            while not done.is_set():
+                t0 = time.perf_counter()
+                try:
+                    await c.get("/health")
+                except httpx.TransportError:  # pooled connection closed by the server's keep-alive timeout
+                    continue
+                health.append(time.perf_counter() - t0)
+                await asyncio.sleep(0.25)
+
+        prober = asyncio.create_task(probe())
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(n)))
+        wall = time.perf_counter() - t0
+        done.set()
+        await prober
+
+    return {
+        "requests": n,
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_sec": round(wall, 2),
+        "throughput_rps": round(n / wall, 2),
+        "overall": _pcts(latencies),
+        "failed": _pcts(failed),
+        "engines": {k: _pcts(v) for k, v in sorted(by_engine.items())},
+        "health_max_ms": round(max(health) * 1000, 1) if health else None,
+    }
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def _save(report: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{report['commit'] or 'nogit'}.json"
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    return path
+
+def _compare(old: dict, new: dict) -> None:
+    def line(label: str, a, b) -> None:
+        if a is None or b is None:
+            return
+        pct = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"  {label:<40} {a:>9} -> {b:<9} {pct}")
+    print(f"compare {old.get('commit')} -> {new.get('commit')}")
+    line("throughput_rps", old["results"]["throughput_rps"], new["results"]["throughput_rps"])
+    line("rss_hwm_mb", old.get("rss_hwm_mb"), new.get("rss_hwm_mb"))
+    for q in ("p50_sec", "p95_sec", "p99_sec"):
+        line(f"overall {q}", old["results"]["overall"].get(q), new["results"]["overall"].get(q))
+    for eng, st in new["results"]["engines"].items():
+        prev = old["results"]["engines"].get(eng, {})
+        for q in ("p50_sec", "p95_sec", "p99_sec"):
+            line(f"{eng} {q}", prev.get(q), st.get(q))
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=40)
+    ap.add_argument("--concurrency", type=int, default=20)
+    ap.add_argument("--mix", default=None, help="scenario weights, e.g. azure_receipt=3,gpt_image=1 (default: all equally)")
+    ap.add_argument("--fixtures", default=None, help=f"comma-separated subset of {','.join(FIXTURES)}")
+    ap.add_argument("--size-kb", type=int, default=64, help="upload size per request")
+    ap.add_argument("--json", action="store_true", help="send JSON {image_base64} instead of multipart")
+    ap.add_argument("--budget-ms", type=int, default=None, help="send X-Deadline-Ms (client wait budget)")
+    ap.add_argument("--target", default=None, help="existing backend URL; skips spawning")
+    ap.add_argument("--compare", default=None, help="earlier result JSON to diff against")
+    ap.add_argument("--no-save", action="store_true")
+    args = ap.parse_args()
+
+    mix = _parse_mix(args.mix)
+    fixtures = [f.strip() for f in args.fixtures.split(",")] if args.fixtures else sorted(FIXTURES)
+    procs: list[subprocess.Popen] = []
+    server_pid = None
+    target = args.target
+    try:
+        if target is None:
+            stub_port, srv_port = _free_port(), _free_port()
+            stub = f"http://127.0.0.1:{stub_port}"
+            env = dict(os.environ)
+            env.update({
+                "OPENAI_API_KEY": env.get("OPENAI_API_KEY") or "stub",
+                "OPENAI_BASE_URL": f"{stub}/v1",
+                "AZURE_DI_ENDPOINT": stub, "AZURE_DI_KEY": "stub",
+                "AZURE_VISION_ENDPOINT": stub, "AZURE_VISION_KEY": "stub",
+                "RATE_LIMIT": "0",
+            })
+            procs.append(_spawn("bench.stubs:app", stub_port, env))
+            asyncio.run(_wait_up(f"{stub}/docs"))
+            target = f"http://127.0.0.1:{srv_port}"
+            procs.append(_spawn("server:app", srv_port, env))
+            server_pid = procs[-1].pid
+            asyncio.run(_wait_up(f"{target}/health"))
+
+        results = asyncio.run(run(target, args.requests, args.concurrency, mix, fixtures, args.size_kb, args.json,
+                                  args.budget_ms))
+        report = {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {"mix": args.mix or "uniform", "fixtures": fixtures,
+                       "size_kb": args.size_kb, "upload": "json" if args.json else "multipart",
+                       "budget_ms": args.budget_ms,
+                       "stub_env": {k: v for k, v in os.environ.items() if k.startswith("STUB_")}},
+            "rss_hwm_mb": _rss_hwm_mb(server_pid),
+            "results": results,
+        }
+        print(json.dumps(report, indent=1))
+        if not args.no_save:
+            print("saved", _save(report))
+        if args.compare:
+            with open(args.compare) as f:
+                _compare(json.load(f), report)
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+
+if __name__ == "__main__":
+    main()
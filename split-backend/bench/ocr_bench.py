@@ -0,0 +1,75 @@
+# Prompt size, tokens and latency of the GPT text passes on the fixture corpus, with
+# the raw Azure Read OCR vs the compacted OCR (ocrtext.compact, server's OCR_* settings).
+#
+#   python -m bench.ocr_bench            # in-process stub upstream; usage is estimated by the stub,
+#                                        # item counts are only meaningful with --live
+#   python -m bench.ocr_bench --live     # real OpenAI (OPENAI_API_KEY / OPENAI_MODEL); spends tokens
+#
+# Each fixture's OCR goes through both the plain and the strict itemization prompt, so
+# the table shows the saving per call and whether the item count changed.
+import argparse, asyncio, json, os, sys
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import httpx
+import server
+from bench.stubs import FIXTURES, app as stub_app
+from ocrtext import compact
+
+def _ocr(fx: dict) -> str:
+    return "\n".join(l["text"] for b in fx["read"]["readResult"]["blocks"] for l in b.get("lines", []))
+
+async def _call(text: str, strict: bool) -> dict:
+    stage = "gpt_text_strict" if strict else "gpt_text"
+    usage: dict = {}
+    prompt = server._force_itemization_prompt(text) if strict else text
+    parsed = await server._openai_from_text(prompt, stage, usage)
+    return {**usage, "items": len(parsed["items"]) if parsed and isinstance(parsed.get("items"), list) else None}
+
+async def run(live: bool, fixtures: list[str]) -> list[dict]:
+    if not live:
+        server.OPENAI_BASE_URL = "http://stub/v1"
+        server._CLIENTS["openai"] = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_app))
+    rows = []
+    for name in fixtures:
+        raw = _ocr(FIXTURES[name])
+        small, stats = compact(raw, head_lines=server.OCR_HEAD_LINES, context=server.OCR_CONTEXT_LINES,
+                               max_tokens=server.OCR_TOKEN_BUDGET)
+        for strict in (False, True):
+            a = await _call(raw, strict)
+            b = await _call(small, strict)
+            rows.append({"fixture": name, "pass": "strict" if strict else "plain", "ocr": stats, "raw": a, "compact": b})
+    await server._close_clients()
+    return rows
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--live", action="store_true", help="call the configured OpenAI endpoint")
+    ap.add_argument("--fixtures", default=None, help=f"comma-separated subset of {','.join(FIXTURES)}")
+    ap.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = ap.parse_args()
+    fixtures = [f.strip() for f in args.fixtures.split(",")] if args.fixtures else sorted(FIXTURES)
+
+    rows = asyncio.run(run(args.live, fixtures))
+    if args.json:
+        print(json.dumps(rows, indent=1))
+        return
+    print(f"{'fixture':<9} {'pass':<7} {'lines':>7} {'chars':>9} {'prompt tok':>13} {'saved':>6} "
+          f"{'compl tok':>11} {'ms':>11} {'items':>7}")
+    tot = [0, 0]
+    for r in rows:
+        a, b, o = r["raw"], r["compact"], r["ocr"]
+        pa, pb = a.get("prompt_tokens"), b.get("prompt_tokens")
+        saved = f"{(pa - pb) / pa * 100:.0f}%" if pa and pb is not None else "-"
+        if pa and pb is not None:
+            tot[0] += pa
+            tot[1] += pb
+        print(f"{r['fixture']:<9} {r['pass']:<7} {o['lines_in']:>3}>{o['lines_out']:<3} "
+              f"{o['chars_in']:>4}>{o['chars_out']:<4} {pa!s:>6}>{pb!s:<6} {saved:>6} "
+              f"{a.get('completion_tokens')!s:>5}>{b.get('completion_tokens')!s:<5} "
+              f"{a.get('ms')!s:>5}>{b.get('ms')!s:<5} {a['items']!s:>3}>{b['items']!s:<3}")
+    if tot[0]:
+        print(f"prompt tokens, all calls: {tot[0]} -> {tot[1]} ({(tot[0] - tot[1]) / tot[0] * 100:.0f}% saved)")
+
+if __name__ == "__main__":
+    main()
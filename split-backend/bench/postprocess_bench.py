@@ -0,0 +1,199 @@
+# Microbenchmark for the postprocess + validate stages on synthetic receipts.
+#
+#   python -m bench.postprocess_bench                 # sizes 10..5000, checks output identity
+#   python -m bench.postprocess_bench --sizes 300 --repeat 50
+#
+# REFERENCE below is the pre-fast-path implementation, kept verbatim so every run
+# proves server._postprocess_receipt still produces byte-identical output.
+from typing import Optional
+import argparse, gc, hashlib, json, os, random, sys, time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastapi import HTTPException
+import server
+
+# ---- reference implementation (as of user-012; categories from the current dictionary) ----
+def _ref_mk_id(desc: str, amt: float, idx: int) -> str:
+    return hashlib.sha1(f"{desc}|{amt}|{idx}".encode("utf-8")).hexdigest()[:12]
+
+def _ref_category_of(name: str) -> str:
+    # Categorization rules moved to the keyword dictionary (user-014); compare the rest
+    return server._category_of(name)
+
+def _ref_coerce_amounts(parsed: dict) -> dict:
+    if not isinstance(parsed, dict) or "items" not in parsed or not isinstance(parsed["items"], list):
+        raise HTTPException(status_code=502, detail="Response missing items[]")
+    for it in parsed["items"]:
+        try:
+            it["amount"] = float(it.get("amount", 0))
+        except Exception:
+            it["amount"] = 0.0
+    if "subtotal" not in parsed:
+        notax = sum(x.get("amount", 0) for x in parsed["items"] if x.get("category") not in ("tax","tip"))
+        parsed["subtotal"] = round(float(notax), 2)
+    return parsed
+
+def _ref_postprocess_receipt(
+    d: dict,
+    include_tax_tip: bool,
+    tip_percent_override: Optional[float] = None,
+    tip_amount_override: Optional[float] = None,
+    tax_amount_override: Optional[float] = None,
+    lock_paper_total: bool = False,
+) -> dict:
+    raw_items = d.get("items") or []
+    cleaned: list[dict] = []
+    skip_tokens = {"SUBTOTAL", "CHANGE", "CASH", "CARD", "BALANCE", "AUTH", "TOTAL", "ROUNDING"}
+    for it in raw_items:
+        try:
+            desc = (it.get("description") or "Item").strip()
+            amt = float(it.get("amount") or 0)
+            if amt <= 0:
+                continue
+            if desc.upper() in skip_tokens:
+                continue
+            cat = (it.get("category") or "").strip().lower() or None
+            cleaned.append({"description": desc, "amount": round(amt, 2), "category": cat})
+        except Exception:
+            continue
+    merged: dict[str, dict] = {}
+    order_keys: list[str] = []
+    for it in cleaned:
+        k = it["description"].strip().lower()
+        if k not in merged:
+            order_keys.append(k)
+            merged[k] = {"amount": 0.0, "category": it["category"]}
+        merged[k]["amount"] = round(merged[k]["amount"] + it["amount"], 2)
+        if not merged[k]["category"] and it["category"]:
+            merged[k]["category"] = it["category"]
+    tax = round(float(d.get("tax") or 0), 2)
+    tip = round(float(d.get("tip") or 0), 2)
+    items_out = []
+    for i, k in enumerate(order_keys):
+        amt = merged[k]["amount"]
+        cat = merged[k]["category"] or _ref_category_of(k)
+        items_out.append({"id": _ref_mk_id(k, amt, i), "description": k.title(), "amount": amt, "category": cat})
+    sum_items = round(sum(x["amount"] for x in items_out if x["category"] not in ("tax","tip","ignore")), 2)
+    if tax_amount_override is not None:
+        tax = round(float(tax_amount_override), 2)
+    if tip_amount_override is not None:
+        tip = round(float(tip_amount_override), 2)
+    elif tip == 0 and tip_percent_override is not None:
+        base_for_tip = sum_items + (tax if include_tax_tip else 0.0)
+        tip = round((base_for_tip * float(tip_percent_override)) / 100.0, 2)
+    computed = round(sum_items + tax + tip, 2)
+    total_field = d.get("total")
+    if lock_paper_total and isinstance(total_field, (int, float)):
+        total = round(float(total_field), 2)
+    else:
+        if total_field is None or not isinstance(total_field, (int, float)):
+            total = computed
+        else:
+            total = round(float(total_field), 2)
+            if abs(total - computed) <= 0.02:
+                total = computed
+    if include_tax_tip:
+        if tax > 0:
+            items_out.append({"id": _ref_mk_id("tax", tax, 99901), "description": "Tax", "amount": tax, "category": "tax"})
+        if tip > 0:
+            items_out.append({"id": _ref_mk_id("tip", tip, 99902), "description": "Tip", "amount": tip, "category": "tip"})
+    return {"merchant": d.get("merchant"), "date": d.get("date"), "total": total, "subtotal": sum_items,
+            "tax": tax, "tip": tip, "items": items_out}
+
+# ---- synthetic receipts ----
+_WORDS = ["organic", "chicken", "thighs", "IPA", "draft", "caesar", "salad", "garlic", "bread", "whole", "milk",
+          "kirkland", "paper", "towels", "merlot", "glass", "nachos", "Tip", "sparkling", "water", "coffee", "beans",
+          "change", "card", "gyoza", "sauce", "12oz", "avocados", "4ct", "Service", "charge", "rumchata", "cashews"]
+_JUNK = [{"description": "SUBTOTAL", "amount": 10}, {"description": "TOTAL ", "amount": "55.10"},
+         {"description": "Coupon", "amount": -2.0}, {"description": "Bag fee", "amount": None},
+         {"description": "Bad", "amount": "n/a"}, "not a dict", {"description": "Weird cat", "amount": 1, "category": 5},
+         {"description": None, "amount": 3.333}, {"amount": 2}]
+
+def synthetic(n: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    items: list = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.05:
+            items.append(rng.choice(_JUNK))
+        elif r < 0.2 and items:
+            prev = rng.choice(items)  # duplicate line, sometimes with different case/spacing
+            if isinstance(prev, dict) and isinstance(prev.get("description"), str):
+                items.append({**prev, "description": f"  {prev['description'].upper()} "})
+            else:
+                items.append(prev)
+        else:
+            desc = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 4)))
+            it = {"description": desc, "amount": round(rng.uniform(0.5, 60), rng.choice((2, 2, 3)))}
+            if rng.random() < 0.15:
+                it["category"] = rng.choice(("Food", " alcohol ", "", None))
+            if rng.random() < 0.1:
+                it["amount"] = str(it["amount"])
+            items.append(it)
+    return {"merchant": "Bench Mart", "date": "2025-01-01", "total": round(rng.uniform(10, 5000), 2),
+            "tax": round(rng.uniform(0, 40), 2), "tip": rng.choice((0, 0, 5.5)), "items": items}
+
+KNOBS = [
+    {"include_tax_tip": True},
+    {"include_tax_tip": False},
+    {"include_tax_tip": True, "tip_percent_override": 18.0},
+    {"include_tax_tip": False, "tip_amount_override": 7.25, "tax_amount_override": 3.1},
+    {"include_tax_tip": True, "lock_paper_total": True},
+]
+
+def _new_pipeline(d: dict, knobs: dict) -> str:
+    return server.AnalyzeResp(**server._postprocess_receipt(d, **knobs)).model_dump_json()
+
+def _ref_pipeline(d: dict, knobs: dict) -> str:
+    return server.AnalyzeResp(**_ref_coerce_amounts(_ref_postprocess_receipt(d, **knobs))).model_dump_json()
+
+def check_identical(seeds: int = 200) -> int:
+    checked = 0
+    for seed in range(seeds):
+        d = synthetic(random.Random(seed).choice((0, 1, 5, 40, 300)), seed)
+        for knobs in KNOBS:
+            a = json.dumps(_ref_postprocess_receipt(json.loads(json.dumps(d)), **knobs))
+            b = json.dumps(server._postprocess_receipt(json.loads(json.dumps(d)), **knobs))
+            if a != b:
+                raise SystemExit(f"output differs for seed={seed} knobs={knobs}")
+            if _ref_pipeline(d, knobs) != _new_pipeline(d, knobs):
+                raise SystemExit(f"validated output differs for seed={seed} knobs={knobs}")
+            checked += 1
+    return checked
+
+def _time(fn, repeat: int) -> float:
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - t0)
+    finally:
+        gc.enable()
+    return best
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10,100,300,1000,5000")
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    print(f"identity check: {check_identical()} receipt/knob combinations byte-identical")
+    print(f"{'lines':>6} {'ref ms':>9} {'new cold ms':>12} {'new warm ms':>12} {'speedup':>8} "
+          f"{'ref +valid ms':>14} {'new +valid ms':>14} {'us/line':>8}")
+    knobs = KNOBS[0]
+    for n in (int(x) for x in args.sizes.split(",")):
+        d = synthetic(n, seed=n)
+        ref = _time(lambda: _ref_postprocess_receipt(d, **knobs), args.repeat)
+        # cold: empty category memo (first sight of every name); warm: names seen before
+        cold = _time(lambda: (server.CATEGORIZER.clear_memo(), server._postprocess_receipt(d, **knobs)), args.repeat)
+        warm = _time(lambda: server._postprocess_receipt(d, **knobs), args.repeat)
+        ref_v = _time(lambda: _ref_pipeline(d, knobs), args.repeat)
+        new_v = _time(lambda: _new_pipeline(d, knobs), args.repeat)
+        print(f"{n:>6} {ref * 1000:>9.3f} {cold * 1000:>12.3f} {warm * 1000:>12.3f} {ref / warm:>7.2f}x "
+              f"{ref_v * 1000:>14.3f} {new_v * 1000:>14.3f} {warm / n * 1e6:>8.2f}")
+
+if __name__ == "__main__":
+    main()
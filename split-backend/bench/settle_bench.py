@@ -0,0 +1,182 @@
+# Settlement engine (settle.py) on synthetic groups: full build, single-expense
+# update, and greedy vs min_transfers transfer counts, next to a float port of the
+# client's computeSettlements (src/lib/split.ts).
+#
+#   python -m bench.settle_bench                         # 5/20/50 people x 100/1000/5000 expenses,
+#                                                        # spread across the group and in households of 5
+#   python -m bench.settle_bench --people 50 --expenses 5000 --itemized 0.5
+#   python -m bench.settle_bench --http                  # also time POST /settle in-process
+#
+# Checks on every run: the batched build matches upserting expenses one by one, cent
+# balances sum to zero, each is within a cent per expense of the float result, and
+# both modes' transfers settle every balance exactly. --http also checks that NaN,
+# Infinity and negative amounts, tax or tip are refused with a 422.
+import argparse, json, os, random, sys, time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("RATE_LIMIT", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from settle import Ledger
+
+def _client_settle(people: list[str], expenses: list[dict]) -> tuple[dict, list]:
+    # split.ts, float for float
+    bal = {p: 0.0 for p in people}
+    for e in expenses:
+        items = e.get("items") or []
+        itemized = e.get("splitMethod") == "itemized" and items
+        total = sum(it["amount"] for it in items) + (e.get("tax") or 0) + (e.get("tip") or 0) if itemized else e["amount"]
+        bal[e["paidBy"]] += total
+        per: dict = {}
+        if itemized:
+            for it in items:
+                group = it["splitAmong"] or people
+                for p in group:
+                    per[p] = per.get(p, 0) + it["amount"] / len(group)
+            extra = (e.get("tax") or 0) + (e.get("tip") or 0)
+            base = sum(per.values())
+            if extra > 0 and base > 0:
+                per = {p: v + extra * v / base for p, v in per.items()}
+        else:
+            group = e["splitAmong"] or people
+            per = {p: e["amount"] / len(group) for p in group}
+        for p, v in per.items():
+            bal[p] -= v
+    debtors = sorted(([p, -v] for p, v in bal.items() if v < -0.009), key=lambda x: -x[1])
+    creditors = sorted(([p, v] for p, v in bal.items() if v > 0.009), key=lambda x: -x[1])
+    out, i, j = [], 0, 0
+    while i < len(debtors) and j < len(creditors):
+        pay = min(debtors[i][1], creditors[j][1])
+        out.append((debtors[i][0], creditors[j][0], round(pay * 100) / 100))
+        debtors[i][1] -= pay
+        creditors[j][1] -= pay
+        if debtors[i][1] < 0.009: i += 1
+        if creditors[j][1] < 0.009: j += 1
+    return bal, out
+
+def _expenses(people: list[str], n: int, itemized: float, rnd: random.Random, clusters: int = 0) -> list[dict]:
+    # clusters > 0: people form that many households and every expense stays inside one
+    pools = [people[i::clusters] for i in range(clusters)] if clusters else [people]
+    out = []
+    for k in range(n):
+        pool = rnd.choice(pools)
+        e = {"id": f"e{k}", "paidBy": rnd.choice(pool), "amount": 0.0, "splitAmong": list(pool) if clusters else []}
+        if rnd.random() < 0.3:
+            e["splitAmong"] = rnd.sample(pool, rnd.randint(1, len(pool)))
+        if rnd.random() < itemized:
+            e["splitMethod"] = "itemized"
+            e["items"] = [{"id": f"e{k}i{j}", "description": "item", "amount": round(rnd.uniform(1, 40), 2),
+                           "splitAmong": rnd.sample(pool, rnd.randint(1, min(4, len(pool))))}
+                          for j in range(rnd.randint(1, 12))]
+            e["tax"] = round(sum(it["amount"] for it in e["items"]) * 0.08, 2)
+            e["tip"] = round(rnd.choice((0, 0.15, 0.2)) * sum(it["amount"] for it in e["items"]), 2)
+        else:
+            e["splitMethod"] = "even"
+            e["amount"] = round(rnd.uniform(3, 400), 2)
+        out.append(e)
+    return out
+
+def _settles(led: Ledger, transfers: list) -> bool:
+    left = dict(led.balance)
+    for a, b, c in transfers:
+        left[a] += c
+        left[b] -= c
+    return not any(left.values())
+
+def _upsert_all(people: list[str], expenses: list[dict]) -> Ledger:
+    led = Ledger(people)
+    for e in expenses:
+        led.upsert(e)
+    return led
+
+def _ms(fn, reps: int = 1):
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        out = fn()
+    return out, (time.perf_counter() - t0) * 1000 / reps
+
+def run(n_people: int, n_exp: int, itemized: float, seed: int, clusters: int = 0) -> dict:
+    rnd = random.Random(seed)
+    people = [f"p{i}" for i in range(n_people)]
+    exps = _expenses(people, n_exp, itemized, rnd, clusters)
+
+    led, build_ms = _ms(lambda: Ledger.build(people, exps))
+    one_by_one, upsert_ms = _ms(lambda: _upsert_all(people, exps))
+    assert one_by_one.balance == led.balance
+    (float_bal, float_tr), client_ms = _ms(lambda: _client_settle(people, exps))
+    assert sum(led.balance.values()) == 0
+    drift = max(abs(led.balance[p] / 100 - float_bal[p]) for p in people)
+    assert drift <= 0.01 * n_exp, drift
+
+    def one_edit():
+        e = dict(rnd.choice(exps))
+        e["amount"] = round(rnd.uniform(3, 400), 2)
+        e["splitMethod"], e["items"] = "even", None
+        led.upsert(e)
+    _, update_ms = _ms(one_edit, reps=200)
+    greedy, greedy_ms = _ms(lambda: led.transfers("greedy"), reps=20)
+    best, best_ms = _ms(lambda: led.transfers("min_transfers"), reps=3)
+    assert _settles(led, greedy) and _settles(led, best)
+    assert len(best) <= len(greedy)
+    return {"people": n_people, "expenses": n_exp, "itemized": itemized, "clusters": clusters,
+            "build_ms": round(build_ms, 2), "upsert_all_ms": round(upsert_ms, 2), "client_float_ms": round(client_ms, 2),
+            "update_ms": round(update_ms, 4), "max_drift": round(drift, 2),
+            "greedy": len(greedy), "greedy_ms": round(greedy_ms, 3),
+            "min_transfers": len(best), "min_transfers_ms": round(best_ms, 3),
+            "client_transfers": len(float_tr)}
+
+def run_http(n_people: int, n_exp: int, itemized: float, seed: int) -> dict:
+    from fastapi.testclient import TestClient
+    import server
+    rnd = random.Random(seed)
+    people = [f"p{i}" for i in range(n_people)]
+    exps = _expenses(people, n_exp, itemized, rnd)
+    body = {"participants": [{"id": p} for p in people], "expenses": exps, "group_id": "bench", "mode": "min_transfers"}
+    with TestClient(server.app) as c:
+        r, full_ms = _ms(lambda: c.post("/settle", json=body))
+        assert r.status_code == 200, r.text
+        edit = dict(exps[0], amount=12.34, splitMethod="even", items=None)
+        patch = {"participants": body["participants"], "upsert": [edit], "group_id": "bench", "mode": "min_transfers"}
+        r2, patch_ms = _ms(lambda: c.post("/settle", json=patch), reps=20)
+        assert r2.status_code == 200 and r2.json()["recomputed"] == 1, r2.text
+        item = '{"description": "x", "amount": 1}'
+        for field in ('"amount": NaN', '"amount": Infinity', '"amount": -5', '"tax": -1', '"tip": NaN',
+                      f'"splitMethod": "itemized", "items": [{item.replace("1", "-1")}]',
+                      f'"splitMethod": "itemized", "items": [{item.replace("1", "Infinity")}]'):
+            bad = '{"participants": [{"id": "p0"}], "expenses": [{"id": "e", "paidBy": "p0", ' + field + '}]}'
+            r3 = c.post("/settle", content=bad, headers={"content-type": "application/json"})
+            assert r3.status_code == 422, (field, r3.status_code, r3.text)
+    return {"people": n_people, "expenses": n_exp, "http_full_ms": round(full_ms, 1),
+            "http_upsert_ms": round(patch_ms, 1), "transfers": len(r2.json()["transfers"])}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--people", type=int, default=None)
+    ap.add_argument("--expenses", type=int, default=None)
+    ap.add_argument("--itemized", type=float, default=0.3, help="fraction of itemized expenses")
+    ap.add_argument("--clusters", type=int, default=None,
+                    help="households per group (default: rows with none and with people/5)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--http", action="store_true", help="also time POST /settle through the app")
+    ap.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = ap.parse_args()
+    sizes = [(p, n) for p in ([args.people] if args.people else [5, 20, 50])
+             for n in ([args.expenses] if args.expenses else [100, 1000, 5000])]
+
+    rows = [run(p, n, args.itemized, args.seed, c) for p, n in sizes
+            for c in ([args.clusters] if args.clusters is not None else [0, max(1, p // 5)])]
+    http = [run_http(p, n, args.itemized, args.seed) for p, n in sizes] if args.http else []
+    if args.json:
+        print(json.dumps({"rows": rows, "http": http}, indent=1))
+        return
+    print(f"{'people':>6} {'expenses':>8} {'clusters':>8} {'build ms':>9} {'upserts ms':>10} {'float ms':>9} "
+          f"{'edit ms':>8} {'greedy':>7} {'min':>5} {'min ms':>8} {'drift $':>8}")
+    for r in rows:
+        print(f"{r['people']:>6} {r['expenses']:>8} {r['clusters']:>8} {r['build_ms']:>9} {r['upsert_all_ms']:>10} "
+              f"{r['client_float_ms']:>9} {r['update_ms']:>8} "
+              f"{r['greedy']:>7} {r['min_transfers']:>5} {r['min_transfers_ms']:>8} {r['max_drift']:>8}")
+    for h in http:
+        print(f"POST /settle {h['people']} people x {h['expenses']} expenses: full {h['http_full_ms']} ms, "
+              f"one upsert {h['http_upsert_ms']} ms, {h['transfers']} transfers")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Local stand-ins for Azure DI, Azure Vision Read and OpenAI chat completions.
+# Run with: uvicorn bench.stubs:app --port 8901
+#
+# Responses replay the fixtures in bench/fixtures/*.json. The uploaded image picks the
+# fixture and the engine path that should win via a marker (see stub_image):
+#   azure_receipt          DI returns every item
+#   azure_read_gpt         DI under-itemizes; GPT on the OCR text (DI's own, or Read's) succeeds
+#   azure_read_gpt_strict  as above, but the first GPT text pass under-itemizes too
+#   gpt_image              DI fails and Read finds no text; GPT vision answers
+# Latency, jitter and error draws are seeded from STUB_SEED and the request body, so a
+# given image always sees the same delays and failures. Per-upstream overrides use
+# STUB_<DI|READ|OPENAI>_<LATENCY_MS|JITTER_MS|ERROR_RATE>. Text completions report token
+# usage estimated from the prompt and answer (~4 characters per token), so prompt size
+# changes show up in usage; vision completions replay the fixture's usage.
+# STUB_CONNECT_MS delays the first request on each new client connection, standing in
+# for the TCP + TLS handshake a real upstream costs.
+from fastapi import FastAPI, Request, Response
+from typing import Optional
+import os, re, json, uuid, time, base64, asyncio, hashlib, random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+SCENARIOS = ("azure_receipt", "azure_read_gpt", "azure_read_gpt_strict", "gpt_image")
+
+STUB_SEED       = os.environ.get("STUB_SEED", "0")
+STUB_DI_RUN_MS  = float(os.environ.get("STUB_DI_RUN_MS", "1500"))       # DI operation runtime
+STUB_ERROR_STATUS = int(os.environ.get("STUB_ERROR_STATUS", "503"))
+STUB_CONNECT_MS = float(os.environ.get("STUB_CONNECT_MS", "0"))
+
+def _knob(upstream: str, name: str, default: str) -> float:
+    return float(os.environ.get(f"STUB_{upstream}_{name}") or os.environ.get(f"STUB_{name}", default))
+
+LATENCY_MS = {u: _knob(u, "LATENCY_MS", "300") for u in ("DI", "READ", "OPENAI")}   # per upstream call
+JITTER_MS  = {u: _knob(u, "JITTER_MS", "0") for u in ("DI", "READ", "OPENAI")}      # +/- uniform
+ERROR_RATE = {u: _knob(u, "ERROR_RATE", "0") for u in ("DI", "READ", "OPENAI")}
+
+def _load_fixtures() -> dict[str, dict]:
+    out = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".json"):
+            with open(os.path.join(FIXTURES_DIR, name)) as f:
+                fx = json.load(f)
+            out[fx["name"]] = fx
+    return out
+
+FIXTURES = _load_fixtures()
+
+_MARKER = re.compile(rb"STUB:fixture=(\w+);scenario=(\w+);")
+_OCR_TAG = re.compile(r"STUB scenario=(\w+) fixture=(\w+)")
+
+def stub_image(fixture: str, scenario: str, nonce: int = 0, size: int = 64 * 1024) -> bytes:
+    # Fake JPEG carrying the marker; the nonce keeps the result cache from short-circuiting
+    head = b"\xff\xd8\xff" + f"STUB:fixture={fixture};scenario={scenario};".encode()
+    return head + hashlib.sha256(f"{nonce}".encode()).digest() * (size // 32) + nonce.to_bytes(8, "big")
+
+def _scenario(body: bytes) -> tuple[dict, str]:
+    m = _MARKER.search(body)
+    if m is None:  # unmarked uploads replay the first fixture on the DI path
+        return next(iter(FIXTURES.values())), "azure_receipt"
+    return FIXTURES.get(m.group(1).decode(), next(iter(FIXTURES.values()))), m.group(2).decode()
+
+app = FastAPI(title="SplitChamp upstream stubs")
+_CONNS: set = set()  # client (host, port) pairs seen, i.e. connections already "handshaken"
+
+@app.middleware("http")
+async def handshake(request: Request, call_next):
+    peer = (request.client.host, request.client.port) if request.client else None
+    if STUB_CONNECT_MS > 0 and peer not in _CONNS:
+        _CONNS.add(peer)
+        CALLS["connect"] = CALLS.get("connect", 0) + 1
+        await asyncio.sleep(STUB_CONNECT_MS / 1000.0)
+    return await call_next(request)
+_OPS: dict[str, list] = {}  # op id -> [ready epoch, analyzeResult, polls so far]
+CALLS: dict[str, int] = {}
+
+def _rng(upstream: str, body: bytes) -> random.Random:
+    return random.Random(hashlib.sha256(f"{STUB_SEED}:{upstream}:".encode() + body).digest())
+
+async def _delay(upstream: str, rng: random.Random) -> Optional[Response]:
+    # Sleeps the configured latency; returns an error response if this call should fail
+    CALLS[upstream] = CALLS.get(upstream, 0) + 1
+    jitter = JITTER_MS[upstream]
+    await asyncio.sleep(max(0.0, LATENCY_MS[upstream] + rng.uniform(-jitter, jitter)) / 1000.0)
+    if rng.random() < ERROR_RATE[upstream]:
+        return Response(status_code=STUB_ERROR_STATUS, content=b'{"error":"stub injected failure"}',
+                        media_type="application/json")
+    return None
+
+def _under_itemized(result: dict, scenario: str, fixture: str) -> dict:
+    # Same document with a single item, below the pipeline's item-count gate. The page
+    # text starts with the tag line the GPT stub reads, as Read's text does.
+    out = json.loads(json.dumps(result))
+    items = out["documents"][0]["fields"]["Items"]
+    items["valueArray"] = items["valueArray"][:1]
+    out["content"] = f"STUB scenario={scenario} fixture={fixture}\n" + out.get("content", "")
+    return out
+
+@app.post("/documentintelligence/documentModels/prebuilt-receipt:analyze")
+@app.post("/formrecognizer/documentModels/prebuilt-receipt:analyze")
+async def di_submit(request: Request):
+    body = await request.body()
+    rng = _rng("DI", body)
+    err = await _delay("DI", rng)
+    if err is not None:
+        return err
+    fx, scenario = _scenario(body)
+    if scenario == "azure_receipt":
+        result = fx["di"]
+    elif scenario == "gpt_image":
+        result = {"status": "failed"}
+    else:
+        result = _under_itemized(fx["di"], scenario, fx["name"])
+    op = uuid.uuid4().hex
+    _OPS[op] = [time.time() + STUB_DI_RUN_MS * rng.uniform(0.8, 1.2) / 1000.0, result, 0]
+    loc = f"{request.base_url}di/operations/{op}"
+    return Response(status_code=202, headers={"operation-location": loc})
+
+@app.get("/di/operations/{op}")
+async def di_poll(op: str):
+    entry = _OPS.get(op)
+    if entry is None:
+        return Response(status_code=404)
+    entry[2] += 1  # each poll attempt gets its own draw
+    err = await _delay("DI", _rng("DI", f"{op}:{entry[2]}".encode()))
+    if err is not None:
+        return err
+    ready, result, _ = entry
+    if time.time() < ready:
+        return {"status": "running"}
+    _OPS.pop(op, None)
+    if result.get("status") == "failed":
+        return {"status": "failed", "error": {"code": "InvalidContent"}}
+    return {"status": "succeeded", "analyzeResult": result}
+
+@app.post("/computervision/imageanalysis:analyze")
+async def vision_read(request: Request):
+    body = await request.body()
+    err = await _delay("READ", _rng("READ", body))
+    if err is not None:
+        return err
+    fx, scenario = _scenario(body)
+    if scenario == "gpt_image":
+        return {"readResult": {"blocks": []}}
+    out = json.loads(json.dumps(fx["read"]))
+    # First line tells the GPT stub which scenario this OCR text belongs to
+    out["readResult"]["blocks"].insert(0, {"lines": [{"text": f"STUB scenario={scenario} fixture={fx['name']}"}]})
+    return out
+
+def _chat(content: dict, usage: dict) -> dict:
+    return {
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(content)},
+                     "finish_reason": "stop"}],
+        "usage": {**usage, "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"]},
+    }
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.body()
+    err = await _delay("OPENAI", _rng("OPENAI", body))
+    if err is not None:
+        return err
+    messages = json.loads(body)["messages"]
+    parts = messages[-1]["content"]
+    image = next((p["image_url"]["url"] for p in parts if p.get("type") == "image_url"), None)
+    if image is not None:
+        fx, _ = _scenario(base64.b64decode(image.split(",", 1)[1]))
+        return _chat(fx["chat"], fx["usage"])
+    text = "\n".join(p.get("text", "") for p in parts)
+    m = _OCR_TAG.search(text)
+    scenario, fx = (m.group(1), FIXTURES.get(m.group(2))) if m else ("azure_read_gpt", None)
+    fx = fx or next(iter(FIXTURES.values()))
+    content = fx["chat"]
+    if scenario == "azure_read_gpt_strict" and "Extract EVERY purchasable line with its price" not in text:
+        content = {**content, "items": content["items"][:1]}
+    prompt = len(messages[0]["content"]) + len(text)  # system + user text parts
+    return _chat(content, {"prompt_tokens": (prompt + 3) // 4, "completion_tokens": (len(json.dumps(content)) + 3) // 4})
+
+@app.get("/stub/stats")
+def stub_stats():
+    return {"calls": CALLS, "pending_ops": len(_OPS), "fixtures": sorted(FIXTURES)}
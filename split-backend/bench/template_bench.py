@@ -0,0 +1,82 @@
+# Merchant templates (templates.py) on repeat receipts: each fixture is uploaded
+# --repeats times through the in-process app with stub upstreams and no result cache,
+# once per TEMPLATES_MODE, from an empty store.
+#
+#   python -m bench.template_bench                       # off / shadow / on, scenario azure_read_gpt
+#   python -m bench.template_bench --repeats 20 --scenario azure_read_gpt_strict --json
+#
+# Reports the template hit rate, OpenAI calls, mean latency and whether each on-mode
+# result matches the off-mode (GPT) result for the same upload.
+import argparse, asyncio, json, os, sys, time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("OPENAI_BASE_URL", "http://stub/v1")
+for _k in ("AZURE_DI_ENDPOINT", "AZURE_VISION_ENDPOINT"):
+    os.environ.setdefault(_k, "http://stub")
+os.environ.setdefault("AZURE_DI_KEY", "bench")
+os.environ.setdefault("AZURE_VISION_KEY", "bench")
+os.environ.setdefault("RATE_LIMIT", "0")
+os.environ.setdefault("DI_POLL_FIRST_DELAY_SEC", "0.05")
+os.environ.setdefault("STUB_DI_RUN_MS", "100")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import httpx
+import server
+from bench import stubs
+from templates import TemplateStore
+
+def _sig(r: dict) -> tuple:
+    return (sorted(round(it["amount"] * 100) for it in r["items"]), round((r.get("total") or 0) * 100))
+
+async def run(mode: str, fixtures: list[str], repeats: int, scenario: str) -> dict:
+    server.TEMPLATES = TemplateStore(mode=mode, min_samples=int(os.environ.get("TEMPLATES_MIN_SAMPLES", "2"))
+                                     ) if mode != "off" else None
+    for n in server.UPSTREAMS:
+        server._CLIENTS[n] = httpx.AsyncClient(transport=httpx.ASGITransport(app=stubs.app))
+    server.RESULT_CACHE = None
+    stubs.CALLS.clear()
+    engines: dict[str, int] = {}
+    ms, sigs = [], {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench") as c:
+        for i in range(repeats):
+            for name in fixtures:
+                img = stubs.stub_image(name, scenario, nonce=i * 1000 + fixtures.index(name) + 1)
+                t0 = time.perf_counter()
+                r = await c.post("/analyze-receipt", files={"file": ("r.jpg", img, "image/jpeg")})
+                ms.append((time.perf_counter() - t0) * 1000)
+                assert r.status_code == 200, r.text
+                body = r.json()
+                engines[body["engine"]] = engines.get(body["engine"], 0) + 1
+                sigs[(name, i)] = _sig(body)
+    await server._close_clients()
+    stats = server.TEMPLATES.stats() if server.TEMPLATES is not None else {}
+    return {"mode": mode, "requests": len(ms), "mean_ms": round(sum(ms) / len(ms), 1),
+            "openai_calls": stubs.CALLS.get("OPENAI", 0), "engines": engines,
+            "hit_rate": stats.get("hit_rate"), "shadow": stats.get("shadow"),
+            "saved_ms": stats.get("saved_ms"), "_sigs": sigs}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeats", type=int, default=10, help="uploads per fixture")
+    ap.add_argument("--scenario", default="azure_read_gpt", choices=stubs.SCENARIOS)
+    ap.add_argument("--latency-ms", type=float, default=300, help="stub OpenAI latency per call")
+    ap.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = ap.parse_args()
+    stubs.LATENCY_MS["OPENAI"] = args.latency_ms
+    fixtures = sorted(stubs.FIXTURES)
+
+    rows = [asyncio.run(run(m, fixtures, args.repeats, args.scenario)) for m in ("off", "shadow", "on")]
+    base = rows[0].pop("_sigs")
+    for r in rows[1:]:
+        sigs = r.pop("_sigs")
+        r["same_as_gpt"] = sum(sigs[k] == base[k] for k in base)
+    if args.json:
+        print(json.dumps(rows, indent=1))
+        return
+    print(f"{'mode':<7} {'requests':>8} {'mean ms':>8} {'openai':>7} {'hit rate':>9} {'saved ms':>9} "
+          f"{'same':>5}  engines")
+    for r in rows:
+        print(f"{r['mode']:<7} {r['requests']:>8} {r['mean_ms']:>8} {r['openai_calls']:>7} "
+              f"{str(r['hit_rate']):>9} {str(r['saved_ms']):>9} {str(r.get('same_as_gpt', '-')):>5}  {r['engines']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Tiled reads of long receipts (IMAGE_TILING): a synthetic grocery strip is drawn with
+# Pillow, cut into bands by imageprep, and each band is "read" by a modelled engine
+# that returns the item lines lying wholly inside it (a line cut by the band edge
+# comes back truncated, as a real OCR misread would) after base + per-megapixel
+# latency. The bands go through server._tiled_path, so banding, concurrency and
+# stitching are the server's own; only the upstream engine is modelled.
+#
+#   python -m bench.tile_bench                           # 40/120/300 items
+#   python -m bench.tile_bench --items 200 --overlap 0.1 --json
+#   python -m bench.tile_bench --fail-band 1               # one band errors
+#
+# Reports band count, wall time tiled vs one call on the whole image under the same
+# latency model, and stitched items missing / duplicated against the drawn ones.
+# --fail-band N makes band N answer an upstream error after a quarter of the base
+# latency: the tiled path should give up then (returning None, so the request falls
+# back to the whole-image cascade) with the other bands cancelled, not finished.
+from typing import Optional
+import argparse, asyncio, io, json, os, random, sys, time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("IMAGE_TILING", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastapi import HTTPException
+from PIL import Image, ImageDraw, ImageFont
+import server
+
+WORDS = ("ORGANIC", "BANANAS", "WHOLE", "MILK", "EGGS", "LARGE", "BREAD", "SOURDOUGH", "CHEDDAR",
+         "APPLES", "GALA", "YOGURT", "GREEK", "SPINACH", "CHICKEN", "THIGHS", "RICE", "BASMATI")
+
+def _receipt(n_items: int, width: int, line_h: int, rnd: random.Random) -> tuple[bytes, list[dict], dict]:
+    # JPEG bytes, drawn items with their rows, and the drawn totals
+    items = [{"description": f"{rnd.choice(WORDS)} {rnd.choice(WORDS)} {k}",
+              "amount": round(rnd.uniform(0.5, 25), 2)} for k in range(n_items)]
+    sub = round(sum(it["amount"] for it in items), 2)
+    tax = round(sub * 0.06, 2)
+    height = line_h * (n_items + 12)
+    im = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(im)
+    font = ImageFont.load_default(size=line_h * 2 // 3)
+    y = line_h * 3
+    draw.text((20, line_h), "BENCH MARKET #12", font=font, fill=0)
+    for it in items:
+        it["rows"] = (y, y + line_h)
+        draw.text((20, y), it["description"], font=font, fill=0)
+        draw.text((width - 160, y), f"{it['amount']:.2f}", font=font, fill=0)
+        y += line_h
+    totals = {"tax": tax, "total": round(sub + tax, 2), "rows": (y + line_h, y + 3 * line_h)}
+    draw.text((20, y + line_h), f"TAX {tax:.2f}", font=font, fill=0)
+    draw.text((20, y + 2 * line_h), f"TOTAL {totals['total']:.2f}", font=font, fill=0)
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue(), items, totals
+
+def _engine(items: list[dict], totals: dict, base_ms: float, ms_per_mpx: float, calls: list,
+            done: list, fail_band: Optional[int]):
+    async def read(run, tile, i):
+        top, bottom = tile.band
+        w, h = tile._decoded[0].size
+        calls.append(w * h)
+        if i == fail_band:
+            await asyncio.sleep(base_ms / 4000)
+            raise HTTPException(status_code=502, detail="OpenAI error (429)")
+        await asyncio.sleep((base_ms + ms_per_mpx * w * h / 1e6) / 1000)
+        done.append(i)
+        out = []
+        for it in items:
+            y0, y1 = it["rows"]
+            if top <= y0 and y1 <= bottom:
+                out.append({"description": it["description"], "amount": it["amount"]})
+            elif y0 < bottom and y1 > top:  # cut by the band edge: half the words survive
+                words = it["description"].split()
+                out.append({"description": " ".join(words[:len(words) // 2]) + "~", "amount": it["amount"]})
+        seen = totals["rows"][0] >= top and totals["rows"][1] <= bottom
+        return {"merchant": "BENCH MARKET" if top == 0 else "", "items": out,
+                "tax": totals["tax"] if seen else 0.0, "total": totals["total"] if seen else 0.0}
+    return read
+
+async def run(n_items: int, width: int, line_h: int, overlap: float, base_ms: float, ms_per_mpx: float,
+              seed: int, fail_band: Optional[int] = None) -> dict:
+    server.IMAGE_TILE_OVERLAP = overlap
+    server.FORCE_SECOND_PASS_MIN_ITEMS = 1
+    raw, items, totals = _receipt(n_items, width, line_h, random.Random(seed))
+    calls: list = []
+    done: list = []
+    server._tile_parse = _engine(items, totals, base_ms, ms_per_mpx, calls, done, fail_band)
+    er = server._EngineRun("sequential")
+    t0 = time.perf_counter()
+    res = await server._tiled_path(er, server.IMAGE_PREP.prepare(raw))
+    tiled_ms = (time.perf_counter() - t0) * 1000
+    if er.tiles is None:  # not tall enough for IMAGE_TILE_MIN_ASPECT
+        return None
+    if fail_band is not None:
+        await asyncio.sleep((base_ms + ms_per_mpx * max(calls) / 1e6) / 1000)  # would the others finish?
+        return {"items": n_items, "bands": len(er.tiles["bands"]), "fail_band": fail_band,
+                "fell_back": res is None, "gave_up_ms": round(tiled_ms),
+                "bands_finished": len(done), "bands_cancelled": len(calls) - len(done) - 1}
+    assert res is not None, er.tiles
+    parsed, _ = res
+    got = [(it["description"], it["amount"]) for it in parsed["items"]]
+    want = [(it["description"], it["amount"]) for it in items]
+    missing = sum(1 for w in want if w not in got)
+    height = line_h * (n_items + 12)
+    return {"items": n_items, "height_px": height, "bands": len(er.tiles["bands"]),
+            "tiled_ms": round(tiled_ms), "whole_ms": round(base_ms + ms_per_mpx * width * height / 1e6),
+            "slowest_band_ms": round(base_ms + ms_per_mpx * max(calls) / 1e6),
+            "stitched": len(got), "missing": missing, "extra": len(got) - (len(want) - missing),
+            "overlap_dropped": er.tiles["dropped"], "total_ok": parsed["total"] == totals["total"]}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=None)
+    ap.add_argument("--width", type=int, default=640)
+    ap.add_argument("--line-px", type=int, default=42)
+    ap.add_argument("--overlap", type=float, default=server.IMAGE_TILE_OVERLAP)
+    ap.add_argument("--base-ms", type=float, default=800, help="modelled engine latency per call")
+    ap.add_argument("--ms-per-mpx", type=float, default=600, help="modelled engine latency per megapixel")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--fail-band", type=int, default=None, help="band that answers an upstream error")
+    ap.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = ap.parse_args()
+
+    rows = [asyncio.run(run(n, args.width, args.line_px, args.overlap, args.base_ms, args.ms_per_mpx, args.seed,
+                            args.fail_band))
+            for n in ([args.items] if args.items else [40, 120, 300])]
+    rows = [r for r in rows if r is not None]
+    if args.json or args.fail_band is not None:
+        print(json.dumps(rows, indent=1))
+        return
+    print(f"{'items':>5} {'height':>7} {'bands':>5} {'tiled ms':>9} {'slowest':>8} {'whole ms':>9} "
+          f"{'stitched':>8} {'missing':>7} {'extra':>5} {'dropped':>7} {'total':>5}")
+    for r in rows:
+        print(f"{r['items']:>5} {r['height_px']:>7} {r['bands']:>5} {r['tiled_ms']:>9} {r['slowest_band_ms']:>8} "
+              f"{r['whole_ms']:>9} {r['stitched']:>8} {r['missing']:>7} {r['extra']:>5} {r['overlap_dropped']:>7} "
+              f"{str(r['total_ok']):>5}")
+
+if __name__ == "__main__":
+    main()
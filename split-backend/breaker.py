@@ -0,0 +1,131 @@
+# Circuit breakers for upstream engines, plus per-engine path latency.
+#
+# A breaker watches the calls made to one upstream over a rolling window. It opens
+# when, with at least min_calls calls in the window, the share of failed calls
+# (errors, 5xx/429, or slower than slow_call_sec) reaches error_rate. While open,
+# callers skip the upstream. After open_sec one caller is let through as a
+# half-open probe. If the probe succeeds the breaker closes; if it fails the breaker
+# reopens with the open time doubled, up to max_open_sec.
+from collections import deque
+from typing import Optional
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+def _pct(xs, q: float) -> Optional[float]:
+    if not xs:
+        return None
+    s = sorted(xs)
+    return s[min(len(s) - 1, int(len(s) * q))]
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_sec: float = 60.0,
+        min_calls: int = 5,
+        error_rate: float = 0.5,
+        slow_call_sec: float = 30.0,
+        open_sec: float = 30.0,
+        max_open_sec: float = 300.0,
+    ):
+        self.name = name
+        self.window_sec = window_sec
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_sec = slow_call_sec
+        self.open_sec = open_sec
+        self.max_open_sec = max_open_sec
+        self.state = CLOSED
+        self._calls: deque[tuple[float, bool, float]] = deque()  # (ts, ok, seconds)
+        self._open_until = 0.0
+        self._open_for = open_sec
+        self._probe_at: Optional[float] = None
+        self.trips = 0
+        self.rejected = 0
+
+    def _trim(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_sec:
+            self._calls.popleft()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now >= self._open_until:
+            self.state = HALF_OPEN
+            self._probe_at = None
+        if self.state == HALF_OPEN:
+            # One probe at a time; a probe that never reports (cancelled) frees the slot
+            if self._probe_at is None or now - self._probe_at > self.slow_call_sec:
+                self._probe_at = now
+                return True
+        self.rejected += 1
+        return False
+
+    def record(self, ok: bool, seconds: float) -> None:
+        now = time.monotonic()
+        ok = ok and seconds < self.slow_call_sec
+        self._calls.append((now, ok, seconds))
+        self._trim(now)
+        if self.state == HALF_OPEN:
+            if ok:
+                self.state = CLOSED
+                self._open_for = self.open_sec
+                self._calls.clear()
+            else:
+                self._open_for = min(self.max_open_sec, self._open_for * 2)
+                self._trip(now)
+            return
+        if self.state == CLOSED and len(self._calls) >= self.min_calls:
+            failed = sum(1 for _, good, _ in self._calls if not good)
+            if failed / len(self._calls) >= self.error_rate:
+                self._trip(now)
+
+    def _trip(self, now: float) -> None:
+        self.state = OPEN
+        self._open_until = now + self._open_for
+        self._probe_at = None
+        self.trips += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._trim(now)
+        n = len(self._calls)
+        lat = [s for _, _, s in self._calls]
+        p50, p95 = _pct(lat, 0.5), _pct(lat, 0.95)
+        return {
+            "state": self.state,
+            "calls": n,
+            "error_rate": round(sum(1 for _, ok, _ in self._calls if not ok) / n, 3) if n else None,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "retry_in_sec": round(self._open_until - now, 1) if self.state == OPEN else None,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class PathLatency:
+    # Recent successful end-to-end latency per engine path, used to order paths
+    def __init__(self, window: int = 50, min_samples: int = 5):
+        self.min_samples = min_samples
+        self._window = window
+        self._samples: dict[str, deque] = {}
+
+    def record(self, path: str, seconds: float) -> None:
+        self._samples.setdefault(path, deque(maxlen=self._window)).append(seconds)
+
+    def p50(self, path: str) -> Optional[float]:
+        xs = self._samples.get(path)
+        if not xs or len(xs) < self.min_samples:
+            return None
+        return _pct(xs, 0.5)
+
+    def stats(self) -> dict:
+        return {
+            path: {"samples": len(xs), "p50_ms": round(_pct(xs, 0.5) * 1000), "p95_ms": round(_pct(xs, 0.95) * 1000)}
+            for path, xs in self._samples.items() if xs
+        }
@@ -0,0 +1,160 @@
+# Content-addressed cache for parsed (pre-postprocess) receipt results.
+#
+# Memory tier: LRU bounded by entry count and total bytes, with TTL.
+# Disk tier (optional): SQLite file that survives restarts; lookups and writes
+# run in a thread so they never block the event loop.
+from collections import OrderedDict
+from typing import Optional
+import asyncio, hashlib, json, sqlite3, threading, time
+
+
+def content_key(raw: bytes, version: str) -> str:
+    h = hashlib.sha256(raw)
+    h.update(b"\0" + version.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(
+        self,
+        max_entries: int = 512,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl_sec: float = 86400,
+        db_path: Optional[str] = None,
+        db_max_rows: int = 50_000,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.db_max_rows = db_max_rows
+        self._mem: "OrderedDict[str, tuple[float, bytes]]" = OrderedDict()  # key -> (expires, blob)
+        self._mem_bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._db_puts = 0
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.evictions = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, blob BLOB)"
+            )
+
+    # ---- memory tier ----
+    def _mem_get(self, key: str) -> Optional[bytes]:
+        ent = self._mem.get(key)
+        if ent is None:
+            return None
+        expires, blob = ent
+        if expires < time.time():
+            self._mem_drop(key)
+            return None
+        self._mem.move_to_end(key)
+        return blob
+
+    def _mem_put(self, key: str, blob: bytes, expires: float) -> None:
+        if len(blob) > self.max_bytes:
+            return
+        if key in self._mem:
+            self._mem_drop(key)
+        self._mem[key] = (expires, blob)
+        self._mem_bytes += len(blob)
+        while self._mem and (len(self._mem) > self.max_entries or self._mem_bytes > self.max_bytes):
+            old, _ = next(iter(self._mem.items()))
+            self._mem_drop(old)
+            self.evictions += 1
+
+    def _mem_drop(self, key: str) -> None:
+        _, blob = self._mem.pop(key)
+        self._mem_bytes -= len(blob)
+
+    # ---- disk tier ----
+    def _disk_get(self, key: str) -> Optional[tuple[float, bytes]]:
+        with self._db_lock:
+            row = self._db.execute("SELECT expires, blob FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return row[0], row[1]
+
+    def _disk_put(self, key: str, blob: bytes, expires: float) -> None:
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO results (key, expires, blob) VALUES (?, ?, ?)",
+                             (key, expires, blob))
+            self._db_puts += 1
+            if self._db_puts % 100 == 0:
+                self._db.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                    (self.db_max_rows,),
+                )
+
+    # ---- public API ----
+    async def get(self, key: str) -> Optional[dict]:
+        blob = self._mem_get(key)
+        if blob is not None:
+            self.hits_mem += 1
+            return json.loads(blob)
+        if self._db is not None:
+            row = await asyncio.to_thread(self._disk_get, key)
+            if row is not None:
+                self.hits_disk += 1
+                self._mem_put(key, row[1], row[0])
+                return json.loads(row[1])
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: dict) -> None:
+        blob = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        expires = time.time() + self.ttl_sec
+        self._mem_put(key, blob, expires)
+        if self._db is not None:
+            await asyncio.to_thread(self._disk_put, key, blob, expires)
+
+    def stats(self) -> dict:
+        lookups = self.hits_mem + self.hits_disk + self.misses
+        return {
+            "entries": len(self._mem),
+            "bytes": self._mem_bytes,
+            "hits_mem": self.hits_mem,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits_mem + self.hits_disk) / lookups, 3) if lookups else None,
+            "disk": self._db is not None,
+        }
+
+    def close(self) -> None:
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+
+class SingleFlight:
+    # Coalesces concurrent calls with the same key onto one shared task. The task is
+    # shielded, so a caller that disconnects does not cancel the work for the others.
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn) -> tuple[object, bool]:
+        task = self._inflight.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _t, k=key: self._inflight.pop(k, None))
+        return await asyncio.shield(task), shared
+
+    def running(self, key: str) -> bool:
+        return key in self._inflight
+
+    def stats(self) -> dict:
+        return {"active": len(self._inflight), "leaders": self.leaders, "coalesced": self.coalesced}
@@ -0,0 +1,93 @@
+# Data-driven item categorizer.
+#
+# The keyword dictionary (categories.json, or CATEGORIES_PATH) lists words and phrases
+# per category and locale; a locale may extend another. Each locale is compiled once
+# into a single regex with one named group per category. Keywords match whole words
+# (an optional plural "s"/"es" is allowed), so "app" no longer matches "apple" nor
+# "ale" "kale". Text is accent-folded, lowercased and punctuation-collapsed before
+# matching, keywords included. When several categories match, the one listed first
+# in "priority" wins; no match gives "default".
+from typing import Iterable, Optional
+import json, re, unicodedata
+
+_PUNCT = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    s = unicodedata.normalize("NFKD", text or "")
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    return _PUNCT.sub(" ", s.casefold()).strip()
+
+
+class Categorizer:
+    def __init__(self, dictionary: dict, default_locale: str = "en", memo_size: int = 50_000):
+        self.version = str(dictionary.get("version", ""))
+        self.priority: list[str] = list(dictionary["priority"])
+        self.default: str = dictionary.get("default", "food")
+        self.default_locale = default_locale
+        self.memo_size = memo_size
+        self._rank = {cat: i for i, cat in enumerate(self.priority)}
+        raw = dictionary["locales"]
+        self.keywords: dict[str, dict[str, list[str]]] = {loc: self._resolve(raw, loc, ()) for loc in raw}
+        self._patterns = {loc: self._compile(kw) for loc, kw in self.keywords.items()}
+        self._memo: dict[tuple[str, str], str] = {}
+        if default_locale not in self._patterns:
+            raise ValueError(f"default locale {default_locale!r} is not in the dictionary")
+
+    @classmethod
+    def load(cls, path: str, **kw) -> "Categorizer":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), **kw)
+
+    def _resolve(self, raw: dict, loc: str, seen: tuple) -> dict[str, list[str]]:
+        if loc in seen:
+            raise ValueError(f"locale {loc!r} extends itself")
+        spec = raw[loc]
+        base = self._resolve(raw, spec["extends"], seen + (loc,)) if spec.get("extends") else {}
+        out = {}
+        for cat in self.priority:
+            words = {normalize(w) for w in base.get(cat, []) + spec.get(cat, [])}
+            out[cat] = sorted(w for w in words if w)
+        return out
+
+    def _compile(self, keywords: dict[str, list[str]]) -> re.Pattern:
+        # Longest keywords first so a phrase wins over its leading word at the same position
+        groups = []
+        for cat in self.priority:
+            words = sorted(keywords[cat], key=len, reverse=True)
+            if words:
+                groups.append(f"(?P<{cat}>{'|'.join(map(re.escape, words))})")
+        # A keyword may run into digits (POS labels like TAX1, GST5) but not into letters (TAXI)
+        return re.compile(r"(?<!\w)(?:" + "|".join(groups) + r")(?:e?s)?(?![^\W\d])")
+
+    @property
+    def locales(self) -> list[str]:
+        return sorted(self._patterns)
+
+    def category(self, text: str, locale: Optional[str] = None) -> str:
+        locale = locale or self.default_locale
+        key = (locale, text)
+        hit = self._memo.get(key)
+        if hit is not None:
+            return hit
+        best = None
+        for m in self._patterns[locale].finditer(normalize(text)):
+            rank = self._rank[m.lastgroup]
+            if best is None or rank < best:
+                best = rank
+                if rank == 0:
+                    break
+        cat = self.priority[best] if best is not None else self.default
+        if len(self._memo) >= self.memo_size:
+            self._memo.clear()
+        self._memo[key] = cat
+        return cat
+
+    def clear_memo(self) -> None:
+        self._memo.clear()
+
+    def categorize(self, texts: Iterable[str], locale: Optional[str] = None) -> list[str]:
+        locale = locale or self.default_locale
+        if locale not in self._patterns:
+            raise KeyError(locale)
+        return [self.category(t, locale) for t in texts]
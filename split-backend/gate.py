@@ -0,0 +1,144 @@
+# Cheap local pre-OCR gate: predicts which engine path will succeed before any
+# upstream call, from image features (size, aspect, blur, contrast) and, once OCR text
+# exists, price-token density.
+#
+# Predictions: "azure_receipt" (normal order), "azure_read_gpt" (skip DI: long
+# itemized strips, where DI tends to under-itemize), "gpt_image" (too small or too
+# blurry for OCR) and, for OCR text, the strict variant of the text engine that will
+# read it ("azure_read_gpt_strict" or, for DI's own text, "azure_receipt_gpt_strict":
+# go straight to the strict itemization prompt). Every decision is compared with the
+# engine that actually won; counts are kept per (predicted, actual) and, if a log path
+# is set, each decision is appended as a JSON line with its features for threshold
+# tuning.
+from typing import Optional
+import asyncio, io, json, struct, time
+
+from lazypil import PIL_AVAILABLE, load_pil  # dimension sniffing works without Pillow
+from ocrtext import PRICE_TOKEN
+
+
+def image_size(raw: bytes) -> Optional[tuple[int, int]]:
+    # (width, height) from the JPEG SOF or PNG IHDR header, without decoding
+    if raw[:8] == b"\x89PNG\r\n\x1a\n" and len(raw) >= 24:
+        return struct.unpack(">II", raw[16:24])
+    if raw[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(raw):
+        if raw[i] != 0xFF:
+            i += 1
+            continue
+        marker = raw[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        seg = struct.unpack(">H", raw[i + 2:i + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack(">HH", raw[i + 5:i + 9])
+            return w, h
+        i += 2 + seg
+    return None
+
+
+def _pixel_stats(raw: bytes) -> Optional[dict]:
+    # Blur (variance of a Laplacian) and contrast (grey-level stddev) on a small preview
+    try:
+        PIL = load_pil()
+        im = PIL.Image.open(io.BytesIO(raw))
+        im.draft("L", (512, 512))  # JPEG: decode at reduced scale, much cheaper than a full decode
+        im = im.convert("L")
+        im.thumbnail((512, 512))
+        lap = im.filter(PIL.ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128))
+        return {"blur_var": round(PIL.ImageStat.Stat(lap).var[0], 1),
+                "contrast": round(PIL.ImageStat.Stat(im).stddev[0], 1)}
+    except Exception:
+        return None
+
+
+class PreGate:
+    def __init__(
+        self,
+        mode: str = "shadow",           # off | shadow (predict + log only) | route
+        min_side: int = 400,            # smaller images go to gpt_image
+        strip_aspect: float = 3.0,      # long side / short side at or above this skips DI
+        blur_var: float = 20.0,         # Laplacian variance below this counts as blurry...
+        min_contrast: float = 25.0,     # ...when contrast is also below this
+        strict_prices: int = 15,        # OCR price tokens at or above this use the strict prompt first
+        log_path: Optional[str] = None,
+    ):
+        self.mode = mode
+        self.min_side = min_side
+        self.strip_aspect = strip_aspect
+        self.blur_var = blur_var
+        self.min_contrast = min_contrast
+        self.strict_prices = strict_prices
+        self._log = open(log_path, "a", buffering=1) if log_path and mode != "off" else None
+        self.counts: dict[tuple[str, str], int] = {}  # (predicted, actual) -> n
+
+    @property
+    def routing(self) -> bool:
+        return self.mode == "route"
+
+    async def predict(self, raw: bytes) -> Optional[dict]:
+        if self.mode == "off":
+            return None
+        t0 = time.perf_counter()
+        feats: dict = {"bytes": len(raw)}
+        size = image_size(raw)
+        if size is not None:
+            w, h = size
+            feats.update(width=w, height=h, aspect=round(max(w, h) / max(1, min(w, h)), 2))
+        if PIL_AVAILABLE and size is not None:
+            feats.update(await asyncio.to_thread(_pixel_stats, raw) or {})
+        predicted, reason = "azure_receipt", "default"
+        if size is not None and min(size) < self.min_side:
+            predicted, reason = "gpt_image", "small"
+        elif feats.get("blur_var", 1e9) < self.blur_var and feats.get("contrast", 1e9) < self.min_contrast:
+            predicted, reason = "gpt_image", "blurry"
+        elif feats.get("aspect", 0) >= self.strip_aspect:
+            predicted, reason = "azure_read_gpt", "long_strip"
+        feats["gate_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return {"mode": self.mode, "predicted": predicted, "reason": reason, "features": feats}
+
+    def predict_text(self, decision: Optional[dict], text: str, strict_engine: str = "azure_read_gpt_strict") -> bool:
+        # True if the strict itemization prompt should be tried first for this OCR text
+        if decision is None:
+            return False
+        prices = len(PRICE_TOKEN.findall(text))
+        lines = text.count("\n") + 1
+        decision["features"].update(ocr_prices=prices, ocr_lines=lines,
+                                    price_density=round(prices / lines, 2))
+        strict = prices >= self.strict_prices
+        if strict:
+            decision["text_predicted"] = strict_engine
+        return strict
+
+    def observe(self, decision: dict, actual: str) -> str:
+        # Records the outcome; returns the prediction it was scored against
+        predicted = decision["predicted"]
+        if actual.endswith(("_gpt", "_gpt_strict")) and "text_predicted" in decision:
+            predicted = decision["text_predicted"]
+        decision["actual"] = actual
+        decision["correct"] = predicted == actual
+        key = (predicted, actual)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self._log is not None:
+            try:
+                self._log.write(json.dumps({"ts": round(time.time(), 3), **decision}) + "\n")
+            except Exception as e:
+                print("Pre-gate log error:", e)
+        return predicted
+
+    def stats(self) -> dict:
+        total = sum(self.counts.values())
+        correct = sum(n for (p, a), n in self.counts.items() if p == a)
+        return {
+            "mode": self.mode,
+            "decisions": total,
+            "accuracy": round(correct / total, 3) if total else None,
+            "confusion": {f"{p}->{a}": n for (p, a), n in sorted(self.counts.items())},
+        }
+
+    def close(self) -> None:
+        if self._log is not None:
+            self._log.close()
@@ -0,0 +1,162 @@
+# Optional server-side image preprocessing (requires Pillow).
+#
+# The upload is decoded once, EXIF-rotated, then re-encoded per engine profile
+# (max long side, grayscale, JPEG quality). Each engine gets the smallest
+# acceptable payload; the original bytes are used when re-encoding would not
+# shrink them. Decoding/encoding runs in a dedicated thread pool.
+#
+# Tall images (long grocery strips) can also be cut into overlapping full-width bands
+# (tiles()), each a PreparedImage of its own, so engines read them at full resolution.
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import asyncio, io, math, time
+
+from gate import image_size
+from lazypil import PIL_AVAILABLE, load_pil  # preprocessing and tiling are skipped without Pillow
+
+
+TILE_JPEG_QUALITY = 90
+
+
+def bands(width: int, height: int, min_aspect: float, band_aspect: float, overlap: float,
+          max_tiles: int) -> Optional[list[tuple[int, int]]]:
+    # (top, bottom) rows of evenly spaced bands about band_aspect x width tall, adjacent
+    # ones sharing at least `overlap` of a band; None unless height/width >= min_aspect.
+    # With more than max_tiles bands needed, the bands grow instead.
+    if width <= 0 or height < min_aspect * width or max_tiles < 2:
+        return None
+    band = band_aspect * width
+    n = math.ceil((height - overlap * band) / (band - overlap * band))
+    n = max(2, min(n, max_tiles))
+    band = height / (n - (n - 1) * overlap)
+    step = (height - band) / (n - 1)
+    return [(round(i * step), min(height, round(i * step + band))) for i in range(n)]
+
+
+class Profile:
+    def __init__(self, max_side: int, grayscale: bool = True, quality: int = 85):
+        self.max_side = max_side
+        self.grayscale = grayscale
+        self.quality = quality
+
+    def key(self) -> tuple:
+        return (self.max_side, self.grayscale, self.quality)
+
+
+class ImagePrep:
+    def __init__(self, enabled: bool, profiles: dict[str, Profile], workers: int = 2):
+        self.enabled = enabled and PIL_AVAILABLE
+        self.profiles = profiles
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="imgprep") if self.enabled else None
+
+    def prepare(self, raw: bytes) -> "PreparedImage":
+        return PreparedImage(self, raw)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+class PreparedImage:
+    def __init__(self, prep: ImagePrep, raw: bytes):
+        self.prep = prep
+        self.raw = raw
+        self._decoded = None         # (PIL image, rotated: bool) or False if undecodable
+        self._decode_lock = asyncio.Lock()
+        self._encoded: dict[tuple, bytes] = {}
+        self.report: dict[str, dict] = {}  # engine -> {bytes, saved_bytes, prep_ms, upload_ms?}
+        self.band: Optional[tuple[int, int]] = None  # (top, bottom) rows in the parent image, for tiles
+
+    def _decode(self):
+        try:
+            PIL = load_pil()
+            im = PIL.Image.open(io.BytesIO(self.raw))
+            im.load()
+            orientation = im.getexif().get(0x0112, 1)
+            if orientation != 1:
+                im = PIL.ImageOps.exif_transpose(im)
+            return im, orientation != 1
+        except Exception as e:
+            print("Image preprocess decode error:", e)
+            return False
+
+    def _encode(self, profile: Profile) -> bytes:
+        im, rotated = self._decoded
+        w, h = im.size
+        scale = profile.max_side / max(w, h)
+        if scale < 1:
+            im = im.resize((max(1, round(w * scale)), max(1, round(h * scale))), load_pil().Image.LANCZOS)
+        im = im.convert("L") if profile.grayscale else im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=profile.quality, optimize=True)
+        out = buf.getvalue()
+        if len(out) >= len(self.raw) and scale >= 1 and not rotated:
+            return self.raw
+        return out
+
+    def _crop(self, boxes: list[tuple[int, int]]) -> list[tuple]:
+        im = self._decoded[0]
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        out = []
+        for top, bottom in boxes:
+            tile = im.crop((0, top, im.width, bottom))
+            buf = io.BytesIO()
+            tile.save(buf, format="JPEG", quality=TILE_JPEG_QUALITY)
+            out.append((tile, buf.getvalue()))
+        return out
+
+    async def _decoded_image(self):
+        async with self._decode_lock:
+            if self._decoded is None:
+                loop = asyncio.get_running_loop()
+                self._decoded = await loop.run_in_executor(self.prep._pool, self._decode)
+        return self._decoded
+
+    async def tiles(self, min_aspect: float, band_aspect: float, overlap: float,
+                    max_tiles: int) -> Optional[list["PreparedImage"]]:
+        # Bands (see bands()) of the EXIF-rotated image, top to bottom; None when the image
+        # is not tall enough, cannot be decoded, or Pillow is missing. Works whether or not
+        # per-engine preprocessing is enabled. The header size is checked first, so
+        # ordinary receipts are never decoded for this; either side may be the long one,
+        # as EXIF rotation is only known after decoding.
+        size = image_size(self.raw)
+        if size is not None and max(size) < min_aspect * min(size):
+            return None
+        if not PIL_AVAILABLE or not await self._decoded_image():
+            return None
+        im = self._decoded[0]
+        boxes = bands(im.width, im.height, min_aspect, band_aspect, overlap, max_tiles)
+        if boxes is None:
+            return None
+        crops = await asyncio.get_running_loop().run_in_executor(self.prep._pool, self._crop, boxes)
+        out = []
+        for box, (tile, data) in zip(boxes, crops):
+            t = PreparedImage(self.prep, data)
+            t._decoded = (tile, False)
+            t.band = box
+            out.append(t)
+        return out
+
+    async def for_engine(self, engine: str) -> bytes:
+        profile = self.prep.profiles.get(engine)
+        if not self.prep.enabled or profile is None:
+            self.report[engine] = {"bytes": len(self.raw), "saved_bytes": 0, "prep_ms": 0}
+            return self.raw
+        t0 = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        await self._decoded_image()
+        async with self._decode_lock:
+            if self._decoded is False:
+                out = self.raw
+            else:
+                out = self._encoded.get(profile.key())
+                if out is None:
+                    out = await loop.run_in_executor(self.prep._pool, self._encode, profile)
+                    self._encoded[profile.key()] = out
+        self.report[engine] = {
+            "bytes": len(out),
+            "saved_bytes": len(self.raw) - len(out),
+            "prep_ms": round((time.perf_counter() - t0) * 1000),
+        }
+        return out
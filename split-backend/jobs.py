@@ -0,0 +1,329 @@
+# Background job queue for receipt analysis.
+#
+# POST /jobs stores the image + knobs and returns an id; a pool of worker tasks
+# runs the analyze pipeline and records the result (and optionally POSTs it to a
+# callback URL). Stores: in-memory (default) or SQLite, which keeps queued jobs
+# across restarts and can be shared by several worker processes.
+#
+# A worker runs a job only after claiming it: status queued -> running with its owner
+# id and a lease, in one conditional update, so two processes never both analyze (and
+# pay upstream for) the same receipt. The lease is renewed while the job runs; a job
+# whose lease ran out (its process died) is claimable again, and each runner re-queues
+# those on startup and every lease period.
+from collections import deque
+from typing import Optional
+import asyncio, json, os, socket, sqlite3, threading, time, uuid
+
+import httpx
+
+TERMINAL = ("succeeded", "failed")
+
+
+class MemoryJobStore:
+    def __init__(self):
+        self._jobs: dict[str, dict] = {}
+
+    async def put(self, job: dict) -> None:
+        self._jobs[job["id"]] = dict(job)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    async def update(self, job_id: str, **fields) -> None:
+        if job_id in self._jobs:
+            self._jobs[job_id].update(fields)
+
+    async def claim(self, job_id: str, owner: str, lease_until: float) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or not _claimable(job, time.time()):
+            return False
+        job.update(status="running", owner=owner, lease_until=lease_until)
+        return True
+
+    async def renew(self, job_id: str, owner: str, lease_until: float) -> None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.get("owner") == owner:
+            job["lease_until"] = lease_until
+
+    async def unfinished(self) -> list[dict]:
+        # Queued, or running on a lease that has run out
+        now = time.time()
+        return [dict(j) for j in self._jobs.values() if _claimable(j, now)]
+
+    async def purge(self, finished_before: float) -> int:
+        old = [k for k, j in self._jobs.items() if (j.get("finished_at") or float("inf")) < finished_before]
+        for k in old:
+            del self._jobs[k]
+        return len(old)
+
+    def close(self) -> None:
+        pass
+
+
+def _claimable(job: dict, now: float) -> bool:
+    return job["status"] == "queued" or (job["status"] == "running" and (job.get("lease_until") or 0) < now)
+
+
+class SQLiteJobStore:
+    # Columns mirror the job dict; knobs/result/error are JSON, image is a blob
+    _COLS = ("id", "status", "created_at", "started_at", "finished_at", "strategy",
+             "knobs", "callback_url", "callback_status", "result", "error", "image",
+             "owner", "lease_until")
+    _JSON = ("knobs", "result", "error")
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, created_at REAL, "
+            "started_at REAL, finished_at REAL, strategy TEXT, knobs TEXT, callback_url TEXT, "
+            "callback_status TEXT, result TEXT, error TEXT, image BLOB, owner TEXT, lease_until REAL)"
+        )
+        cols = {r[1] for r in self._db.execute("PRAGMA table_info(jobs)")}
+        for col, kind in (("owner", "TEXT"), ("lease_until", "REAL")):  # databases from before leases
+            if col not in cols:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {col} {kind}")
+
+    def _encode(self, k: str, v):
+        return json.dumps(v) if k in self._JSON and v is not None else v
+
+    def _row(self, row) -> dict:
+        job = dict(zip(self._COLS, row))
+        for k in self._JSON:
+            if job[k] is not None:
+                job[k] = json.loads(job[k])
+        return job
+
+    def _exec(self, sql: str, args: tuple = ()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    async def put(self, job: dict) -> None:
+        vals = tuple(self._encode(k, job.get(k)) for k in self._COLS)
+        sql = f"INSERT OR REPLACE INTO jobs ({', '.join(self._COLS)}) VALUES ({', '.join('?' * len(self._COLS))})"
+        await asyncio.to_thread(self._exec, sql, vals)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        rows = await asyncio.to_thread(self._exec, f"SELECT {', '.join(self._COLS)} FROM jobs WHERE id = ?", (job_id,))
+        return self._row(rows[0]) if rows else None
+
+    async def update(self, job_id: str, **fields) -> None:
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        vals = tuple(self._encode(k, v) for k, v in fields.items()) + (job_id,)
+        await asyncio.to_thread(self._exec, f"UPDATE jobs SET {sets} WHERE id = ?", vals)
+
+    def _claim(self, job_id: str, owner: str, lease_until: float) -> bool:
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ? WHERE id = ? AND "
+                "(status = 'queued' OR (status = 'running' AND COALESCE(lease_until, 0) < ?))",
+                (owner, lease_until, job_id, time.time()),
+            ).rowcount == 1
+
+    async def claim(self, job_id: str, owner: str, lease_until: float) -> bool:
+        return await asyncio.to_thread(self._claim, job_id, owner, lease_until)
+
+    async def renew(self, job_id: str, owner: str, lease_until: float) -> None:
+        await asyncio.to_thread(self._exec, "UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ?",
+                                (lease_until, job_id, owner))
+
+    async def unfinished(self) -> list[dict]:
+        # Queued, or running on a lease that has run out
+        rows = await asyncio.to_thread(
+            self._exec,
+            f"SELECT {', '.join(self._COLS)} FROM jobs WHERE status = 'queued' OR "
+            "(status = 'running' AND COALESCE(lease_until, 0) < ?) ORDER BY created_at",
+            (time.time(),),
+        )
+        return [self._row(r) for r in rows]
+
+    def _purge(self, finished_before: float) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (finished_before,)).rowcount
+
+    async def purge(self, finished_before: float) -> int:
+        return await asyncio.to_thread(self._purge, finished_before)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class JobRunner:
+    # max_bytes caps the image bytes of jobs waiting in this process (0 = no cap), next
+    # to max_queue: a queue of large uploads fills memory long before the count limit
+    def __init__(self, store, handler, workers: int = 4, max_queue: int = 1000,
+                 ttl_sec: float = 86400, callback_retries: int = 3, max_bytes: int = 0,
+                 lease_sec: float = 300):
+        self.store = store
+        self.handler = handler            # async (job dict) -> result dict; raises on failure
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.lease_sec = lease_sec
+        self.ttl_sec = ttl_sec
+        self.callback_retries = callback_retries
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: dict[str, int] = {}  # queued here: job id -> image bytes
+        self._tasks: list[asyncio.Task] = []
+        self._http: Optional[httpx.AsyncClient] = None
+        self._wait: deque[float] = deque(maxlen=500)
+        self._run: deque[float] = deque(maxlen=500)
+        self.counts = {"submitted": 0, "succeeded": 0, "failed": 0, "recovered": 0, "claim_lost": 0}
+
+    async def start(self) -> None:
+        self._http = httpx.AsyncClient(timeout=10)
+        await self._recover()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._janitor()))
+        self._tasks.append(asyncio.ensure_future(self._reclaimer()))
+
+    def _enqueue(self, job_id: str, size: int) -> None:
+        if job_id not in self._pending:
+            self._pending[job_id] = size
+            self._queue.put_nowait(job_id)
+
+    async def _recover(self) -> None:
+        # Jobs nobody holds a live lease on; claim() settles which process runs each
+        for job in await self.store.unfinished():
+            if job["id"] not in self._pending:
+                self._enqueue(job["id"], len(job.get("image") or b""))
+                self.counts["recovered"] += 1
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+        self.store.close()
+
+    def full(self, size: int = 0) -> bool:
+        # Would a job with `size` image bytes go over the count or byte budget?
+        if self._queue.qsize() >= self.max_queue:
+            return True
+        return self.max_bytes > 0 and sum(self._pending.values()) + size > self.max_bytes
+
+    async def submit(self, image: bytes, knobs: dict, strategy: str, callback_url: Optional[str] = None) -> dict:
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "strategy": strategy,
+            "knobs": knobs,
+            "callback_url": callback_url,
+            "callback_status": None,
+            "result": None,
+            "error": None,
+            "image": image,
+            "owner": None,
+            "lease_until": None,
+        }
+        await self.store.put(job)
+        self._enqueue(job["id"], len(image))
+        self.counts["submitted"] += 1
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._process(job_id)
+            except Exception as e:
+                print("Job worker error:", repr(e))
+            finally:
+                self._pending.pop(job_id, None)
+                self._queue.task_done()
+
+    async def _process(self, job_id: str) -> None:
+        if not await self.store.claim(job_id, self.owner, time.time() + self.lease_sec):
+            self.counts["claim_lost"] += 1  # finished, or running in another process
+            return
+        job = await self.store.get(job_id)
+        if job is None:
+            return
+        started = time.time()
+        self._wait.append(started - job["created_at"])
+        await self.store.update(job_id, started_at=started)
+        heartbeat = asyncio.ensure_future(self._renew(job_id))
+        try:
+            result = await self.handler(job)
+            fields = {"status": "succeeded", "result": result}
+        except Exception as e:
+            fields = {"status": "failed", "error": {
+                "status": getattr(e, "status_code", 502),
+                "detail": str(getattr(e, "detail", "") or "Analyzer crashed unexpectedly"),
+            }}
+        finally:
+            heartbeat.cancel()
+        finished = time.time()
+        self._run.append(finished - started)
+        self.counts[fields["status"]] += 1
+        # Drop the image once finished; results are small
+        await self.store.update(job_id, finished_at=finished, image=None, **fields)
+        if job.get("callback_url"):
+            job.update(fields)
+            await self.store.update(job_id, callback_status=await self._deliver(job))
+
+    async def _deliver(self, job: dict) -> str:
+        body = {"id": job["id"], "status": job["status"], "result": job.get("result"), "error": job.get("error")}
+        for attempt in range(self.callback_retries):
+            try:
+                r = await self._http.post(job["callback_url"], json=body)
+                if r.status_code < 300:
+                    return "delivered"
+                print("Job callback error", r.status_code)
+            except httpx.HTTPError as e:
+                print("Job callback network error:", e)
+            await asyncio.sleep(2 ** attempt)
+        return "failed"
+
+    async def _renew(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_sec / 3)
+            try:
+                await self.store.renew(job_id, self.owner, time.time() + self.lease_sec)
+            except Exception as e:
+                print("Job lease renew error:", repr(e))
+
+    async def _reclaimer(self) -> None:
+        # Picks up jobs left by a process that died (lease ran out) or queued by one that stopped
+        while True:
+            await asyncio.sleep(self.lease_sec)
+            try:
+                await self._recover()
+            except Exception as e:
+                print("Job recover error:", repr(e))
+
+    async def _janitor(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.ttl_sec, 600))
+            try:
+                await self.store.purge(time.time() - self.ttl_sec)
+            except Exception as e:
+                print("Job purge error:", repr(e))
+
+    @staticmethod
+    def _pct(xs, q: float) -> Optional[float]:
+        if not xs:
+            return None
+        s = sorted(xs)
+        return round(s[min(len(s) - 1, int(len(s) * q))], 3)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_bytes": sum(self._pending.values()),
+            "workers": self.workers,
+            **self.counts,
+            "wait_p50_sec": self._pct(self._wait, 0.5),
+            "wait_p95_sec": self._pct(self._wait, 0.95),
+            "run_p50_sec": self._pct(self._run, 0.5),
+            "run_p95_sec": self._pct(self._run, 0.95),
+        }
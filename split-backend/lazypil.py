@@ -0,0 +1,14 @@
+# Pillow, imported on first use rather than with the modules that use it (gate.py,
+# imageprep.py): it is the slowest import on the startup path. PIL_AVAILABLE says
+# whether it is installed; callers skip their image work without it.
+import importlib.util
+
+PIL_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+
+def load_pil():
+    # The PIL package with Image, ImageFilter, ImageOps and ImageStat imported, or None
+    if not PIL_AVAILABLE:
+        return None
+    import PIL.Image, PIL.ImageFilter, PIL.ImageOps, PIL.ImageStat
+    return PIL
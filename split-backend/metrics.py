@@ -0,0 +1,152 @@
+# Minimal Prometheus-style metrics (text exposition format 0.0.4) plus per-request
+# Server-Timing collection. Hot-path cost is a dict lookup and a few float adds.
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+import bisect, time
+
+# Stage timings for the current request: list of (stage, seconds). Tasks spawned by
+# the request (engine paths) share the list through the copied context.
+SERVER_TIMING: ContextVar[Optional[list]] = ContextVar("server_timing", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 90, 120)
+BYTES_BUCKETS = (16e3, 64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+TOKEN_BUCKETS = (100, 200, 400, 800, 1600, 3200, 6400, 12800)
+
+
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(labels.get(n, "") for n in self.labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in self._values.items():
+            out.append(f"{self.name}{_labels(self.labels, key)} {v}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(n, "") for n in self.labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * (len(self.buckets) + 2)
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in self._values.items():
+            acc = 0
+            for b, n in zip(self.buckets, row):
+                acc += n
+                le = 'le="%g"' % b
+                out.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {acc}")
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {row[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labels, key)} {round(row[-2], 6)}")
+            out.append(f"{self.name}_count{_labels(self.labels, key)} {row[-1]}")
+        return out
+
+
+class Gauge:
+    # Value read at scrape time; fn returns a number or {label value: number}
+    def __init__(self, name: str, help: str, fn: Callable, label: str = ""):
+        self.name, self.help, self.fn, self.label = name, help, fn, label
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            v = self.fn()
+        except Exception:
+            return out
+        if isinstance(v, dict):
+            for k, x in v.items():
+                if isinstance(x, (int, float)):
+                    out.append(f"{self.name}{_labels((self.label,), (k,))} {x}")
+        elif isinstance(v, (int, float)):
+            out.append(f"{self.name} {v}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, *a, **k) -> Counter:
+        m = Counter(*a, **k)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, *a, **k) -> Histogram:
+        m = Histogram(*a, **k)
+        self._metrics.append(m)
+        return m
+
+    def gauge(self, *a, **k) -> Gauge:
+        m = Gauge(*a, **k)
+        self._metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "splitchamp_stage_seconds", "Time spent per pipeline stage", ("stage",))
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    st = SERVER_TIMING.get()
+    if st is not None:
+        st.append((stage, seconds))
+
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - t0)
+
+
+def server_timing_header(entries: list, total: Optional[float] = None) -> str:
+    # Repeated stages (DI polls) are summed and annotated with their count
+    agg: dict[str, list] = {}
+    for name, secs in entries:
+        a = agg.setdefault(name, [0.0, 0])
+        a[0] += secs
+        a[1] += 1
+    parts = [f'{n};dur={d * 1000:.1f}' + (f';desc="x{c}"' if c > 1 else "") for n, (d, c) in agg.items()]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
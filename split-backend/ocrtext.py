@@ -0,0 +1,97 @@
+# OCR text compaction before the GPT text pass.
+#
+# Azure Read returns every line on the receipt: addresses, phone numbers, cashier
+# names, loyalty blurbs, survey links, card/approval lines and repeated "thank you"
+# footers. Itemization only needs the lines with a price, their immediate neighbours
+# (Read often splits a description and its price into two lines), a few header lines
+# (merchant) and dates. compact() keeps those, collapses whitespace and drops repeated
+# non-price lines. Over a token budget it gives up lines by value (_drop_order): never
+# the head lines or the subtotal/tax/tip/total lines reconciliation checks against;
+# first the context lines without a price nearest the middle, then priced lines below
+# the totals (payment, change), then item lines nearest the middle.
+import re
+
+# Shared with templates.py (PRICE, DATE), gate.py and server.py (PRICE_TOKEN). PRICE is
+# one amount as printed on a line; PRICE_TOKEN is the looser count of price-like tokens
+# the pre-gate and the second-pass heuristic use
+PRICE = re.compile(r"(?<![\d.,])-?\$?\d{1,4}(?:,\d{3})*[.,]\d{2}(?![\d])")
+DATE = re.compile(r"\b(?:\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4})\b")
+PRICE_TOKEN = re.compile(r"\$?\d{1,3}(?:[,\d]{0,3})?\.\d{2}")
+_WS = re.compile(r"\s+")
+_TOTALS = re.compile(r"\b(?:sub\s*-?\s*total|total|tax(?:es)?|tip|gratuity|service charge|balance due|amount due"
+                     r"|hst|gst|pst|vat|tps|tvq|tva|iva)(?![^\W\d])", re.I)
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for receipt text (English, digits); only used for budgeting
+    return (len(text) + 3) // 4
+
+
+def _drop_order(lines: list[str], priced: list[bool], head_lines: int) -> list[int]:
+    n = len(lines)
+    fixed = set(range(min(head_lines, n)))
+    totals = [i for i, l in enumerate(lines) if _TOTALS.search(l)]
+    for i in totals:
+        fixed.add(i)
+        if not priced[i] and i + 1 < n and priced[i + 1]:  # Read put the amount under its label
+            fixed.add(i + 1)
+    below = max(totals, default=n)
+    mid = n / 2
+    rest = [i for i in range(n) if i not in fixed]
+    context = sorted((i for i in rest if not priced[i]), key=lambda i: abs(i - mid))
+    footer = sorted((i for i in rest if priced[i] and i > below), reverse=True)
+    items = sorted((i for i in rest if priced[i] and i < below), key=lambda i: abs(i - mid))
+    return context + footer + items
+
+
+def compact(text: str, head_lines: int = 2, context: int = 1, max_tokens: int = 0) -> tuple[str, dict]:
+    lines = [l for l in (_WS.sub(" ", l).strip() for l in text.splitlines()) if l]
+    n = len(lines)
+    priced = [PRICE.search(l) is not None for l in lines]
+    keep = [False] * n
+    for i in range(n):
+        if priced[i]:
+            for j in range(max(0, i - context), min(n, i + context + 1)):
+                keep[j] = True
+        elif i < head_lines or DATE.search(lines[i]):
+            keep[i] = True
+
+    out: list[str] = []
+    out_priced: list[bool] = []
+    seen: set[str] = set()
+    for i in range(n):
+        if not keep[i]:
+            continue
+        if not priced[i]:
+            key = lines[i].casefold()
+            if key in seen:
+                continue
+            seen.add(key)
+        out.append(lines[i])
+        out_priced.append(priced[i])
+
+    dropped = dropped_priced = 0
+    if max_tokens > 0:
+        chars = sum(len(l) + 1 for l in out)
+        gone = set()
+        for i in _drop_order(out, out_priced, head_lines):
+            if (chars + 3) // 4 <= max_tokens:
+                break
+            gone.add(i)
+            chars -= len(out[i]) + 1
+            dropped_priced += out_priced[i]
+        dropped = len(gone)
+        out = [l for i, l in enumerate(out) if i not in gone]
+
+    result = "\n".join(out)
+    return result, {
+        "lines_in": n,
+        "lines_out": len(out),
+        "chars_in": len(text),
+        "chars_out": len(result),
+        "est_tokens_in": estimate_tokens(text),
+        "est_tokens_out": estimate_tokens(result),
+        "truncated": dropped > 0,
+        "dropped_lines": dropped,
+        "dropped_price_lines": dropped_priced,  # items (or payment lines) the model never sees
+    }
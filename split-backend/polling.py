@@ -0,0 +1,74 @@
+# Adaptive polling policy for long-running Azure operations (operation-location).
+#
+# - First poll waits roughly the median observed completion time (auto-tuned),
+#   later polls back off exponentially from a short base delay.
+# - Retry-After from the service is honoured as a lower bound.
+# - A hard deadline caps the total time spent polling.
+from collections import deque
+from typing import Optional
+import statistics
+
+
+def retry_after_sec(headers) -> Optional[float]:
+    v = headers.get("retry-after") if headers is not None else None
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        return None  # HTTP-date form; Azure sends seconds
+
+
+class AdaptivePoller:
+    def __init__(
+        self,
+        first_delay: float = 0.5,
+        max_delay: float = 4.0,
+        backoff: float = 1.5,
+        deadline: float = 30.0,
+        window: int = 200,
+        min_samples: int = 5,
+    ):
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.deadline = deadline
+        self.min_samples = min_samples
+        self._done: deque[float] = deque(maxlen=window)   # seconds from submit to the poll that saw completion
+        self._polls: deque[int] = deque(maxlen=window)
+        self.timeouts = 0
+
+    def initial_delay(self) -> float:
+        if len(self._done) < self.min_samples:
+            return self.first_delay
+        # Slightly under the median so fast operations are not overshot
+        return min(self.max_delay * 2, max(self.first_delay, statistics.median(self._done) * 0.9))
+
+    def next_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # attempt 0 is the wait before the first poll
+        if attempt == 0:
+            delay = self.initial_delay()
+        else:
+            delay = min(self.max_delay, self.first_delay * (self.backoff ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def record(self, elapsed: float, polls: int) -> None:
+        self._done.append(elapsed)
+        self._polls.append(polls)
+
+    def record_timeout(self) -> None:
+        self.timeouts += 1
+
+    def stats(self) -> dict:
+        done = sorted(self._done)
+        n = len(done)
+        return {
+            "samples": n,
+            "p50_sec": round(done[n // 2], 2) if n else None,
+            "p90_sec": round(done[min(n - 1, int(n * 0.9))], 2) if n else None,
+            "avg_polls": round(sum(self._polls) / len(self._polls), 2) if self._polls else None,
+            "initial_delay_sec": round(self.initial_delay(), 2),
+            "timeouts": self.timeouts,
+        }
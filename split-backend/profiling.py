@@ -0,0 +1,175 @@
+# Sampling profiler for single requests, saved as collapsed stacks ("frame;frame;frame
+# weight" per line, the format flamegraph.pl, inferno and speedscope read).
+#
+# A daemon thread samples every thread's Python stack (sys._current_frames) every
+# interval_sec and weights each stack by the microseconds since the previous sample,
+# so the profile covers awaits as well as CPU. The event loop sitting in select() is
+# recorded as one frame, "[await I/O]": with a single request in flight that is the
+# time spent blocked on upstream calls. Idle pool threads are left out. Samples cover
+# the whole process, so requests running alongside show up too: profile on a quiet
+# worker for a clean picture. One profile runs at a time, for at most max_sec (so a
+# profile whose request never finishes does not block later ones).
+#
+# summary() splits the sampled time by the frames each stack contains (BUCKETS, in
+# order), into io_wait for the idle loop, and other for the remaining CPU.
+from typing import Optional
+import itertools, json, os, sys, threading, time
+
+BUCKETS = (
+    ("postprocess", ("server:_postprocess_receipt",)),
+    ("base64", ("base64:", "binascii:", "upload:decode_b64", "upload:b64_body")),
+    ("pydantic", ("pydantic", "fastapi._compat:", "fastapi.routing:serialize_response",
+                  "fastapi.encoders:jsonable_encoder")),
+)
+IDLE = "[await I/O]"
+
+_ACTIVE = threading.Lock()
+
+
+def _label(frame) -> str:
+    mod = frame.f_globals.get("__name__", "?")
+    return f"{mod}:{frame.f_code.co_qualname}".replace(";", ":").replace(" ", "_")
+
+
+def _stack(frame) -> Optional[str]:
+    # Root-first frame labels; IDLE for the event loop in select(), None for a blocked
+    # pool thread
+    code = frame.f_code
+    if code.co_filename.endswith("selectors.py") and code.co_name == "select":
+        return IDLE
+    if code.co_filename.endswith(("threading.py", "queue.py")) or \
+            (code.co_filename.endswith("thread.py") and code.co_name == "_worker"):
+        return None
+    out = []
+    while frame is not None:
+        out.append(_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(out))
+
+
+class Profile:
+    def __init__(self, interval_sec: float = 0.002, max_sec: float = 120.0):
+        self.interval = interval_sec
+        self.max_sec = max_sec
+        self.stacks: dict[str, int] = {}  # thread;frames -> microseconds
+        self.samples = 0
+        self.wall_sec = 0.0
+        self._t0 = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        # False when another profile is running
+        if not _ACTIVE.acquire(blocking=False):
+            return False
+        self._t0 = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.wall_sec = time.perf_counter() - self._t0
+
+    def _run(self) -> None:
+        try:
+            self._sample()
+        finally:
+            _ACTIVE.release()
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            if now - self._t0 > self.max_sec:
+                return
+            us = round((now - last) * 1e6)
+            last = now
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = _stack(frame)
+                if stack is None:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                key = f"{names.get(ident, ident)};{stack}"
+                self.stacks[key] = self.stacks.get(key, 0) + us
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{k} {v}\n" for k, v in sorted(self.stacks.items()))
+
+    def summary(self) -> dict:
+        buckets = {name: 0 for name, _ in BUCKETS}
+        buckets.update(io_wait=0, other=0)
+        for key, us in self.stacks.items():
+            if key.endswith(IDLE):
+                buckets["io_wait"] += us
+                continue
+            name = next((n for n, marks in BUCKETS if any(m in key for m in marks)), "other")
+            buckets[name] += us
+        return {"wall_ms": round(self.wall_sec * 1000, 1), "samples": self.samples,
+                "interval_ms": self.interval * 1000,
+                "ms": {k: round(v / 1000, 1) for k, v in buckets.items()}}
+
+
+class ProfileStore:
+    # <id>.folded (collapsed stacks) and <id>.json (summary + request meta) per profile;
+    # the oldest are deleted beyond `keep`
+    def __init__(self, path: str, keep: int = 50):
+        self.path = path
+        self.keep = keep
+        self._seq = itertools.count()
+
+    def new_id(self) -> str:
+        return f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._seq)}"
+
+    def save(self, pid: str, prof: Profile, meta: dict) -> None:
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, pid + ".folded"), "w") as f:
+                f.write(prof.folded())
+            with open(os.path.join(self.path, pid + ".json"), "w") as f:
+                json.dump({"id": pid, **meta, **prof.summary()}, f)
+            self._rotate()
+        except OSError as e:
+            print("Profile save error:", e)
+
+    def _rotate(self) -> None:
+        metas = sorted((e for e in os.scandir(self.path) if e.name.endswith(".json")),
+                       key=lambda e: e.stat().st_mtime)
+        for e in metas[:max(0, len(metas) - self.keep)]:
+            for ext in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(self.path, e.name[:-5] + ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> list[dict]:
+        if not os.path.isdir(self.path):
+            return []
+        out = []
+        for e in sorted(os.scandir(self.path), key=lambda e: e.name, reverse=True):
+            if e.name.endswith(".json"):
+                try:
+                    with open(e.path) as f:
+                        out.append(json.load(f))
+                except (OSError, ValueError):
+                    pass
+        return out
+
+    def load(self, pid: str, ext: str) -> Optional[str]:
+        if not pid or os.path.basename(pid) != pid or pid.startswith("."):
+            return None
+        try:
+            with open(os.path.join(self.path, pid + ext)) as f:
+                return f.read()
+        except OSError:
+            return None
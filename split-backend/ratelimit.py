@@ -0,0 +1,153 @@
+# Token-bucket rate limiting with pluggable stores.
+#
+# Each key (client IP) has a bucket of `capacity` tokens refilled at
+# capacity / window_sec per second; a request spends its route cost.
+# Stores:
+#   MemoryStore  per-process, LRU-bounded, idle buckets expire
+#   SQLiteStore  shared file, so limits hold across uvicorn workers on one host
+#   RedisStore   any Redis-protocol server (Redis, Valkey, KeyDB...); needs `redis`
+from collections import OrderedDict
+import asyncio, math, sqlite3, threading, time
+
+
+def _take(tokens: float, ts: float, now: float, capacity: float, rate: float, cost: float) -> tuple[bool, float]:
+    tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+    if tokens >= cost:
+        return True, tokens - cost
+    return False, tokens
+
+
+class MemoryStore:
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple[float, float]]" = OrderedDict()  # key -> (tokens, ts)
+        self._ops = 0
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float, now: float) -> tuple[bool, float]:
+        tokens, ts = self._buckets.pop(key, (capacity, now))
+        ok, tokens = _take(tokens, ts, now, capacity, rate, cost)
+        self._buckets[key] = (tokens, now)
+        self._ops += 1
+        if len(self._buckets) > self.max_keys or self._ops % 1000 == 0:
+            self._sweep(now, capacity / rate if rate > 0 else math.inf)
+        return ok, tokens
+
+    def _sweep(self, now: float, idle_sec: float) -> None:
+        # Oldest first: drop buckets idle long enough to be full again, then enforce the cap
+        while self._buckets:
+            key, (_, ts) = next(iter(self._buckets.items()))
+            if now - ts < idle_sec and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteStore:
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, ts REAL)")
+        self._ops = 0
+
+    def _take_sync(self, key: str, cost: float, capacity: float, rate: float, now: float) -> tuple[bool, float]:
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")  # serializes the read-modify-write across processes
+            try:
+                row = db.execute("SELECT tokens, ts FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens, ts = row if row else (capacity, now)
+                ok, tokens = _take(tokens, ts, now, capacity, rate, cost)
+                db.execute("INSERT OR REPLACE INTO buckets (key, tokens, ts) VALUES (?, ?, ?)", (key, tokens, now))
+                self._ops += 1
+                if self._ops % 1000 == 0 and rate > 0:
+                    db.execute("DELETE FROM buckets WHERE ts < ?", (now - capacity / rate,))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return ok, tokens
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float, now: float) -> tuple[bool, float]:
+        return await asyncio.to_thread(self._take_sync, key, cost, capacity, rate, now)
+
+    def size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class RedisStore:
+    # Atomic token bucket as a server-side script; keys expire once the bucket would be full
+    _SCRIPT = """
+local cap = tonumber(ARGV[1]); local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3]); local cost = tonumber(ARGV[4]); local ttl = tonumber(ARGV[5])
+local v = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(v[1]) or cap
+local ts = tonumber(v[2]) or now
+tokens = math.min(cap, tokens + math.max(0, now - ts) * rate)
+local ok = 0
+if tokens >= cost then tokens = tokens - cost; ok = 1 end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ttl)
+return {ok, tostring(tokens)}
+"""
+
+    def __init__(self, url: str, prefix: str = "splitchamp:rl:"):
+        try:
+            import redis.asyncio as aioredis  # optional dependency
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the 'redis' package (pip install redis)")
+        self._r = aioredis.from_url(url)
+        self._script = self._r.register_script(self._SCRIPT)
+        self.prefix = prefix
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float, now: float) -> tuple[bool, float]:
+        ttl = max(1, math.ceil(capacity / rate)) if rate > 0 else 86400
+        ok, tokens = await self._script(keys=[self.prefix + key], args=[capacity, rate, now, cost, ttl])
+        return bool(int(ok)), float(tokens)
+
+    def size(self) -> int:
+        return -1  # not tracked locally
+
+    def close(self) -> None:
+        pass
+
+
+class RateLimiter:
+    def __init__(self, store, capacity: float, window_sec: float):
+        self.store = store
+        self.capacity = capacity
+        self.window_sec = window_sec
+        self.rate = capacity / window_sec if window_sec > 0 else 0.0
+        self.allowed = 0
+        self.limited = 0
+
+    async def hit(self, key: str, cost: float = 1.0) -> tuple[bool, dict]:
+        # Returns (allowed, RateLimit-* headers)
+        ok, tokens = await self.store.take(key, cost, self.capacity, self.rate, time.time())
+        if ok:
+            self.allowed += 1
+        else:
+            self.limited += 1
+        # Seconds until the bucket is full again / until `cost` tokens are available
+        reset = math.ceil((self.capacity - tokens) / self.rate) if self.rate > 0 else 0
+        headers = {
+            "RateLimit-Limit": str(int(self.capacity)),
+            "RateLimit-Remaining": str(max(0, int(tokens))),
+            "RateLimit-Reset": str(reset),
+        }
+        if not ok:
+            headers["Retry-After"] = str(math.ceil((cost - tokens) / self.rate) if self.rate > 0 else 1)
+        return ok, headers
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": self.limited, "keys": self.store.size()}
@@ -1,58 +1,524 @@
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Body, Form, Query
+from fastapi import FastAPI, HTTPException, Request, Response, UploadFile, File, Form, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from typing import Optional
-import os, requests, json, time, base64, hashlib, re
+from contextlib import asynccontextmanager
+import json, time, hashlib, hmac, itertools, math, asyncio
+import httpx
+
+from admission import Admission, Shed
+from cache import ResultCache, SingleFlight, content_key
+from polling import AdaptivePoller, retry_after_sec
+from imageprep import ImagePrep, PreparedImage, Profile
+from lazypil import PIL_AVAILABLE, load_pil
+from jobs import JobRunner, MemoryJobStore, SQLiteJobStore
+from ratelimit import MemoryStore, RateLimiter, RedisStore, SQLiteStore
+from categorize import Categorizer, normalize
+from breaker import CircuitBreaker, PathLatency
+from gate import PreGate
+from ocrtext import PRICE_TOKEN, compact as compact_ocr
+from templates import TemplateStore
+from settings import ENGINE_STRATEGIES, UPSTREAMS, Settings
+from settle import MODES as SETTLE_MODES, Ledger, LedgerCache
+from upload import BodyLimit, TooLarge, b64_body, b64_len, decode_b64, parse_json, read_body, read_upload
+from urllib.parse import urlparse
+import metrics, profiling
 
 # --- Config / env ---
 load_dotenv()
 
-OPENAI_KEY = os.environ.get("OPENAI_API_KEY")
-if not OPENAI_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not set. Put it in .env or your environment.")
-
-MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")  # vision + JSON mode
-ALLOWED_ORIGINS = os.environ.get("ALLOWED_ORIGINS", "*")
-RATE_LIMIT = int(os.environ.get("RATE_LIMIT", "60"))
-RATE_WINDOW_SEC = int(os.environ.get("RATE_WINDOW_SEC", "3600"))
-MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))  # 10MB
+# Typed settings (settings.py), read once; the module constants below are views of it,
+# kept so the code (and the benches, which override some) reads them as before.
+# Built at import, not in the lifespan: the middleware, rate limiter, breakers, caches
+# and job runner below are wired from it when the app object is created.
+SETTINGS = Settings.from_env()
+
+OPENAI_KEY = SETTINGS.openai_key
+OPENAI_CONFIGURED = SETTINGS.openai_configured
+if not OPENAI_CONFIGURED:
+    print("OPENAI_API_KEY is not set; GPT engines are off and /readyz needs Azure DI to pass")
+
+MODEL = SETTINGS.openai_model
+OPENAI_BASE_URL = SETTINGS.openai_base_url
+ALLOWED_ORIGINS = SETTINGS.allowed_origins
+RATE_LIMIT = SETTINGS.limits.rate_limit
+RATE_WINDOW_SEC = SETTINGS.limits.window_sec
+MAX_IMAGE_BYTES = SETTINGS.limits.max_image_bytes  # 10MB
+BODY_SLACK_BYTES = SETTINGS.limits.body_slack_bytes  # multipart/JSON framing per image
 
 # When DI/GPT returns only a total but OCR looks rich, force a second parsing pass
-FORCE_SECOND_PASS_MIN_ITEMS = int(os.environ.get("FORCE_SECOND_PASS_MIN_ITEMS", "2"))
-
-def _to_bool(v: Optional[str], default: bool = False) -> bool:
-    if v is None:
-        return default
-    clean = v.strip()
-    if "#" in clean:
-        clean = clean.split("#", 1)[0].strip()
-    s = clean.lower()
-    if s in {"true", "1", "yes", "y", "on"}:  return True
-    if s in {"false", "0", "no", "n", "off"}: return False
-    return default
+FORCE_SECOND_PASS_MIN_ITEMS = SETTINGS.engines.force_second_pass_min_items
+# DI items below this confidence are dropped; at or above DI_MERGE_MIN_CONFIDENCE they are
+# merged into a GPT pass that follows an under-itemized DI result
+DI_MIN_ITEM_CONFIDENCE  = SETTINGS.engines.di_min_item_confidence
+DI_MERGE_MIN_CONFIDENCE = SETTINGS.engines.di_merge_min_confidence
+
+# Engine execution strategy: "sequential" (DI → Read+GPT → vision), "parallel" (DI and Read
+# OCR concurrently) or "hedged" (start the next engine after HEDGE_DELAY_SEC without an answer)
+ENGINE_STRATEGY = SETTINGS.engines.strategy
+HEDGE_DELAY_SEC = SETTINGS.engines.hedge_delay_sec
 
 # Feature toggles
-AZURE_USE_RECEIPT = _to_bool(os.environ.get("AZURE_USE_RECEIPT"), True)
-AZURE_USE_READ    = _to_bool(os.environ.get("AZURE_USE_READ"), True)
-RESTAURANT_INCLUDE_TAX_TIP_ITEMS = _to_bool(os.environ.get("RESTAURANT_INCLUDE_TAX_TIP_ITEMS"), True)
+AZURE_USE_RECEIPT = SETTINGS.azure_use_receipt
+AZURE_USE_READ    = SETTINGS.azure_use_read
+RESTAURANT_INCLUDE_TAX_TIP_ITEMS = SETTINGS.engines.restaurant_include_tax_tip_items
 
 # --- Azure resources ---
-AZURE_DI_ENDPOINT       = (os.environ.get("AZURE_DI_ENDPOINT") or "").rstrip("/")
-AZURE_DI_KEY            = os.environ.get("AZURE_DI_KEY") or ""
-AZURE_VISION_ENDPOINT   = (os.environ.get("AZURE_VISION_ENDPOINT") or "").rstrip("/")
-AZURE_VISION_KEY        = os.environ.get("AZURE_VISION_KEY") or ""
+AZURE_DI_ENDPOINT       = SETTINGS.azure_di_endpoint
+AZURE_DI_KEY            = SETTINGS.azure_di_key
+AZURE_VISION_ENDPOINT   = SETTINGS.azure_vision_endpoint
+AZURE_VISION_KEY        = SETTINGS.azure_vision_key
 
-DI_CONFIGURED     = bool(AZURE_DI_ENDPOINT and AZURE_DI_KEY)
-VISION_CONFIGURED = bool(AZURE_VISION_ENDPOINT and AZURE_VISION_KEY)
+DI_CONFIGURED     = SETTINGS.di_configured
+VISION_CONFIGURED = SETTINGS.vision_configured
 AZURE_CONFIGURED  = DI_CONFIGURED or VISION_CONFIGURED
 
 AZURE_API_VERSION_DOCS_NEW  = "2024-07-31"  # Document Intelligence (new)
 AZURE_API_VERSION_DOCS_OLD  = "2023-07-31"  # Form Recognizer (legacy)
 AZURE_API_VERSION_VISION    = "2024-02-01"  # Vision Image Analysis (Read)
 
-# --- App / CORS ---
-app = FastAPI(title="SplitChamp AI Backend", version="1.4.1")
+# DI operation polling: tuned first delay, exponential backoff, Retry-After, hard deadline
+DI_POLLER = AdaptivePoller(
+    first_delay=SETTINGS.engines.di_poll_first_delay_sec,
+    max_delay=SETTINGS.engines.di_poll_max_delay_sec,
+    backoff=SETTINGS.engines.di_poll_backoff,
+    deadline=SETTINGS.engines.di_poll_deadline_sec,
+)
+
+# --- Result cache (keyed on image bytes + engine/model version) ---
+RESULT_CACHE_ENABLED     = SETTINGS.cache.enabled
+RESULT_CACHE_MAX_ENTRIES = SETTINGS.cache.max_entries
+RESULT_CACHE_MAX_BYTES   = SETTINGS.cache.max_bytes
+RESULT_CACHE_TTL_SEC     = SETTINGS.cache.ttl_sec
+RESULT_CACHE_DB          = SETTINGS.cache.db
+
+# --- Image preprocessing (optional, needs Pillow): per-engine downscale/grayscale/JPEG ---
+IMAGE_PREPROCESS     = SETTINGS.images.preprocess
+IMAGE_PREP_WORKERS   = SETTINGS.images.prep_workers
+IMAGE_JPEG_QUALITY   = SETTINGS.images.jpeg_quality
+IMAGE_GRAYSCALE      = SETTINGS.images.grayscale
+IMAGE_MAX_SIDE_DI     = SETTINGS.images.max_side_di
+IMAGE_MAX_SIDE_VISION = SETTINGS.images.max_side_vision
+IMAGE_MAX_SIDE_OPENAI = SETTINGS.images.max_side_openai  # OpenAI scales to 2048 anyway
+
+IMAGE_PREP = ImagePrep(
+    enabled=IMAGE_PREPROCESS,
+    profiles={
+        "azure_di": Profile(IMAGE_MAX_SIDE_DI, IMAGE_GRAYSCALE, IMAGE_JPEG_QUALITY),
+        "azure_vision": Profile(IMAGE_MAX_SIDE_VISION, IMAGE_GRAYSCALE, IMAGE_JPEG_QUALITY),
+        "openai": Profile(IMAGE_MAX_SIDE_OPENAI, IMAGE_GRAYSCALE, IMAGE_JPEG_QUALITY),
+    },
+    workers=IMAGE_PREP_WORKERS,
+)
+if IMAGE_PREPROCESS and not IMAGE_PREP.enabled:
+    print("IMAGE_PREPROCESS is on but Pillow is not installed; sending original images")
+
+# Tiling (needs Pillow): an image at least IMAGE_TILE_MIN_ASPECT times taller than wide is
+# cut into overlapping full-width bands about IMAGE_TILE_ASPECT x width tall (sharing
+# IMAGE_TILE_OVERLAP of a band, at most IMAGE_TILE_MAX bands). The bands are read
+# concurrently and their items stitched; the usual cascade runs if that falls short.
+IMAGE_TILING          = SETTINGS.images.tiling and PIL_AVAILABLE
+IMAGE_TILE_MIN_ASPECT = SETTINGS.images.tile_min_aspect
+IMAGE_TILE_ASPECT     = SETTINGS.images.tile_aspect
+IMAGE_TILE_OVERLAP    = SETTINGS.images.tile_overlap
+IMAGE_TILE_MAX        = SETTINGS.images.tile_max
+if SETTINGS.images.tiling and not PIL_AVAILABLE:
+    print("IMAGE_TILING is on but Pillow is not installed; tall images are read whole")
+
+# Pre-OCR gate: predict the winning engine path from cheap local image features.
+# shadow = log predictions and accuracy only; route = act on them; off = skip the stage
+PREGATE_MODE = SETTINGS.pregate.mode
+PREGATE = PreGate(
+    mode=PREGATE_MODE,
+    min_side=SETTINGS.pregate.min_side,
+    strip_aspect=SETTINGS.pregate.strip_aspect,
+    blur_var=SETTINGS.pregate.blur_var,
+    min_contrast=SETTINGS.pregate.min_contrast,
+    strict_prices=SETTINGS.pregate.strict_prices,
+    log_path=SETTINGS.pregate.log_path,  # JSON lines: features, prediction, actual engine
+)
+
+# OCR compaction before the GPT text pass: keep price lines, their neighbours, header
+# and date lines; drop repeated footer text; cap the OCR part of the prompt at
+# OCR_TOKEN_BUDGET estimated tokens (0 = no cap). See ocrtext.py.
+OCR_COMPACT         = SETTINGS.ocr.compact
+OCR_HEAD_LINES      = SETTINGS.ocr.head_lines
+OCR_CONTEXT_LINES   = SETTINGS.ocr.context_lines
+OCR_TOKEN_BUDGET    = SETTINGS.ocr.token_budget
+# Completion cap for the GPT text passes (0 = model default)
+GPT_TEXT_MAX_TOKENS = SETTINGS.engines.gpt_text_max_tokens
+
+# Per-merchant layout templates learned from GPT text parses that add up (templates.py).
+# on = a template parse whose items + tax + tip match its total replaces the GPT text
+# pass; shadow = parse and compare with GPT, which still answers; off = skip.
+# TEMPLATES_PATH keeps them across restarts (JSON, written at shutdown).
+TEMPLATES_MODE = SETTINGS.templates.mode
+TEMPLATES = TemplateStore(
+    mode=TEMPLATES_MODE,
+    min_samples=SETTINGS.templates.min_samples,
+    max_merchants=SETTINGS.templates.max_merchants,
+    max_headers=SETTINGS.templates.max_headers,
+    path=SETTINGS.templates.path,
+) if TEMPLATES_MODE != "off" else None
+
+# Bump when parsing/prompts change so stale cached parses are not reused
+PIPELINE_VERSION = "1"
+ENGINE_VERSION = (
+    f"p{PIPELINE_VERSION}|{MODEL}|di:{AZURE_API_VERSION_DOCS_NEW}|vision:{AZURE_API_VERSION_VISION}"
+    f"|receipt:{int(AZURE_USE_RECEIPT and DI_CONFIGURED)}|read:{int(AZURE_USE_READ and VISION_CONFIGURED)}"
+    f"|prep:{int(IMAGE_PREP.enabled)}:{IMAGE_MAX_SIDE_DI}/{IMAGE_MAX_SIDE_VISION}/{IMAGE_MAX_SIDE_OPENAI}"
+    f":{IMAGE_JPEG_QUALITY}:{int(IMAGE_GRAYSCALE)}"
+    f"|ocr:{int(OCR_COMPACT)}:{OCR_HEAD_LINES}/{OCR_CONTEXT_LINES}/{OCR_TOKEN_BUDGET}:{GPT_TEXT_MAX_TOKENS}"
+    f"|tpl:{TEMPLATES_MODE}"
+    f"|tile:{int(IMAGE_TILING)}:{IMAGE_TILE_MIN_ASPECT}/{IMAGE_TILE_ASPECT}/{IMAGE_TILE_OVERLAP}/{IMAGE_TILE_MAX}"
+)
+
+RESULT_CACHE = ResultCache(
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+    ttl_sec=RESULT_CACHE_TTL_SEC,
+    db_path=RESULT_CACHE_DB,
+) if RESULT_CACHE_ENABLED else None
+
+# Concurrent identical uploads share one upstream pipeline
+_INFLIGHT = SingleFlight()
+
+# --- Item categories (keyword dictionary compiled at startup; also served on /categorize) ---
+CATEGORIES_PATH   = SETTINGS.categories.path
+CATEGORIES_LOCALE = SETTINGS.categories.locale
+CATEGORIZE_MAX_ITEMS = SETTINGS.categories.max_items
+CATEGORIZER = Categorizer.load(CATEGORIES_PATH, default_locale=CATEGORIES_LOCALE)
+
+# --- Rate limiting ---
+# Token bucket per client IP: RATE_LIMIT tokens, refilled over RATE_WINDOW_SEC.
+# memory: per process; sqlite: shared file across workers on one host; redis: shared
+# across hosts (needs the `redis` package). RATE_LIMIT=0 disables limiting.
+RATE_LIMIT_BACKEND  = SETTINGS.limits.backend
+RATE_LIMIT_DB       = SETTINGS.limits.db
+RATE_LIMIT_REDIS_URL = SETTINGS.limits.redis_url
+RATE_LIMIT_MAX_KEYS = SETTINGS.limits.max_keys
+
+# Tokens spent per request; unlisted routes cost RATE_COST_DEFAULT. Batches also pay
+# RATE_COST_BATCH_ITEM per image beyond the first. Override with
+# RATE_COSTS="/analyze-receipt=2,/jobs/{job_id}=0"
+RATE_COST_DEFAULT    = SETTINGS.limits.cost_default
+RATE_COST_BATCH_ITEM = SETTINGS.limits.cost_batch_item
+RATE_COSTS = {"/": 0.0, "/health": 0.0, "/livez": 0.0, "/readyz": 0.0, "/metrics": 0.0, "/jobs/{job_id}": 0.1,
+              **SETTINGS.limits.costs}
+
+def _rate_cost(method: str, path: str) -> float:
+    if method == "OPTIONS":
+        return 0.0
+    cost = RATE_COSTS.get(path)
+    if cost is not None:
+        return cost
+    for route, c in RATE_COSTS.items():  # templated routes match on their static prefix
+        if "{" in route and path.startswith(route.split("{", 1)[0]):
+            return c
+    return RATE_COST_DEFAULT
+
+def _rate_store():
+    if RATE_LIMIT_BACKEND == "sqlite":
+        return SQLiteStore(RATE_LIMIT_DB)
+    if RATE_LIMIT_BACKEND == "redis":
+        return RedisStore(RATE_LIMIT_REDIS_URL)
+    return MemoryStore(max_keys=RATE_LIMIT_MAX_KEYS)
+
+RATE_LIMITER = RateLimiter(_rate_store(), RATE_LIMIT, RATE_WINDOW_SEC) if RATE_LIMIT > 0 else None
+
+# --- Upstream HTTP clients (one pooled keep-alive client per upstream) ---
+HTTP_MAX_CONNECTIONS   = SETTINGS.http_max_connections
+HTTP_MAX_KEEPALIVE     = SETTINGS.http_max_keepalive
+HTTP_KEEPALIVE_EXPIRY  = SETTINGS.http_keepalive_expiry
+
+_CLIENTS: dict[str, httpx.AsyncClient] = {}
+
+# Global cap on in-flight calls per upstream (shared by single and batch requests)
+UPSTREAM_CONCURRENCY = SETTINGS.engines.upstream_concurrency
+_UPSTREAM_SEM = {name: asyncio.Semaphore(n) for name, n in UPSTREAM_CONCURRENCY.items()}
+_UPSTREAM_WAITING = {name: 0 for name in UPSTREAMS}
+
+async def _limited(upstream: str, coro):
+    try:
+        _UPSTREAM_WAITING[upstream] += 1
+        try:
+            await _UPSTREAM_SEM[upstream].acquire()
+        finally:
+            _UPSTREAM_WAITING[upstream] -= 1
+        try:
+            return await coro
+        finally:
+            _UPSTREAM_SEM[upstream].release()
+    finally:
+        coro.close()  # no-op once awaited; avoids "never awaited" if cancelled while queued
+
+# Admission control: at most ADMISSION_MAX_ACTIVE pipelines that call upstreams run at
+# once, up to ADMISSION_MAX_QUEUE wait. A request whose estimated queue wait plus a
+# typical run exceeds its budget (X-Deadline-Ms, else ADMISSION_DEFAULT_BUDGET_SEC) gets
+# a 503 with Retry-After right away. Cache hits and coalesced uploads skip the queue.
+# ADMISSION_MAX_ACTIVE=0 disables it.
+ADMISSION_MAX_ACTIVE  = SETTINGS.admission.max_active
+ADMISSION_MAX_QUEUE   = SETTINGS.admission.max_queue
+ADMISSION_MAX_WAIT_SEC = SETTINGS.admission.max_wait_sec
+ADMISSION_SERVICE_SEC = SETTINGS.admission.service_sec  # initial estimate of one run; then EWMA
+ADMISSION_DEFAULT_BUDGET_SEC = SETTINGS.admission.default_budget_sec
+ADMISSION = Admission(
+    max_active=ADMISSION_MAX_ACTIVE,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait_sec=ADMISSION_MAX_WAIT_SEC,
+    service_sec=ADMISSION_SERVICE_SEC,
+) if ADMISSION_MAX_ACTIVE > 0 else None
+# Queue order when pipelines are saturated
+PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_JOB = 0, 1, 2
+
+# Operator endpoints (/admin/*) and on-demand profiling need X-Admin-Token == ADMIN_TOKEN;
+# without ADMIN_TOKEN they are off. An /analyze-receipt call sent with X-Profile: 1 is
+# profiled (profiling.py) and answers with X-Profile-Id; PROFILE_SAMPLE_EVERY=N also
+# profiles every Nth call. Profiles go to PROFILE_DIR, the newest PROFILE_KEEP are kept.
+ADMIN_TOKEN          = SETTINGS.profiling.admin_token
+PROFILE_DIR          = SETTINGS.profiling.dir
+PROFILE_KEEP         = SETTINGS.profiling.keep
+PROFILE_SAMPLE_EVERY = SETTINGS.profiling.sample_every  # 0 = only on request
+PROFILE_INTERVAL_MS  = SETTINGS.profiling.interval_ms
+PROFILES = profiling.ProfileStore(PROFILE_DIR, keep=PROFILE_KEEP)
+_PROFILE_COUNT = itertools.count(1)
+
+# Circuit breaker per upstream: skip an upstream whose recent calls mostly fail (or are
+# slower than BREAKER_SLOW_CALL_SEC), probe it again after BREAKER_OPEN_SEC
+BREAKER_WINDOW_SEC    = SETTINGS.breaker.window_sec
+BREAKER_MIN_CALLS     = SETTINGS.breaker.min_calls
+BREAKER_ERROR_RATE    = SETTINGS.breaker.error_rate
+BREAKER_SLOW_CALL_SEC = SETTINGS.breaker.slow_call_sec
+BREAKER_OPEN_SEC      = SETTINGS.breaker.open_sec
+BREAKERS = {
+    name: CircuitBreaker(name, window_sec=BREAKER_WINDOW_SEC, min_calls=BREAKER_MIN_CALLS,
+                         error_rate=BREAKER_ERROR_RATE, slow_call_sec=BREAKER_SLOW_CALL_SEC,
+                         open_sec=BREAKER_OPEN_SEC)
+    for name in UPSTREAMS
+}
+
+# Engine routing for sequential/hedged runs: "fixed" keeps DI before Read+GPT; "fastest"
+# tries whichever of the two has the lower recent p50 first. gpt_image stays last resort.
+ENGINE_ROUTING = SETTINGS.engines.routing
+ENGINE_LATENCY = PathLatency()
+
+# --- Metrics (served on /metrics; stage timings also go to the Server-Timing header) ---
+UPSTREAM_REQUESTS = metrics.REGISTRY.counter(
+    "splitchamp_upstream_requests_total", "Upstream HTTP calls by status code", ("upstream", "status"))
+UPSTREAM_PAYLOAD_BYTES = metrics.REGISTRY.histogram(
+    "splitchamp_upstream_payload_bytes", "Request body size sent upstream", ("upstream",),
+    buckets=metrics.BYTES_BUCKETS)
+OPENAI_TOKENS = metrics.REGISTRY.counter(
+    "splitchamp_openai_tokens_total", "OpenAI token usage", ("call", "kind"))
+OPENAI_PROMPT_TOKENS = metrics.REGISTRY.histogram(
+    "splitchamp_openai_prompt_tokens", "Prompt tokens per OpenAI call", ("call",),
+    buckets=metrics.TOKEN_BUCKETS)
+OCR_CHARS = metrics.REGISTRY.counter(
+    "splitchamp_ocr_chars_total", "OCR text characters before and after compaction", ("kind",))
+OCR_DROPPED_PRICE_LINES = metrics.REGISTRY.counter(
+    "splitchamp_ocr_dropped_price_lines_total", "Priced OCR lines cut to fit OCR_TOKEN_BUDGET")
+ENGINE_WINS = metrics.REGISTRY.counter(
+    "splitchamp_engine_wins_total", "Pipeline runs by winning engine", ("engine",))
+UPSTREAM_PREWARM = metrics.REGISTRY.counter(
+    "splitchamp_upstream_prewarm_total", "Connection prewarm rounds per upstream", ("upstream", "result"))
+PROFILED = metrics.REGISTRY.counter(
+    "splitchamp_profiles_total", "Profiled requests (requested | sampled | busy: another profile was running)",
+    ("trigger",))
+TILED_RUNS = metrics.REGISTRY.counter(
+    "splitchamp_tiled_total", "Tall images read as bands (ok | short | failed: the whole image went through the cascade)", ("result",))
+TEMPLATE_EVENTS = metrics.REGISTRY.counter(
+    "splitchamp_template_total", "Merchant template lookups (none | hit | shadow_ok | reject | learned | shadow_agree | shadow_disagree)",
+    ("result",))
+TEMPLATE_SAVED_SECONDS = metrics.REGISTRY.counter(
+    "splitchamp_template_saved_seconds_total", "Estimated GPT text time saved by template hits")
+PREGATE_DECISIONS = metrics.REGISTRY.counter(
+    "splitchamp_pregate_decisions_total", "Pre-OCR gate predictions vs winning engine", ("predicted", "actual"))
+CACHE_EVENTS = metrics.REGISTRY.counter(
+    "splitchamp_analyze_cache_total", "Analyze requests by cache outcome", ("result",))
+HTTP_REQUESTS = metrics.REGISTRY.counter(
+    "splitchamp_http_requests_total", "HTTP requests by route and status", ("route", "status"))
+HTTP_SECONDS = metrics.REGISTRY.histogram(
+    "splitchamp_http_request_seconds", "HTTP request latency (time to response headers)", ("route",))
+RATE_LIMITED = metrics.REGISTRY.counter(
+    "splitchamp_rate_limited_total", "Requests rejected by the rate limiter")
+ADMISSION_SHED = metrics.REGISTRY.counter(
+    "splitchamp_admission_shed_total", "Analyze requests rejected by admission control", ("reason",))
+ADMISSION_QUEUE_SECONDS = metrics.REGISTRY.histogram(
+    "splitchamp_admission_queue_seconds", "Time admitted pipelines waited in the admission queue", ("priority",))
+# Read at scrape time, so later-defined subsystems are fine to reference
+metrics.REGISTRY.gauge("splitchamp_cache_entries", "Result cache entries in memory",
+                       lambda: RESULT_CACHE.stats()["entries"] if RESULT_CACHE is not None else 0)
+metrics.REGISTRY.gauge("splitchamp_inflight_pipelines", "Pipelines currently running",
+                       lambda: _INFLIGHT.stats()["active"])
+metrics.REGISTRY.gauge("splitchamp_jobs_queue_depth", "Jobs waiting for a worker",
+                       lambda: JOB_RUNNER.stats()["queue_depth"])
+metrics.REGISTRY.gauge("splitchamp_breaker_state", "Upstream circuit breaker (0 closed, 1 half-open, 2 open)",
+                       lambda: {n: ("closed", "half_open", "open").index(b.state) for n, b in BREAKERS.items()},
+                       label="upstream")
+metrics.REGISTRY.gauge("splitchamp_admission_active", "Pipelines holding an admission slot",
+                       lambda: ADMISSION.active if ADMISSION is not None else 0)
+metrics.REGISTRY.gauge("splitchamp_admission_queue_depth", "Requests waiting for an admission slot",
+                       lambda: ADMISSION.waiting if ADMISSION is not None else 0)
+metrics.REGISTRY.gauge("splitchamp_admission_estimated_wait_seconds", "Estimated admission wait for a new request",
+                       lambda: ADMISSION.estimate_wait() if ADMISSION is not None else 0)
+metrics.REGISTRY.gauge("splitchamp_upstream_waiting", "Calls waiting for an upstream concurrency slot",
+                       lambda: dict(_UPSTREAM_WAITING), label="upstream")
+metrics.REGISTRY.gauge("splitchamp_templates", "Merchants with a learned template",
+                       lambda: TEMPLATES.size() if TEMPLATES is not None else 0)
+metrics.REGISTRY.gauge("splitchamp_rate_limit_keys", "Client buckets held by the rate limiter",
+                       lambda: RATE_LIMITER.store.size() if RATE_LIMITER is not None else 0)
+
+async def _upstream(upstream: str, stage: str, method: str, url: str, **kw) -> httpx.Response:
+    # One upstream HTTP call: pooled client, status/error counter, payload size, stage timing
+    body = kw.get("content")
+    if body is not None:
+        size = len(body) if isinstance(body, (bytes, str)) else int(kw["headers"]["Content-Length"])
+        UPSTREAM_PAYLOAD_BYTES.observe(size, upstream=upstream)
+    t0 = time.perf_counter()
+    try:
+        r = await _client(upstream).request(method, url, **kw)
+    except httpx.HTTPError:
+        UPSTREAM_REQUESTS.inc(upstream=upstream, status="error")
+        BREAKERS[upstream].record(False, time.perf_counter() - t0)
+        raise
+    finally:
+        metrics.record_stage(stage, time.perf_counter() - t0)
+    UPSTREAM_REQUESTS.inc(upstream=upstream, status=str(r.status_code))
+    BREAKERS[upstream].record(r.status_code < 500 and r.status_code != 429, time.perf_counter() - t0)
+    return r
+
+def _record_usage(call: str, usage: Optional[dict], out: Optional[dict] = None) -> None:
+    if isinstance(usage, dict):
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if isinstance(usage.get(kind), (int, float)):
+                OPENAI_TOKENS.inc(usage[kind], call=call, kind=kind.split("_")[0])
+                if out is not None:
+                    out[kind] = usage[kind]
+        if isinstance(usage.get("prompt_tokens"), (int, float)):
+            OPENAI_PROMPT_TOKENS.observe(usage["prompt_tokens"], call=call)
+
+def _client(name: str) -> httpx.AsyncClient:
+    # Created at startup; lazily (re)created if used outside the app lifespan.
+    c = _CLIENTS.get(name)
+    if c is None or c.is_closed:
+        c = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+        _CLIENTS[name] = c
+    return c
+
+async def _close_clients() -> None:
+    clients = list(_CLIENTS.values())
+    _CLIENTS.clear()
+    for c in clients:
+        await c.aclose()
+
+# --- Startup: prewarming and readiness ---
+# Each configured upstream gets UPSTREAM_PREWARM_CONNECTIONS concurrent HEAD requests to
+# its base URL, so the TCP + TLS handshakes happen before the first receipt and the
+# connections sit in the keep-alive pool; repeated every UPSTREAM_PREWARM_INTERVAL_SEC
+# (keep it under HTTP_KEEPALIVE_EXPIRY and the upstreams' idle timeouts) so they stay
+# open while traffic is quiet. Any HTTP answer counts, 404 included. Pillow is imported
+# in the first round too. /readyz passes once that round is done (or
+# UPSTREAM_PREWARM_TIMEOUT_SEC has passed) and some engine is configured.
+_WARM: dict[str, dict] = {}  # upstream -> {ok, ms, at}
+_STARTUP = {"started": time.time(), "ready_at": None}
+_READY = asyncio.Event()
+
+async def _warm_upstream(name: str, url: str) -> None:
+    t0 = time.perf_counter()
+    res = await asyncio.gather(*(_client(name).head(url, timeout=SETTINGS.prewarm_timeout_sec)
+                                 for _ in range(SETTINGS.prewarm_connections)), return_exceptions=True)
+    ok = any(isinstance(r, httpx.Response) for r in res)
+    UPSTREAM_PREWARM.inc(upstream=name, result="ok" if ok else "error")
+    if not ok:
+        print(f"Prewarm {name} failed:", repr(res[0]))
+    _WARM[name] = {"ok": ok, "ms": round((time.perf_counter() - t0) * 1000), "at": round(time.time())}
+
+async def _warm_round() -> None:
+    urls = SETTINGS.upstream_urls() if SETTINGS.prewarm_connections > 0 else {}
+    await asyncio.gather(*(_warm_upstream(n, u) for n, u in urls.items()))
+
+async def _keep_warm() -> None:
+    first = asyncio.gather(_warm_round(), asyncio.to_thread(load_pil))
+    try:
+        await asyncio.wait_for(asyncio.shield(first), SETTINGS.prewarm_timeout_sec)
+    except asyncio.TimeoutError:
+        print("Prewarm still running after", SETTINGS.prewarm_timeout_sec, "s; reporting ready")
+    _STARTUP["ready_at"] = time.time()
+    _READY.set()
+    await first
+    while SETTINGS.prewarm_interval_sec > 0:
+        await asyncio.sleep(SETTINGS.prewarm_interval_sec)
+        await _warm_round()
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    for name in UPSTREAMS:
+        _client(name)
+    await JOB_RUNNER.start()
+    warmer = asyncio.create_task(_keep_warm())
+    try:
+        yield
+    finally:
+        warmer.cancel()
+        await JOB_RUNNER.stop()
+        await _close_clients()
+        if RESULT_CACHE is not None:
+            RESULT_CACHE.close()
+        IMAGE_PREP.close()
+        PREGATE.close()
+        if TEMPLATES is not None:
+            TEMPLATES.close()
+        if RATE_LIMITER is not None:
+            RATE_LIMITER.store.close()
+
+# --- App ---
+app = FastAPI(title="SplitChamp AI Backend", version="1.4.1", lifespan=_lifespan)
+
+# --- Rate limit (token bucket per client IP; cost per route) ---
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    cost = _rate_cost(request.method, request.url.path)
+    if RATE_LIMITER is None or cost <= 0:
+        return await call_next(request)
+    ip = request.client.host if request.client else "unknown"
+    try:
+        ok, headers = await RATE_LIMITER.hit(ip, cost)
+    except Exception as e:  # store unavailable: fail open
+        print("Rate limit store error:", repr(e))
+        return await call_next(request)
+    if not ok:
+        RATE_LIMITED.inc()
+        return JSONResponse({"detail": "Rate limit exceeded"}, status_code=429, headers=headers)
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+# Oversized bodies are refused while streaming (413), before the handler buffers them,
+# with the message the upload handlers use
+_TOO_LARGE = f"Image too large; please send < {MAX_IMAGE_BYTES / (1024 * 1024):g}MB"
+
+def _body_limit(path: str) -> Optional[int]:
+    per_image = b64_len(MAX_IMAGE_BYTES) + BODY_SLACK_BYTES  # base64 JSON is the larger encoding
+    if path in ("/analyze-receipt", "/jobs"):
+        return per_image
+    if path == "/analyze-receipts":
+        return per_image * BATCH_MAX_ITEMS
+    return None
+
+app.add_middleware(BodyLimit, limit_for=_body_limit, detail=_TOO_LARGE)
+
+# CORS is registered after the limiter and body limit so it wraps them and 429/413s carry CORS headers
 origins = [o.strip() for o in ALLOWED_ORIGINS.split(",")] if ALLOWED_ORIGINS else ["*"]
 app.add_middleware(
     CORSMiddleware,
@@ -62,28 +528,107 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Tiny best-effort rate limit (in-memory) ---
-_BUCKET: dict[str, tuple[int, int]] = {}  # ip -> (reset_epoch, count)
-def _rate_check(ip: str) -> None:
-    now = int(time.time())
-    reset, cnt = _BUCKET.get(ip, (now + RATE_WINDOW_SEC, 0))
-    if now > reset:
-        reset, cnt = now + RATE_WINDOW_SEC, 0
-    cnt += 1
-    _BUCKET[ip] = (reset, cnt)
-    if cnt > RATE_LIMIT:
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+# FastAPI's own 422, except that NaN/Infinity inputs (the JSON parser accepts them) are
+# echoed as strings: as floats they cannot be rendered and the 422 became a 500
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    errors = [{**e, "input": str(e["input"])} if isinstance(e.get("input"), float) and not math.isfinite(e["input"])
+              else e for e in exc.errors()]
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
 
 @app.middleware("http")
-async def rate_limit(request: Request, call_next):
-    ip = request.client.host if request.client else "unknown"
-    _rate_check(ip)
-    return await call_next(request)
+async def instrument(request: Request, call_next):
+    timings: list = []
+    token = metrics.SERVER_TIMING.set(timings)
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        metrics.SERVER_TIMING.reset(token)
+        total = time.perf_counter() - t0
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.inc(route=path, status=str(status))
+        HTTP_SECONDS.observe(total, route=path)
+    response.headers["Server-Timing"] = metrics.server_timing_header(timings, total)
+    return response
+
+# --- Profiling (operator only; see ADMIN_TOKEN) ---
+def _is_admin(token: Optional[str]) -> bool:
+    return ADMIN_TOKEN is not None and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+async def _require_admin(token: Optional[str] = Header(default=None, alias="X-Admin-Token")) -> None:
+    if not _is_admin(token):
+        raise HTTPException(status_code=403, detail="Admin token required")
 
-# --- Schemas ---
-class AnalyzeReq(BaseModel):
-    image_base64: str
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    if request.method != "POST" or request.url.path != "/analyze-receipt":
+        return await call_next(request)
+    if request.headers.get("x-profile"):
+        if not _is_admin(request.headers.get("x-admin-token")):
+            return JSONResponse({"detail": "Admin token required"}, status_code=403)
+        trigger = "requested"
+    elif PROFILE_SAMPLE_EVERY > 0 and next(_PROFILE_COUNT) % PROFILE_SAMPLE_EVERY == 0:
+        trigger = "sampled"
+    else:
+        return await call_next(request)
+    prof = profiling.Profile(PROFILE_INTERVAL_MS / 1000)
+    if not prof.start():
+        PROFILED.inc(trigger="busy")
+        response = await call_next(request)
+        if trigger == "requested":
+            response.headers["X-Profile-Id"] = "busy"
+        return response
+    PROFILED.inc(trigger=trigger)
+    pid = PROFILES.new_id()
+    try:
+        response = await call_next(request)
+    except BaseException:
+        prof.stop()
+        raise
+    body = response.body_iterator
 
+    async def profiled_body():
+        # The profile ends once the body is sent (streams included), then is written out
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            prof.stop()
+            meta = {"trigger": trigger, "path": request.url.path, "status": response.status_code,
+                    "cache": response.headers.get("x-cache"),
+                    "server_timing": response.headers.get("server-timing")}
+            await asyncio.to_thread(PROFILES.save, pid, prof, meta)
+
+    response.body_iterator = profiled_body()
+    if trigger == "requested":
+        response.headers["X-Profile-Id"] = pid
+    return response
+
+@app.get("/admin/profiles", dependencies=[Depends(_require_admin)])
+def list_profiles():
+    return {"dir": PROFILES.path, "profiles": PROFILES.list()}
+
+@app.get("/admin/profiles/{pid}", dependencies=[Depends(_require_admin)])
+def get_profile(pid: str, format: str = Query(default="folded")):
+    # folded: collapsed stacks for flamegraph.pl / speedscope; json: time split and request meta
+    if format not in ("folded", "json"):
+        raise HTTPException(status_code=400, detail="format must be 'folded' or 'json'")
+    out = PROFILES.load(pid, "." + format)
+    if out is None:
+        raise HTTPException(status_code=404, detail="Unknown profile id")
+    if format == "json":
+        return JSONResponse(json.loads(out))
+    return PlainTextResponse(out, headers={"Content-Disposition": f'attachment; filename="{pid}.folded"'})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+# --- Schemas ---
 class ReceiptItem(BaseModel):
     id: Optional[str] = None
     description: str
@@ -99,6 +644,27 @@ class AnalyzeResp(BaseModel):
     tip: Optional[float] = None
     items: list[ReceiptItem]
     engine: Optional[str] = None
+    engine_meta: Optional[dict] = None  # {strategy, timings_ms: {stage: ms}, cancelled: [stage]}
+
+class BatchItemResult(BaseModel):
+    index: int
+    ok: bool
+    result: Optional[AnalyzeResp] = None
+    status: Optional[int] = None  # HTTP-style status for failed items
+    error: Optional[str] = None
+
+class AnalyzeBatchResp(BaseModel):
+    results: list[BatchItemResult]
+    errors: int
+
+class CategorizeReq(BaseModel):
+    descriptions: list[str]
+    locale: Optional[str] = None
+
+class CategorizeResp(BaseModel):
+    categories: list[str]
+    locale: str
+    version: str
 
 # --- Healthcheck ---
 @app.get("/health")
@@ -119,6 +685,37 @@ def health():
         "azure_configured": AZURE_CONFIGURED,
         "azure_on": (AZURE_USE_RECEIPT and DI_CONFIGURED) or (AZURE_USE_READ and VISION_CONFIGURED),
         "azure_reason": None if not reasons else reasons,
+        "cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+        "inflight": _INFLIGHT.stats(),
+        "di_polling": DI_POLLER.stats(),
+        "jobs": JOB_RUNNER.stats(),
+        "breakers": {name: b.stats() for name, b in BREAKERS.items()},
+        "engine_latency": ENGINE_LATENCY.stats(),
+        "pregate": PREGATE.stats(),
+        "templates": TEMPLATES.stats() if TEMPLATES is not None else None,
+        "rate_limit": RATE_LIMITER.stats() if RATE_LIMITER is not None else None,
+        "admission": ADMISSION.stats() if ADMISSION is not None else None,
+        "upstream_waiting": dict(_UPSTREAM_WAITING),
+    }
+
+# Liveness: the process serves requests. Readiness: startup warmed the upstream pools
+# and at least one engine can run (GPT, or Azure DI without it)
+@app.get("/livez")
+def livez():
+    return {"ok": True}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    engines = OPENAI_CONFIGURED or (AZURE_USE_RECEIPT and DI_CONFIGURED)
+    ready = _READY.is_set() and engines
+    if not ready:
+        response.status_code = 503
+    return {
+        "ready": ready,
+        "warming": not _READY.is_set(),
+        "startup_sec": round(_STARTUP["ready_at"] - _STARTUP["started"], 3) if _STARTUP["ready_at"] else None,
+        "upstreams": _WARM,
+        "problems": SETTINGS.problems(),
     }
 
 @app.get("/")
@@ -126,43 +723,13 @@ def root():
     return {"name": "SplitChamp AI Backend", "version": "1.4.1", "health": "/health"}
 
 # ---- Helpers ----
-def _to_b64_jpeg(raw: bytes) -> str:
-    if len(raw) > MAX_IMAGE_BYTES:
-        raise HTTPException(status_code=413, detail="Image too large; please send < 10MB")
-    return base64.b64encode(raw).decode("utf-8")
-
 def _mk_id(desc: str, amt: float, idx: int) -> str:
     return hashlib.sha1(f"{desc}|{amt}|{idx}".encode("utf-8")).hexdigest()[:12]
 
-_ALC = ["beer","wine","lager","ipa","ale","stout","sauvignon","cabernet","merlot","riesling","pinot",
-        "vodka","tequila","whiskey","bourbon","rum","sake","soju","cocktail","margarita","mojito","martini","negroni"]
-_NONALC = ["soda","coke","pepsi","sprite","fanta","lemonade","juice","coffee","latte","tea","mocktail"]
-_APPS = ["app","appetizer","starter","fries","nachos","wings","edamame","chips","guac","dip","bread","garlic","calamari"]
-_IGNORE = ["subtotal","balance","rounding","change","cash","card","auth","approval","points"]
-
 def _category_of(name: str) -> str:
-    s = (name or "").lower()
-    if not s: return "food"
-    if "tax" in s: return "tax"
-    if "tip" in s or "gratuity" in s or "service charge" in s: return "tip"
-    if any(k in s for k in _IGNORE): return "ignore"
-    if any(k in s for k in _ALC): return "alcohol"
-    if any(k in s for k in _APPS): return "appetizer"
-    # Non-alcoholic drinks count as "food" for splitting
-    return "food"
-
-def _coerce_amounts(parsed: dict) -> dict:
-    if not isinstance(parsed, dict) or "items" not in parsed or not isinstance(parsed["items"], list):
-        raise HTTPException(status_code=502, detail="Response missing items[]")
-    for it in parsed["items"]:
-        try:
-            it["amount"] = float(it.get("amount", 0))
-        except Exception:
-            it["amount"] = 0.0
-    if "subtotal" not in parsed:
-        notax = sum(x.get("amount", 0) for x in parsed["items"] if x.get("category") not in ("tax","tip"))
-        parsed["subtotal"] = round(float(notax), 2)
-    return parsed
+    return CATEGORIZER.category(name)
+
+_SKIP_TOKENS = frozenset({"SUBTOTAL", "CHANGE", "CASH", "CARD", "BALANCE", "AUTH", "TOTAL", "ROUNDING"})
 
 def _postprocess_receipt(
     d: dict,
@@ -173,10 +740,11 @@ def _postprocess_receipt(
     lock_paper_total: bool = False,
 ) -> dict:
     raw_items = d.get("items") or []
-    cleaned: list[dict] = []
 
-    # Basic cleanup and skip junk rows
-    skip_tokens = {"SUBTOTAL", "CHANGE", "CASH", "CARD", "BALANCE", "AUTH", "TOTAL", "ROUNDING"}
+    # Cleanup, skip junk rows and merge duplicates by description (case-insensitive) in one
+    # pass; dict order keeps first-seen order. key -> [amount, category]
+    skip_tokens = _SKIP_TOKENS
+    merged: dict[str, list] = {}
     for it in raw_items:
         try:
             desc = (it.get("description") or "Item").strip()
@@ -186,21 +754,17 @@ def _postprocess_receipt(
             if desc.upper() in skip_tokens:
                 continue
             cat = (it.get("category") or "").strip().lower() or None
-            cleaned.append({"description": desc, "amount": round(amt, 2), "category": cat})
         except Exception:
             continue
-
-    # Merge duplicates by description (case-insensitive)
-    merged: dict[str, dict] = {}
-    order_keys: list[str] = []
-    for it in cleaned:
-        k = it["description"].strip().lower()
-        if k not in merged:
-            order_keys.append(k)
-            merged[k] = {"amount": 0.0, "category": it["category"]}
-        merged[k]["amount"] = round(merged[k]["amount"] + it["amount"], 2)
-        if not merged[k]["category"] and it["category"]:
-            merged[k]["category"] = it["category"]
+        amt = round(amt, 2)
+        k = desc.lower()
+        m = merged.get(k)
+        if m is None:
+            merged[k] = [amt, cat]  # already rounded; round() is idempotent
+        else:
+            m[0] = round(m[0] + amt, 2)
+            if not m[1] and cat:
+                m[1] = cat
 
     # Numbers reported by the model(s)
     tax = round(float(d.get("tax") or 0), 2)
@@ -208,17 +772,20 @@ def _postprocess_receipt(
 
     # Build item list with id + category
     items_out = []
-    for i, k in enumerate(order_keys):
-        amt = merged[k]["amount"]
-        cat = merged[k]["category"] or _category_of(k)
+    counted = []  # amounts that make up the subtotal, in item order
+    sha1 = hashlib.sha1
+    for i, (k, (amt, cat)) in enumerate(merged.items()):
+        cat = cat or _category_of(k)
         items_out.append({
-            "id": _mk_id(k, amt, i),
+            "id": sha1(f"{k}|{amt}|{i}".encode("utf-8")).hexdigest()[:12],  # == _mk_id(k, amt, i)
             "description": k.title(),
             "amount": amt,
             "category": cat
         })
+        if cat not in ("tax", "tip", "ignore"):
+            counted.append(amt)
 
-    sum_items = round(sum(x["amount"] for x in items_out if x["category"] not in ("tax","tip","ignore")), 2)
+    sum_items = round(sum(counted), 2)
 
     # ----- Apply overrides / percent logic (no double tipping) -----
     if tax_amount_override is not None:
@@ -261,8 +828,123 @@ def _postprocess_receipt(
         "items": items_out
     }
 
+# --- Categorize descriptions without a receipt (same rules as analyze) ---
+@app.post("/categorize", response_model=CategorizeResp)
+def categorize(body: CategorizeReq):
+    if len(body.descriptions) > CATEGORIZE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {CATEGORIZE_MAX_ITEMS} descriptions per call")
+    locale = (body.locale or CATEGORIES_LOCALE).strip().lower()
+    if locale not in CATEGORIZER.locales:
+        raise HTTPException(status_code=400, detail=f"locale must be one of {', '.join(CATEGORIZER.locales)}")
+    return {"categories": CATEGORIZER.categorize(body.descriptions, locale), "locale": locale,
+            "version": CATEGORIZER.version}
+
+# --- Settlement: balances in integer cents and who pays whom (same splits as src/lib/split.ts) ---
+# Send the full `expenses` list, or with a `group_id` used before, only `upsert`/`remove`
+# for what changed; ledgers are kept per process (LRU), so a 409 means send everything again.
+SETTLE_MAX_PEOPLE   = SETTINGS.settle.max_people
+SETTLE_MAX_EXPENSES = SETTINGS.settle.max_expenses
+SETTLE_MAX_GROUPS   = SETTINGS.settle.max_groups
+# min_transfers searches exactly up to this many unmatched non-zero balances (O(2^n * n))
+SETTLE_EXACT_MAX    = SETTINGS.settle.exact_max
+_LEDGERS = LedgerCache(SETTLE_MAX_GROUPS)
+
+# Money in /settle is finite and non-negative: JSON NaN/Infinity or a negative amount
+# is a 422, not a 500 in to_cents or a ledger that makes no sense
+class SettleItem(ReceiptItem):
+    amount: float = Field(ge=0, allow_inf_nan=False)
+    splitAmong: list[str] = []  # empty = everyone
+
+class SettleExpense(BaseModel):
+    id: str
+    description: Optional[str] = None
+    amount: float = Field(default=0, ge=0, allow_inf_nan=False)
+    paidBy: str
+    splitAmong: list[str] = []  # empty = everyone
+    splitMethod: Optional[str] = None  # 'even' | 'itemized'
+    items: Optional[list[SettleItem]] = None
+    tax: Optional[float] = Field(default=None, ge=0, allow_inf_nan=False)
+    tip: Optional[float] = Field(default=None, ge=0, allow_inf_nan=False)
+
+class SettleParticipant(BaseModel):
+    id: str
+    name: Optional[str] = None
+
+class SettleReq(BaseModel):
+    participants: list[SettleParticipant]
+    expenses: Optional[list[SettleExpense]] = None
+    upsert: list[SettleExpense] = []
+    remove: list[str] = []
+    group_id: Optional[str] = None
+    mode: str = "greedy"  # greedy | min_transfers
+
+class SettleTransfer(BaseModel):
+    from_: str = Field(alias="from")
+    to: str
+    amount: float
+
+class SettleResp(BaseModel):
+    balances: dict[str, float]  # + is owed money, - owes
+    transfers: list[SettleTransfer]
+    mode: str
+    expenses: int
+    recomputed: int  # expenses whose shares were computed by this call
+    group_id: Optional[str] = None
+
+def _check_expense(e: SettleExpense, known: set) -> None:
+    ids = [e.paidBy, *e.splitAmong, *(p for it in e.items or () for p in it.splitAmong)]
+    unknown = next((p for p in ids if p not in known), None)
+    if unknown is not None:
+        raise HTTPException(status_code=400, detail=f"Expense {e.id}: unknown participant {unknown}")
+
+@app.post("/settle", response_model=SettleResp)
+def settle(body: SettleReq):
+    if body.mode not in SETTLE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SETTLE_MODES)}")
+    everyone = [p.id for p in body.participants]
+    if not 1 <= len(everyone) <= SETTLE_MAX_PEOPLE:
+        raise HTTPException(status_code=400, detail=f"participants must be between 1 and {SETTLE_MAX_PEOPLE}")
+    if len(set(everyone)) != len(everyone):
+        raise HTTPException(status_code=400, detail="Duplicate participant id")
+    if body.expenses is None and not body.group_id:
+        raise HTTPException(status_code=400, detail="expenses is required without group_id")
+    known = set(everyone)
+    for e in (body.expenses or []) + body.upsert:
+        _check_expense(e, known)
+    upserts = [e.model_dump() for e in body.upsert]
+
+    with _LEDGERS.lock:
+        led = _LEDGERS.get(body.group_id) if body.group_id else None
+        if body.expenses is not None or led is None or led.everyone != everyone:
+            if body.expenses is None:
+                raise HTTPException(status_code=409, detail="Unknown group_id or changed participants; send all expenses")
+            full = [e.model_dump() for e in body.expenses]
+            if len(full) + len(upserts) > SETTLE_MAX_EXPENSES:
+                raise HTTPException(status_code=400, detail=f"At most {SETTLE_MAX_EXPENSES} expenses per group")
+            led = Ledger.build(everyone, full)
+            recomputed = len(full)
+        else:
+            if len(led.expenses) + len(upserts) > SETTLE_MAX_EXPENSES:
+                raise HTTPException(status_code=400, detail=f"At most {SETTLE_MAX_EXPENSES} expenses per group")
+            recomputed = 0
+        for e in upserts:
+            led.upsert(e)
+        for expense_id in body.remove:
+            led.remove(expense_id)
+        recomputed += len(upserts)
+        transfers = led.transfers(body.mode, SETTLE_EXACT_MAX)
+        balances = {pid: c / 100 for pid, c in led.balance.items()}
+        n = len(led.expenses)
+        if body.group_id:
+            _LEDGERS.put(body.group_id, led)
+    return {"balances": balances, "mode": body.mode, "expenses": n, "recomputed": recomputed,
+            "group_id": body.group_id,
+            "transfers": [{"from": a, "to": b, "amount": c / 100} for a, b, c in transfers]}
+
 # ---------- Azure helpers ----------
-def _azure_analyze_receipt(image_bytes: bytes) -> Optional[dict]:
+async def _azure_analyze_receipt(
+    image_bytes: bytes, report: Optional[dict] = None, progress=None,
+) -> Optional[dict]:
     if not (AZURE_USE_RECEIPT and DI_CONFIGURED):
         return None
 
@@ -270,9 +952,10 @@ def _azure_analyze_receipt(image_bytes: bytes) -> Optional[dict]:
 
     # Try the new DI route first
     url_new = f"{AZURE_DI_ENDPOINT}/documentintelligence/documentModels/prebuilt-receipt:analyze?api-version={AZURE_API_VERSION_DOCS_NEW}"
+    t_up = time.perf_counter()
     try:
-        r = requests.post(url_new, headers=headers, data=image_bytes, timeout=60)
-    except requests.RequestException as e:
+        r = await _upstream("azure_di", "di_submit", "POST", url_new, headers=headers, content=image_bytes, timeout=60)
+    except httpx.HTTPError as e:
         print("Azure DI submit network error:", e)
         r = None
 
@@ -280,10 +963,12 @@ def _azure_analyze_receipt(image_bytes: bytes) -> Optional[dict]:
     if r is None or r.status_code == 404:
         url_old = f"{AZURE_DI_ENDPOINT}/formrecognizer/documentModels/prebuilt-receipt:analyze?api-version={AZURE_API_VERSION_DOCS_OLD}"
         try:
-            r = requests.post(url_old, headers=headers, data=image_bytes, timeout=60)
-        except requests.RequestException as e:
+            r = await _upstream("azure_di", "di_submit", "POST", url_old, headers=headers, content=image_bytes, timeout=60)
+        except httpx.HTTPError as e:
             print("Azure DI legacy submit network error:", e)
             return None
+    if report is not None:
+        report["upload_ms"] = round((time.perf_counter() - t_up) * 1000)
 
     if r.status_code not in (200, 202):
         print("Azure receipt submit error", r.status_code, r.text[:300])
@@ -301,32 +986,57 @@ def _azure_analyze_receipt(image_bytes: bytes) -> Optional[dict]:
             pass
         print("Azure receipt: missing operation-location")
         return None
+    if progress:
+        progress("di_submitted")
 
-    # Poll
+    # Poll (cancellable; reuses the pooled azure_di connection)
     result = None
-    for _ in range(30):
+    t0 = time.monotonic()
+    retry_after = retry_after_sec(r.headers)
+    polls = 0
+    while True:
+        remaining = DI_POLLER.deadline - (time.monotonic() - t0)
+        if remaining <= 0:
+            DI_POLLER.record_timeout()
+            BREAKERS["azure_di"].record(False, time.monotonic() - t0)  # operation never finished
+            print("Azure receipt: polling deadline exceeded")
+            break
+        await asyncio.sleep(min(DI_POLLER.next_delay(polls, retry_after), remaining))
+        polls += 1
+        sent = time.monotonic() - t0
         try:
-            pr = requests.get(op_url, headers={"Ocp-Apim-Subscription-Key": AZURE_DI_KEY}, timeout=30)
-        except requests.RequestException:
-            time.sleep(1.0); continue
+            pr = await _upstream("azure_di", "di_poll", "GET", op_url,
+                                 headers={"Ocp-Apim-Subscription-Key": AZURE_DI_KEY}, timeout=30)
+        except httpx.HTTPError:
+            retry_after = None
+            continue
+        retry_after = retry_after_sec(pr.headers)
         if pr.status_code != 200:
-            time.sleep(1.0); continue
+            continue
         data = pr.json()
         status = data.get("status")
+        if progress:
+            progress("di_polling", attempt=polls, status=status)
         if status in ("succeeded", "failed", "partiallySucceeded"):
+            DI_POLLER.record(sent, polls)
             result = data.get("analyzeResult") or data.get("result") or data
             break
-        time.sleep(1.0)
 
     if not isinstance(result, dict):
         return None
 
     return _parse_di_result(result)
 
+# Fields, items (with DI's confidence) and the page text. The text lets an under-itemized
+# DI result go to GPT directly instead of paying for a separate Read OCR call.
 def _parse_di_result(result: dict) -> Optional[dict]:
+    content = result.get("content")
+    if not isinstance(content, str):
+        content = "\n".join(l.get("content", "") for pg in result.get("pages") or [] for l in pg.get("lines") or [])
+    content = content.strip()
     docs = result.get("documents") or []
     if not docs:
-        return None
+        return {"items": [], "content": content} if content else None
     fields = docs[0].get("fields", {}) if isinstance(docs[0], dict) else {}
 
     def _num(field):
@@ -347,8 +1057,9 @@ def _parse_di_result(result: dict) -> Optional[dict]:
     items = fields.get("Items", {}).get("valueArray") or []
     for it in items:
         f = it.get("valueObject", {}) if isinstance(it, dict) else {}
-        conf = it.get("confidence", 1.0) if isinstance(it, dict) else 1.0
-        if conf is not None and conf < 0.65:
+        conf = it.get("confidence") if isinstance(it, dict) else None
+        conf = 1.0 if conf is None else conf
+        if conf < DI_MIN_ITEM_CONFIDENCE:
             continue
         desc = (f.get("Description", {}).get("valueString")
                 or f.get("Description", {}).get("content") or "").strip() or "Item"
@@ -358,7 +1069,7 @@ def _parse_di_result(result: dict) -> Optional[dict]:
             qty = f.get("Quantity", {}).get("valueNumber") or 1
             amt = unit * qty
         try:
-            items_out.append({"description": desc, "amount": float(amt or 0)})
+            items_out.append({"description": desc, "amount": float(amt or 0), "confidence": conf})
         except Exception:
             pass
 
@@ -369,12 +1080,54 @@ def _parse_di_result(result: dict) -> Optional[dict]:
         "tax": _num("TotalTax") or _num("Tax"),
         "tip": _num("Tip"),
         "items": items_out,
+        "content": content,
     }
-    if not parsed["items"]:
+    if not parsed["items"] and not content:
         return None
     return parsed
 
-def _azure_read_ocr(image_bytes: bytes) -> Optional[str]:
+def _words(desc) -> set:
+    return set(normalize(desc if isinstance(desc, str) else "").split())
+
+# GPT's items, plus high-confidence DI items GPT missed. A DI item matches a GPT item with
+# the same description, or the same amount and a shared word; on a description match
+# DI's amount wins. DI's header fields (merchant, date, total, tax, tip) win when set.
+def _reconcile(di: Optional[dict], gpt: Optional[dict]) -> tuple[Optional[dict], Optional[dict]]:
+    if not di or not isinstance(gpt, dict) or not isinstance(gpt.get("items"), list):
+        return gpt, None
+    items = [dict(it) for it in gpt["items"] if isinstance(it, dict)]
+    keys = []  # (description words, cents) per GPT item
+    for it in items:
+        try:
+            cents = round(float(it.get("amount") or 0) * 100)
+        except (TypeError, ValueError):
+            cents = None
+        keys.append((_words(it.get("description")), cents))
+    stats = {"di_items": len(di["items"]), "matched": 0, "corrected": 0, "added": 0}
+    for d in di["items"]:
+        if d["confidence"] < DI_MERGE_MIN_CONFIDENCE:
+            continue
+        words, cents = _words(d["description"]), round(d["amount"] * 100)
+        hit = next((i for i, (w, _) in enumerate(keys) if w and w == words), None)
+        if hit is None:
+            hit = next((i for i, (w, c) in enumerate(keys) if c == cents and w & words), None)
+        if hit is None:
+            items.append({"description": d["description"], "amount": d["amount"]})
+            keys.append((words, cents))
+            stats["added"] += 1
+        elif keys[hit][1] != cents:
+            items[hit]["amount"] = d["amount"]
+            keys[hit] = (keys[hit][0], cents)
+            stats["corrected"] += 1
+        else:
+            stats["matched"] += 1
+    out = {**gpt, "items": items}
+    for k in ("merchant", "date", "total", "tax", "tip"):
+        if di.get(k):
+            out[k] = di[k]
+    return out, stats
+
+async def _azure_read_ocr(image_bytes: bytes, report: Optional[dict] = None) -> Optional[str]:
     if not (AZURE_USE_READ and VISION_CONFIGURED):
         return None
 
@@ -383,11 +1136,14 @@ def _azure_read_ocr(image_bytes: bytes) -> Optional[str]:
         "Ocp-Apim-Subscription-Key": AZURE_VISION_KEY,
         "Content-Type": "application/octet-stream",
     }
+    t_up = time.perf_counter()
     try:
-        r = requests.post(url, headers=headers, data=image_bytes, timeout=60)
-    except requests.RequestException as e:
+        r = await _upstream("azure_vision", "azure_read", "POST", url, headers=headers, content=image_bytes, timeout=60)
+    except httpx.HTTPError as e:
         print("Azure Read network error:", e)
         return None
+    if report is not None:
+        report["upload_ms"] = round((time.perf_counter() - t_up) * 1000)  # includes OCR time
 
     if r.status_code != 200:
         print("Azure Read error", r.status_code, r.text[:300])
@@ -419,7 +1175,9 @@ _SYSTEM = {
     )
 }
 
-def _openai_from_image(image_b64: str) -> dict:
+_IMAGE_SLOT = "@@image@@"
+
+async def _openai_from_image(image: bytes, report: Optional[dict] = None, usage: Optional[dict] = None) -> dict:
     payload = {
         "model": MODEL,
         "response_format": {"type": "json_object"},
@@ -441,30 +1199,42 @@ def _openai_from_image(image_b64: str) -> dict:
                             "use 'tax' or 'tip' only for those lines; otherwise 'food'."
                         )
                     },
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}" }},
+                    {"type": "image_url", "image_url": {"url": _IMAGE_SLOT}},
                 ],
             },
         ],
     }
+    # Base64 is only produced here, when the vision engine runs, and is encoded chunk by
+    # chunk as the body streams out rather than held as one string
+    head, tail = json.dumps(payload).encode().split(_IMAGE_SLOT.encode())
+    length, body = b64_body(head + b"data:image/jpeg;base64,", image, tail)
+    t_up = time.perf_counter()
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json"},
-            data=json.dumps(payload), timeout=90,
+        r = await _upstream(
+            "openai", "gpt_image", "POST", f"{OPENAI_BASE_URL}/chat/completions",
+            headers={"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json",
+                     "Content-Length": str(length)},
+            content=body, timeout=90,
         )
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"OpenAI network error: {e}")
+    if report is not None:
+        report["upload_ms"] = round((time.perf_counter() - t_up) * 1000)  # includes model time
+    if usage is not None:
+        usage["ms"] = round((time.perf_counter() - t_up) * 1000)
 
     if r.status_code != 200:
         raise HTTPException(status_code=502, detail=f"OpenAI error ({r.status_code}): {r.text[:800]}")
     try:
         data = r.json()
+        _record_usage("gpt_image", data.get("usage"), usage)
         content = data["choices"][0]["message"]["content"]
         return json.loads(content)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Failed to parse OpenAI JSON: {e}")
 
-def _openai_from_text(text: str) -> Optional[dict]:
+# `usage` (if given) receives {ms, prompt_tokens, completion_tokens} for the call
+async def _openai_from_text(text: str, stage: str = "gpt_text", usage: Optional[dict] = None) -> Optional[dict]:
     payload = {
         "model": MODEL,
         "response_format": {"type": "json_object"},
@@ -485,35 +1255,484 @@ def _openai_from_text(text: str) -> Optional[dict]:
             },
         ],
     }
+    if GPT_TEXT_MAX_TOKENS > 0:
+        payload["max_tokens"] = GPT_TEXT_MAX_TOKENS
+    t0 = time.perf_counter()
     try:
-        r = requests.post(
-            "https://api.openai.com/v1/chat/completions",
+        r = await _upstream(
+            "openai", stage, "POST", f"{OPENAI_BASE_URL}/chat/completions",
             headers={"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json"},
-            data=json.dumps(payload), timeout=90
+            content=json.dumps(payload), timeout=90
         )
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print("OpenAI text network error:", e)
         return None
+    if usage is not None:
+        usage["ms"] = round((time.perf_counter() - t0) * 1000)
 
     if r.status_code != 200:
         print("OpenAI text error", r.status_code, r.text[:300])
         return None
     try:
         data = r.json()
+        _record_usage(stage, data.get("usage"), usage)
         content = data["choices"][0]["message"]["content"]
         return json.loads(content)
     except Exception:
         return None
 
-# --- Main endpoint ---
-@app.post("/analyze-receipt", response_model=AnalyzeResp)
-async def analyze(
-    request: Request,
-    # image inputs
-    file: UploadFile | None = File(default=None),
-    json_body: AnalyzeReq | None = Body(default=None),
+# --- Engine cascade ---
+def _enough_items(parsed: Optional[dict]) -> bool:
+    # Quality gate on purchasable lines only, so the winning engine does not depend on request knobs
+    if not parsed or not parsed.get("items"):
+        return False
+    out = _postprocess_receipt(parsed, include_tax_tip=False)
+    return len(out["items"]) >= FORCE_SECOND_PASS_MIN_ITEMS
+
+class _EngineRun:
+    # Per-pipeline record of which stages ran, how long each took and which were cancelled,
+    # plus progress events fanned out to streaming listeners (late joiners get a replay)
+    def __init__(self, strategy: str):
+        self.strategy = strategy
+        self.timings: dict[str, int] = {}
+        self.cancelled: list[str] = []
+        self.skipped: list[str] = []  # stages skipped: upstream breaker open, or routed out by the pre-gate
+        self.gate: Optional[dict] = None  # pre-gate decision
+        self.ocr: Optional[dict] = None  # OCR compaction stats
+        self.openai: dict[str, dict] = {}  # call -> {ms, prompt_tokens, completion_tokens}
+        self.di: Optional[dict] = None  # under-itemized DI result, reconciled with a later GPT text result
+        self.reconcile: Optional[dict] = None  # DI/GPT merge counts
+        self.template: Optional[dict] = None  # merchant template lookup: {merchant, ok, ms, unknown_lines, agree?}
+        self.tiles: Optional[dict] = None  # tiled read: {bands, items per band, overlap items dropped}
+        self.text_tried = False  # a GPT text pass ran; OCR text from another source would not do better
+        self.events: list[tuple[str, dict]] = []
+        self._listeners: list[asyncio.Queue] = []
+
+    def emit(self, event: str, **data) -> None:
+        self.events.append((event, data))
+        for q in self._listeners:
+            q.put_nowait((event, data))
+
+    def subscribe(self, q: asyncio.Queue) -> None:
+        for ev in self.events:
+            q.put_nowait(ev)
+        self._listeners.append(q)
+
+    def candidate(self, engine: str, parsed: Optional[dict], accepted: bool) -> None:
+        # Partial result: an engine's items as soon as it answers, before the pipeline decides
+        if parsed and parsed.get("items"):
+            items = [{"description": it.get("description"), "amount": it.get("amount")} for it in parsed["items"]]
+            self.emit("items", engine=engine, accepted=accepted, items=items)
+
+    def allow(self, stage: str, upstream: str) -> bool:
+        if upstream == "openai" and not OPENAI_CONFIGURED:
+            self.skipped.append(stage)
+            return False
+        if BREAKERS[upstream].allow():
+            return True
+        self.skipped.append(stage)
+        self.emit("engine_skipped", stage=stage, upstream=upstream)
+        return False
+
+    async def timed(self, stage: str, coro):
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            self.cancelled.append(stage)
+            raise
+        finally:
+            self.timings[stage] = round((time.perf_counter() - t0) * 1000)
+
+    def meta(self, img: PreparedImage) -> dict:
+        return {"strategy": self.strategy, "timings_ms": self.timings, "cancelled": self.cancelled,
+                "skipped": self.skipped, "payload": img.report, "pregate": self.gate,
+                "ocr": self.ocr, "openai": self.openai, "reconcile": self.reconcile,
+                "template": self.template, "tiles": self.tiles}
+
+# Each path returns (parsed dict before postprocess, engine name), or None to fall through
+# An under-itemized DI result falls back to GPT on DI's own text (azure_receipt_gpt*)
+# unless text_fallback is off (parallel runs, where Read OCR text is already on the way)
+async def _di_path(run: _EngineRun, img: PreparedImage, text_fallback: bool = True) -> Optional[tuple[dict, str]]:
+    if not (AZURE_USE_RECEIPT and DI_CONFIGURED) or not run.allow("azure_receipt", "azure_di"):
+        return None
+    t0 = time.perf_counter()
+    with metrics.stage("preprocess"):
+        data = await img.for_engine("azure_di")
+    parsed = await run.timed(
+        "azure_receipt", _limited("azure_di", _azure_analyze_receipt(data, img.report["azure_di"], run.emit))
+    )
+    if parsed is None:
+        return None
+    content = parsed.pop("content", "")
+    ok = _enough_items(parsed)
+    run.candidate("azure_receipt", parsed, ok)
+    if ok:
+        ENGINE_LATENCY.record("azure_receipt", time.perf_counter() - t0)
+        return parsed, "azure_receipt"
+    run.di = {**parsed, "content": content}
+    if not text_fallback or run.text_tried:
+        return None
+    res = await _gpt_text_path(run, content, "azure_receipt")
+    if res is not None:
+        ENGINE_LATENCY.record("azure_receipt_gpt", time.perf_counter() - t0)
+    return res
+
+def _prompt_text(run: _EngineRun, text: str) -> str:
+    # OCR text as sent to GPT: compacted once per run, shared by the plain and strict passes
+    if not OCR_COMPACT:
+        return text
+    with metrics.stage("ocr_compact"):
+        out, run.ocr = compact_ocr(text, head_lines=OCR_HEAD_LINES, context=OCR_CONTEXT_LINES,
+                                   max_tokens=OCR_TOKEN_BUDGET)
+    OCR_CHARS.inc(run.ocr["chars_in"], kind="raw")
+    OCR_CHARS.inc(run.ocr["chars_out"], kind="compact")
+    if run.ocr["dropped_price_lines"]:
+        OCR_DROPPED_PRICE_LINES.inc(run.ocr["dropped_price_lines"])
+    return out
+
+def _gpt_text(run: _EngineRun, prompt: str, stage: str):
+    return run.timed(stage, _limited("openai", _openai_from_text(prompt, stage, run.openai.setdefault(stage, {}))))
+
+async def _gpt_text_reconciled(run: _EngineRun, prompt: str, stage: str) -> Optional[dict]:
+    parsed, stats = _reconcile(run.di, await _gpt_text(run, prompt, stage))
+    if stats is not None:
+        run.reconcile = stats
+    return parsed
+
+def _adds_up(parsed: Optional[dict]) -> bool:
+    # Items + tax + tip (as _postprocess_receipt counts them) match the receipt's total
+    if not parsed or not isinstance(parsed.get("total"), (int, float)) or not parsed["total"]:
+        return False
+    out = _postprocess_receipt(parsed, include_tax_tip=False)
+    return abs(out["subtotal"] + out["tax"] + out["tip"] - float(parsed["total"])) <= 0.02
+
+def _template_parse(run: _EngineRun, text: str, source: str) -> Optional[tuple[dict, str]]:
+    # The merchant's learned layout applied to the OCR text; a parse that adds up replaces
+    # GPT (TEMPLATES_MODE=on) or is kept in run.template for comparison (shadow)
+    if TEMPLATES is None:
+        return None
+    t0 = time.perf_counter()
+    with metrics.stage("template"):
+        parsed, key = TEMPLATES.parse((run.di or {}).get("merchant"), text)
+    if parsed is None:
+        TEMPLATE_EVENTS.inc(result="none")
+        return None
+    unknown = parsed.pop("unknown_lines")
+    ok = _enough_items(parsed) and _adds_up(parsed)
+    ms = (time.perf_counter() - t0) * 1000
+    saved_before = TEMPLATES.saved_ms
+    result = TEMPLATES.outcome(key, ok, ms)
+    TEMPLATE_SAVED_SECONDS.inc((TEMPLATES.saved_ms - saved_before) / 1000)
+    TEMPLATE_EVENTS.inc(result=result)
+    run.template = {"merchant": key, "ok": ok, "ms": round(ms, 2), "unknown_lines": unknown}
+    run.emit("template", merchant=key, ok=ok, used=ok and TEMPLATES.routing)
+    if not ok:
+        return None
+    if not TEMPLATES.routing:
+        run.template["parsed"] = parsed
+        return None
+    run.text_tried = True
+    engine = f"{source}_template"
+    run.candidate(engine, parsed, True)
+    return parsed, engine
 
-    # knobs via multipart form (preferred on mobile)
+def _template_learn(run: _EngineRun, text: str, parsed: dict) -> None:
+    # A side effect of a good GPT parse: whatever GPT returned, it never fails the request
+    try:
+        shadow = (run.template or {}).pop("parsed", None)
+        if shadow is not None:
+            run.template["agree"] = TEMPLATES.compare(shadow, parsed)
+            TEMPLATE_EVENTS.inc(result="shadow_agree" if run.template["agree"] else "shadow_disagree")
+        TEMPLATES.observe_gpt(sum(c.get("ms", 0) for c in run.openai.values()))
+        if _adds_up(parsed) and TEMPLATES.learn(parsed.get("merchant"), text, parsed):
+            TEMPLATE_EVENTS.inc(result="learned")
+    except Exception as e:
+        print("Template learn error:", repr(e))
+
+# GPT on OCR text from `source` (azure_read, or azure_receipt for DI's own text), or the
+# merchant's template in its place; engine names are f"{source}_gpt",
+# f"{source}_gpt_strict" and f"{source}_template"
+async def _gpt_text_path(run: _EngineRun, text: Optional[str], source: str = "azure_read") -> Optional[tuple[dict, str]]:
+    if not text:
+        return None
+    res = _template_parse(run, text, source)
+    if res is None:
+        res = await _gpt_text_passes(run, text, source)
+        if res is not None and TEMPLATES is not None:
+            _template_learn(run, text, res[0])
+    return res
+
+async def _gpt_text_passes(run: _EngineRun, text: str, source: str) -> Optional[tuple[dict, str]]:
+    if not run.allow("gpt_text", "openai"):
+        return None
+    run.text_tried = True
+    engine, strict_engine = f"{source}_gpt", f"{source}_gpt_strict"
+    strict_first = PREGATE.predict_text(run.gate, text, strict_engine) and PREGATE.routing
+    text = _prompt_text(run, text)
+    if strict_first:
+        # Dense price list: the plain prompt usually under-itemizes, go straight to the strict one
+        run.emit("gpt_text_started", strict=True, source=source)
+        parsed = await _gpt_text_reconciled(run, _force_itemization_prompt(text), "gpt_text_strict")
+        if _enough_items(parsed):
+            run.candidate(strict_engine, parsed, True)
+            return parsed, strict_engine
+    run.emit("gpt_text_started", strict=False, source=source)
+    parsed_text = await _gpt_text_reconciled(run, text, "gpt_text")
+    if parsed_text and parsed_text.get("items"):
+        ok = _enough_items(parsed_text)
+        run.candidate(engine, parsed_text, ok)
+        if ok:
+            return parsed_text, engine
+        # If too few items but OCR looks rich (many prices), try a stricter second pass
+        if _looks_like_many_prices(text):
+            run.emit("gpt_text_started", strict=True, source=source)
+            parsed_text2 = await _gpt_text_reconciled(run, _force_itemization_prompt(text), "gpt_text_strict")
+            if parsed_text2 and parsed_text2.get("items"):
+                run.candidate(strict_engine, parsed_text2, True)
+                return parsed_text2, strict_engine
+    return None
+
+async def _read_text(run: _EngineRun, img: PreparedImage) -> Optional[str]:
+    if not (AZURE_USE_READ and VISION_CONFIGURED) or not run.allow("azure_read", "azure_vision"):
+        return None
+    with metrics.stage("preprocess"):
+        data = await img.for_engine("azure_vision")
+    text = await run.timed(
+        "azure_read", _limited("azure_vision", _azure_read_ocr(data, img.report["azure_vision"]))
+    )
+    run.emit("ocr_done", lines=text.count("\n") + 1 if text else 0)
+    return text
+
+async def _read_path(run: _EngineRun, img: PreparedImage) -> Optional[tuple[dict, str]]:
+    if run.text_tried:  # GPT already read DI's text: Read OCR would repeat it; go on to vision
+        run.skipped.append("azure_read")
+        return None
+    t0 = time.perf_counter()
+    res = await _gpt_text_path(run, await _read_text(run, img))
+    if res is not None:
+        ENGINE_LATENCY.record("azure_read_gpt", time.perf_counter() - t0)
+    return res
+
+async def _vision_path(run: _EngineRun, img: PreparedImage) -> tuple[dict, str]:
+    if not OPENAI_CONFIGURED:
+        raise HTTPException(status_code=503, detail="OpenAI is not configured and no other engine could read this image")
+    if not run.allow("gpt_image", "openai"):
+        retry = BREAKERS["openai"].stats()["retry_in_sec"] or BREAKER_OPEN_SEC
+        raise HTTPException(status_code=503, detail="Receipt engines are temporarily unavailable",
+                            headers={"Retry-After": str(max(1, int(retry)))})
+    with metrics.stage("preprocess"):
+        image = await img.for_engine("openai")
+    run.emit("gpt_image_started")
+    parsed = await run.timed(
+        "gpt_image", _limited("openai", _openai_from_image(image, img.report["openai"], run.openai.setdefault("gpt_image", {})))
+    )
+    return parsed, "gpt_image"
+
+# --- Tiling ---
+async def _tile_parse(run: _EngineRun, tile: PreparedImage, i: int) -> Optional[dict]:
+    # One band through the first engine that answers: DI (GPT on DI's text if DI finds no
+    # items), else Read OCR + GPT, else GPT on the image. No minimum item count: a band may
+    # hold only the header or the totals. None if no engine could read it.
+    name, text = f"tile{i}", None
+    if AZURE_USE_RECEIPT and DI_CONFIGURED and BREAKERS["azure_di"].allow():
+        data = await tile.for_engine("azure_di")
+        parsed = await run.timed(f"{name}_azure_receipt",
+                                 _limited("azure_di", _azure_analyze_receipt(data, tile.report["azure_di"])))
+        if parsed is not None:
+            text = parsed.pop("content", "")
+            if parsed["items"]:
+                return parsed
+    if not text and AZURE_USE_READ and VISION_CONFIGURED and BREAKERS["azure_vision"].allow():
+        data = await tile.for_engine("azure_vision")
+        text = await run.timed(f"{name}_azure_read",
+                               _limited("azure_vision", _azure_read_ocr(data, tile.report["azure_vision"])))
+    if not OPENAI_CONFIGURED or not BREAKERS["openai"].allow():
+        return None
+    if text:
+        stage = f"{name}_gpt_text"
+        return await run.timed(stage, _limited("openai", _openai_from_text(
+            text, "tile_gpt_text", run.openai.setdefault(stage, {}))))
+    image = await tile.for_engine("openai")
+    stage = f"{name}_gpt_image"
+    return await run.timed(stage, _limited("openai", _openai_from_image(
+        image, tile.report["openai"], run.openai.setdefault(stage, {}))))
+
+def _same_item(a: dict, b: dict) -> bool:
+    # Same line read from two bands: same price and, unless one read lost it, a shared word
+    try:
+        if round(float(a.get("amount") or 0) * 100) != round(float(b.get("amount") or 0) * 100):
+            return False
+    except (TypeError, ValueError):
+        return False
+    wa, wb = _words(a.get("description")), _words(b.get("description"))
+    return not wa or not wb or bool(wa & wb)
+
+def _join_items(a: list, b: list) -> tuple[list, int]:
+    # b follows a; the longest run of items ending a that also starts b was read twice in
+    # the overlap. Each such line is taken from the band where it sits farther from the
+    # edge (a for the first half of the run, b for the rest): a line cut by an edge may
+    # still match on price and a word. A cut line that does not match at all is junk at
+    # the end of a or the start of b, dropped when the run matches next to it.
+    for k in range(min(len(a), len(b)), 0, -1):
+        for da, db in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            end = len(a) - da
+            if end - k < 0 or db + k > len(b):
+                continue
+            if all(_same_item(x, y) for x, y in zip(a[end - k:end], b[db:db + k])):
+                half = (k + 1) // 2
+                return a[:end - k + half] + b[db + half:], k + da + db
+    return a + b, 0
+
+def _stitch_tiles(parts: list[dict]) -> tuple[dict, int]:
+    # Items in band order with the overlap reads removed; merchant/date from the topmost
+    # band that has them, total/tax/tip from the bottommost
+    items, dropped = [], 0
+    for p in parts:
+        band = [it for it in p.get("items") or [] if isinstance(it, dict)]
+        items, n = _join_items(items, band)
+        dropped += n
+    out: dict = {"items": items}
+    for k in ("merchant", "date"):
+        out[k] = next((p[k] for p in parts if p.get(k)), None)
+    for k in ("total", "tax", "tip", "subtotal"):
+        out[k] = next((p[k] for p in reversed(parts) if p.get(k)), None)
+    return out, dropped
+
+async def _tiled_path(run: _EngineRun, img: PreparedImage) -> Optional[tuple[dict, str]]:
+    with metrics.stage("tile"):
+        tiles = await img.tiles(IMAGE_TILE_MIN_ASPECT, IMAGE_TILE_ASPECT, IMAGE_TILE_OVERLAP, IMAGE_TILE_MAX)
+    if not tiles:
+        return None
+    run.emit("tiles", bands=[t.band for t in tiles])
+    # A band nobody read would leave a gap in the items: the first band that fails (None,
+    # or an upstream error) cancels the rest and the whole image goes down the cascade
+    tasks = [asyncio.ensure_future(_tile_parse(run, t, i)) for i, t in enumerate(tiles)]
+    failed = False
+    try:
+        for fut in asyncio.as_completed(tasks):
+            try:
+                if not isinstance(await fut, dict):
+                    failed = True
+            except HTTPException as e:
+                run.emit("tile_failed", status=e.status_code, detail=str(e.detail))
+                failed = True
+            if failed:
+                break
+    finally:
+        for t in tasks:
+            t.cancel()
+    parts = [t.result() if t.done() and not t.cancelled() and t.exception() is None else None for t in tasks]
+    run.tiles = {"bands": [t.band for t in tiles],
+                 "items": [len(p.get("items") or []) if isinstance(p, dict) else None for p in parts]}
+    if failed:
+        TILED_RUNS.inc(result="failed")
+        return None
+    with metrics.stage("tile_stitch"):
+        parsed, run.tiles["dropped"] = _stitch_tiles(parts)
+    ok = _enough_items(parsed)
+    run.candidate("tiled", parsed, ok)
+    TILED_RUNS.inc(result="ok" if ok else "short")
+    return (parsed, "tiled") if ok else None
+
+async def _first_success(paths: list, hedge_delay: Optional[float]) -> Optional[tuple[dict, str]]:
+    # Launch paths in order; the next one starts as soon as a running one fails, or (if
+    # hedge_delay is set) when none has answered within hedge_delay. First result wins.
+    pending: set[asyncio.Task] = set()
+    last_exc: Optional[BaseException] = None
+    nxt = 0
+
+    def launch() -> None:
+        nonlocal nxt
+        pending.add(asyncio.ensure_future(paths[nxt]()))
+        nxt += 1
+
+    launch()
+    try:
+        while pending:
+            timeout = hedge_delay if nxt < len(paths) else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
+                continue
+            for t in done:
+                pending.discard(t)
+                try:
+                    res = t.result()
+                except HTTPException as e:
+                    last_exc, res = e, None
+                if res is not None:
+                    return res
+            if nxt < len(paths):
+                launch()
+        if last_exc is not None:
+            raise last_exc
+        return None
+    finally:
+        for t in pending:
+            t.cancel()
+
+async def _run_engines(img: PreparedImage, run: _EngineRun) -> tuple[dict, str, dict]:
+    if IMAGE_TILING:
+        res = await _tiled_path(run, img)
+        if res is not None:
+            return *res, run.meta(img)
+    with metrics.stage("pregate"):
+        run.gate = await PREGATE.predict(img.raw)
+    # Engines the pre-gate routes around (route mode only)
+    skip = set()
+    if run.gate is not None:
+        run.emit("pregate", predicted=run.gate["predicted"], reason=run.gate["reason"])
+        if PREGATE.routing and run.gate["predicted"] != "azure_receipt":
+            skip = {"azure_receipt"} if run.gate["predicted"] == "azure_read_gpt" else {"azure_receipt", "azure_read"}
+            run.skipped.extend(sorted(skip))
+
+    if run.strategy == "parallel":
+        # DI and Read OCR together; GPT only runs on the OCR text if DI under-itemizes
+        # (on DI's own text if Read returned none)
+        di, text = await asyncio.gather(
+            _di_path(run, img, text_fallback=False) if "azure_receipt" not in skip else asyncio.sleep(0),
+            _read_text(run, img) if "azure_read" not in skip else asyncio.sleep(0),
+        )
+        res = di
+        if res is None and text:
+            res = await _gpt_text_path(run, text)
+        elif res is None and run.di is not None:
+            res = await _gpt_text_path(run, run.di["content"], "azure_receipt")
+        if res is None:
+            res = await _vision_path(run, img)
+    else:
+        ocr = [("azure_receipt", lambda: _di_path(run, img)), ("azure_read", lambda: _read_path(run, img))]
+        ocr = [p for p in ocr if p[0] not in skip]
+        if ENGINE_ROUTING == "fastest" and len(ocr) == 2:
+            di, read = ENGINE_LATENCY.p50("azure_receipt"), ENGINE_LATENCY.p50("azure_read_gpt")
+            if di is not None and read is not None and read < di:
+                ocr.reverse()
+        paths = [fn for _, fn in ocr] + [lambda: _vision_path(run, img)]
+        res = await _first_success(paths, HEDGE_DELAY_SEC if run.strategy == "hedged" else None)
+    parsed, engine = res
+    return parsed, engine, run.meta(img)
+
+# In-flight pipeline runs by content key, so streaming callers can follow a coalesced run
+_RUNS: dict[str, _EngineRun] = {}
+
+async def _run_engines_cached(key: str, img: PreparedImage, run: _EngineRun, ticket=None) -> tuple[dict, str, dict]:
+    try:
+        parsed, engine, meta = await _run_engines(img, run)
+        ENGINE_WINS.inc(engine=engine)
+        if run.gate is not None and not engine.endswith("_template"):  # no text pass ran to score
+            PREGATE_DECISIONS.inc(predicted=PREGATE.observe(run.gate, engine), actual=engine)
+        if RESULT_CACHE is not None and parsed.get("items"):
+            await RESULT_CACHE.put(key, {"parsed": parsed, "engine": engine, "meta": meta})
+        return parsed, engine, meta
+    finally:
+        if ticket is not None:
+            ticket.release()
+        if _RUNS.get(key) is run:
+            _RUNS.pop(key, None)
+
+# --- Request knobs (multipart form preferred on mobile, query as fallback) ---
+async def _request_knobs(
     include_tax_tip_form: Optional[bool] = Form(default=None, alias="include_tax_tip"),
     people_form: Optional[int] = Form(default=None, alias="people"),
     tip_percent_form: Optional[float] = Form(default=None, alias="tip_percent"),
@@ -521,112 +1740,226 @@ async def analyze(
     tax_amount_override_form: Optional[float] = Form(default=None, alias="tax_amount"),
     lock_paper_total_form: Optional[bool] = Form(default=None, alias="lock_paper_total"),
 
-    # knobs via query (fallback)
     include_tax_tip_q: Optional[bool] = Query(default=None, alias="include_tax_tip"),
     people_q: Optional[int] = Query(default=None, alias="people"),
     tip_percent_q: Optional[float] = Query(default=None, alias="tip_percent"),
     tip_amount_override_q: Optional[float] = Query(default=None, alias="tip_amount"),
     tax_amount_override_q: Optional[float] = Query(default=None, alias="tax_amount"),
     lock_paper_total_q: Optional[bool] = Query(default=None, alias="lock_paper_total"),
+) -> dict:
+    # ---- normalize knobs ----
+    include_tax_tip_in = include_tax_tip_form if include_tax_tip_form is not None else include_tax_tip_q
+    include_tax_tip_flag = RESTAURANT_INCLUDE_TAX_TIP_ITEMS if include_tax_tip_in is None else bool(include_tax_tip_in)
+
+    people = people_form if people_form is not None else people_q
+    tip_percent = tip_percent_form if tip_percent_form is not None else tip_percent_q
+
+    tip_amount_override = tip_amount_override_form if tip_amount_override_form is not None else tip_amount_override_q
+    tax_amount_override = tax_amount_override_form if tax_amount_override_form is not None else tax_amount_override_q
+    lock_paper_total = (lock_paper_total_form
+                        if lock_paper_total_form is not None else (lock_paper_total_q or False))
+
+    # basic validation
+    if people is not None and (people < 1 or people > 50):
+        raise HTTPException(status_code=400, detail="people must be between 1 and 50")
+    if tip_percent is not None and (tip_percent < 0 or tip_percent > 100):
+        raise HTTPException(status_code=400, detail="tip_percent must be between 0 and 100")
+    if tip_amount_override is not None and tip_amount_override < 0:
+        raise HTTPException(status_code=400, detail="tip_amount must be >= 0")
+    if tax_amount_override is not None and tax_amount_override < 0:
+        raise HTTPException(status_code=400, detail="tax_amount must be >= 0")
+
+    # keyword arguments for _postprocess_receipt
+    return {
+        "include_tax_tip": include_tax_tip_flag,
+        "tip_percent_override": tip_percent,
+        "tip_amount_override": tip_amount_override,
+        "tax_amount_override": tax_amount_override,
+        "lock_paper_total": lock_paper_total,
+    }
+
+# engine execution strategy override (sequential | parallel | hedged)
+async def _request_budget(deadline_ms: Optional[str] = Header(default=None, alias="X-Deadline-Ms")) -> float:
+    # How long the client will wait for this response; drives admission shedding
+    try:
+        ms = float(deadline_ms) if deadline_ms is not None else None
+    except ValueError:
+        ms = None
+    return ms / 1000 if ms is not None and ms > 0 else ADMISSION_DEFAULT_BUDGET_SEC
+
+async def _request_strategy(strategy: Optional[str] = Query(default=None)) -> str:
+    strategy = (strategy or ENGINE_STRATEGY).strip().lower()
+    if strategy not in ENGINE_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"strategy must be one of {', '.join(ENGINE_STRATEGIES)}")
+    return strategy
+
+# --- Reading images: one buffer per upload, size checked before it is read ---
+
+def _is_json(request: Request) -> bool:
+    return (request.headers.get("content-type") or "").startswith("application/json")
+
+async def _read_file(file: UploadFile) -> bytes:
+    try:
+        with metrics.stage("read_image"):
+            return await read_upload(file, MAX_IMAGE_BYTES)
+    except TooLarge:
+        raise HTTPException(status_code=413, detail=_TOO_LARGE)
+
+# `blob` names a base64 field to keep in the request buffer instead of copying it (see upload.py)
+async def _read_json(request: Request, expected: str, blob: Optional[str] = None) -> dict:
+    try:
+        with metrics.stage("read_image"):
+            body = parse_json(await read_body(request, _body_limit(request.url.path)), blob)
+    except TooLarge:
+        raise HTTPException(status_code=413, detail=_TOO_LARGE)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail=f"Expected JSON {expected}")
+    return body
+
+def _decode_b64_image(image_b64) -> bytes:
+    if not isinstance(image_b64, (str, memoryview)):
+        raise HTTPException(status_code=400, detail="Invalid base64 image")
+    try:
+        with metrics.stage("read_image"):
+            return decode_b64(image_b64, MAX_IMAGE_BYTES)
+    except TooLarge:
+        raise HTTPException(status_code=413, detail=_TOO_LARGE)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid base64 image")
+
+# multipart 'file', or JSON {image_base64}
+async def _read_image(request: Request, file: Optional[UploadFile]) -> bytes:
+    if file is not None:
+        return await _read_file(file)
+    if _is_json(request):
+        body = await _read_json(request, "{image_base64: string}", blob="image_base64")
+        if body.get("image_base64"):
+            return _decode_b64_image(body["image_base64"])
+    raise HTTPException(status_code=400, detail="Provide a 'file' (multipart) or 'image_base64' (JSON).")
+
+async def _admit(budget: Optional[float], priority: int, listener: Optional[asyncio.Queue]):
+    def queued(wait: float, depth: int) -> None:
+        if listener is not None:
+            listener.put_nowait(("queued", {"queue_depth": depth, "est_wait_ms": round(wait * 1000)}))
+    try:
+        ticket = await ADMISSION.acquire(budget, priority, queued)
+    except Shed as e:
+        ADMISSION_SHED.inc(reason=e.reason)
+        raise HTTPException(status_code=503, detail=f"Server busy ({e.reason}); retry later",
+                            headers={"Retry-After": str(e.retry_after)})
+    ADMISSION_QUEUE_SECONDS.observe(ticket.waited, priority=str(priority))
+    return ticket
+
+# Returns (response, cache status: hit | miss | coalesced). `listener` receives progress events.
+# A miss that has to start a pipeline goes through admission control first (budget in
+# seconds, None = wait as long as it takes).
+async def _analyze_image(
+    raw: bytes, knobs: dict, strategy: str,
+    listener: Optional[asyncio.Queue] = None,
+    budget: Optional[float] = None, priority: int = PRIORITY_INTERACTIVE,
+) -> tuple[AnalyzeResp, str]:
+    # ---- pipeline (cached + coalesced on image bytes) ----
+    key = content_key(raw, ENGINE_VERSION)
+    hit = await RESULT_CACHE.get(key) if RESULT_CACHE is not None else None
+    if hit is not None:
+        parsed, engine, meta = hit["parsed"], hit["engine"], hit.get("meta")
+        status = "hit"
+        if listener is not None:
+            listener.put_nowait(("cache_hit", {"engine": engine}))
+    else:
+        ticket = None
+        if ADMISSION is not None and not _INFLIGHT.running(key):
+            ticket = await _admit(budget, priority, listener)
+            if _INFLIGHT.running(key):  # an identical upload started while this one queued
+                ticket.release()
+                ticket = None
+        # No await between here and _INFLIGHT.do registering the task, so _RUNS stays in step
+        if not _INFLIGHT.running(key):
+            _RUNS[key] = _EngineRun(strategy)
+        run = _RUNS.get(key)
+        if listener is not None and run is not None:
+            run.subscribe(listener)
+        (parsed, engine, meta), shared = await _INFLIGHT.do(
+            key, lambda: _run_engines_cached(key, IMAGE_PREP.prepare(raw), run, ticket)
+        )
+        status = "coalesced" if shared else "miss"
+
+    CACHE_EVENTS.inc(result=status)
+    with metrics.stage("postprocess"):
+        out = _postprocess_receipt(parsed, **knobs)
+    out["engine"] = engine
+    out["engine_meta"] = meta
+    with metrics.stage("validate"):
+        resp = AnalyzeResp(**out)
+    return resp, status
+
+def _stream_line(event: str, data: dict, sse: bool) -> str:
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+    return json.dumps({"event": event, **data}, separators=(",", ":")) + "\n"
+
+# Progress events (di_submitted, di_polling, ocr_done, gpt_text_started, items, ...) then result|error
+async def _progress_stream(raw: bytes, knobs: dict, strategy: str, sse: bool, budget: float):
+    queue: asyncio.Queue = asyncio.Queue()
+    task = asyncio.ensure_future(_analyze_image(raw, knobs, strategy, listener=queue, budget=budget))
+    try:
+        yield _stream_line("accepted", {}, sse)
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                event, data = getter.result()
+                yield _stream_line(event, data, sse)
+                continue
+            getter.cancel()
+            break
+        while not queue.empty():
+            event, data = queue.get_nowait()
+            yield _stream_line(event, data, sse)
+        try:
+            out, status = task.result()
+            yield _stream_line("result", {"cache": status, "result": jsonable_encoder(out)}, sse)
+        except HTTPException as e:
+            err = {"status": e.status_code, "detail": str(e.detail)}
+            if e.headers and "Retry-After" in e.headers:
+                err["retry_after"] = int(e.headers["Retry-After"])
+            yield _stream_line("error", err, sse)
+        except Exception as e:
+            print("Analyze fatal error:", repr(e))
+            yield _stream_line("error", {"status": 502, "detail": "Analyzer crashed unexpectedly"}, sse)
+    finally:
+        # Client aborted: stop waiting. The shared pipeline keeps running and fills the cache.
+        task.cancel()
+
+# --- Main endpoint ---
+@app.post("/analyze-receipt", response_model=AnalyzeResp)
+async def analyze(
+    request: Request,
+    response: Response,
+    # image inputs
+    file: UploadFile | None = File(default=None),  # or a JSON body {image_base64}
+    knobs: dict = Depends(_request_knobs),
+    strategy: str = Depends(_request_strategy),
+    budget: float = Depends(_request_budget),
+    stream: Optional[str] = Query(default=None),  # ndjson | sse: progress events, then the result
 ):
     try:
-        # ---- normalize knobs ----
-        include_tax_tip_in = include_tax_tip_form if include_tax_tip_form is not None else include_tax_tip_q
-        include_tax_tip_flag = RESTAURANT_INCLUDE_TAX_TIP_ITEMS if include_tax_tip_in is None else bool(include_tax_tip_in)
-
-        people = people_form if people_form is not None else people_q
-        tip_percent = tip_percent_form if tip_percent_form is not None else tip_percent_q
-
-        tip_amount_override = tip_amount_override_form if tip_amount_override_form is not None else tip_amount_override_q
-        tax_amount_override = tax_amount_override_form if tax_amount_override_form is not None else tax_amount_override_q
-        lock_paper_total = (lock_paper_total_form
-                            if lock_paper_total_form is not None else (lock_paper_total_q or False))
-
-        # basic validation
-        if people is not None and (people < 1 or people > 50):
-            raise HTTPException(status_code=400, detail="people must be between 1 and 50")
-        if tip_percent is not None and (tip_percent < 0 or tip_percent > 100):
-            raise HTTPException(status_code=400, detail="tip_percent must be between 0 and 100")
-        if tip_amount_override is not None and tip_amount_override < 0:
-            raise HTTPException(status_code=400, detail="tip_amount must be >= 0")
-        if tax_amount_override is not None and tax_amount_override < 0:
-            raise HTTPException(status_code=400, detail="tax_amount must be >= 0")
+        if stream not in (None, "ndjson", "sse"):
+            raise HTTPException(status_code=400, detail="stream must be 'ndjson' or 'sse'")
 
         # ---- read image ----
-        if file is not None:
-            raw = await file.read()
-            image_b64 = _to_b64_jpeg(raw)
-        elif json_body is not None and json_body.image_base64:
-            image_b64 = json_body.image_base64.strip()
-            approx_bytes = (len(image_b64) * 3) // 4
-            if approx_bytes > MAX_IMAGE_BYTES:
-                raise HTTPException(status_code=413, detail="Image too large; please send < 10MB")
-            try:
-                raw = base64.b64decode(image_b64)
-            except Exception:
-                raise HTTPException(status_code=400, detail="Invalid base64 image")
-        else:
-            raise HTTPException(status_code=400, detail="Provide a 'file' (multipart) or 'image_base64' (JSON).")
+        raw = await _read_image(request, file)
 
-        # ---- pipeline ----
-        # 1) Azure DI
-        parsed = _azure_analyze_receipt(raw)
-        if parsed and parsed.get("items"):
-            out = _postprocess_receipt(
-                parsed,
-                include_tax_tip_flag,
-                tip_percent_override=tip_percent,
-                tip_amount_override=tip_amount_override,
-                tax_amount_override=tax_amount_override,
-                lock_paper_total=lock_paper_total,
-            )
-            if len(out["items"]) >= FORCE_SECOND_PASS_MIN_ITEMS:
-                out["engine"] = "azure_receipt"
-                return AnalyzeResp(**_coerce_amounts(out))
-
-        # 2) Azure Read OCR → GPT
-        text = _azure_read_ocr(raw)
-        if text:
-            parsed_text = _openai_from_text(text)
-            if parsed_text and parsed_text.get("items"):
-                out = _postprocess_receipt(
-                    parsed_text,
-                    include_tax_tip_flag,
-                    tip_percent_override=tip_percent,
-                    tip_amount_override=tip_amount_override,
-                    tax_amount_override=tax_amount_override,
-                    lock_paper_total=lock_paper_total,
-                )
-                if len(out["items"]) >= FORCE_SECOND_PASS_MIN_ITEMS:
-                    out["engine"] = "azure_read_gpt"
-                    return AnalyzeResp(**_coerce_amounts(out))
-                # If too few items but OCR looks rich (many prices), try a stricter second pass
-                if _looks_like_many_prices(text):
-                    parsed_text2 = _openai_from_text(_force_itemization_prompt(text))
-                    if parsed_text2 and parsed_text2.get("items"):
-                        out2 = _postprocess_receipt(
-                            parsed_text2,
-                            include_tax_tip_flag,
-                            tip_percent_override=tip_percent,
-                            tip_amount_override=tip_amount_override,
-                            tax_amount_override=tax_amount_override,
-                            lock_paper_total=lock_paper_total,
-                        )
-                        out2["engine"] = "azure_read_gpt_strict"
-                        return AnalyzeResp(**_coerce_amounts(out2))
-
-        # 3) GPT with image (vision)
-        parsed_img = _openai_from_image(image_b64)
-        out = _postprocess_receipt(
-            parsed_img,
-            include_tax_tip_flag,
-            tip_percent_override=tip_percent,
-            tip_amount_override=tip_amount_override,
-            tax_amount_override=tax_amount_override,
-            lock_paper_total=lock_paper_total,
-        )
-        out["engine"] = "gpt_image"
-        return AnalyzeResp(**_coerce_amounts(out))
+        if stream:
+            media = "text/event-stream" if stream == "sse" else "application/x-ndjson"
+            return StreamingResponse(_progress_stream(raw, knobs, strategy, stream == "sse", budget),
+                                     media_type=media)
+
+        out, status = await _analyze_image(raw, knobs, strategy, budget=budget)
+        response.headers["X-Cache"] = status
+        return out
 
     except HTTPException:
         raise
@@ -634,12 +1967,164 @@ async def analyze(
         print("Analyze fatal error:", repr(e))
         raise HTTPException(status_code=502, detail="Analyzer crashed unexpectedly")
 
+# --- Batch endpoint ---
+BATCH_MAX_ITEMS   = SETTINGS.limits.batch_max_items
+BATCH_CONCURRENCY = SETTINGS.limits.batch_concurrency  # per batch; upstream caps still apply
+
+async def _batch_item(i: int, src, sem: asyncio.Semaphore, knobs: dict, strategy: str, deadline: float) -> dict:
+    async with sem:
+        try:
+            if isinstance(src, HTTPException):
+                raise src
+            budget = max(0.0, deadline - time.monotonic())  # what is left of the batch's budget
+            out, _ = await _analyze_image(src, knobs, strategy, budget=budget, priority=PRIORITY_BATCH)
+            return {"index": i, "ok": True, "result": jsonable_encoder(out)}
+        except HTTPException as e:
+            return {"index": i, "ok": False, "status": e.status_code, "error": str(e.detail)}
+        except Exception as e:
+            print("Analyze batch item error:", repr(e))
+            return {"index": i, "ok": False, "status": 502, "error": "Analyzer crashed unexpectedly"}
+
+async def _batch_stream(tasks: list[asyncio.Task], sse: bool):
+    errors = 0
+    try:
+        for fut in asyncio.as_completed(tasks):
+            item = await fut
+            errors += 0 if item["ok"] else 1
+            line = json.dumps(item, separators=(",", ":"))
+            yield f"event: item\ndata: {line}\n\n" if sse else line + "\n"
+        done = json.dumps({"done": True, "count": len(tasks), "errors": errors})
+        yield f"event: done\ndata: {done}\n\n" if sse else done + "\n"
+    finally:
+        for t in tasks:
+            t.cancel()  # client went away: stop remaining items
+
+@app.post("/analyze-receipts", response_model=AnalyzeBatchResp)
+async def analyze_batch(
+    request: Request,
+    files: list[UploadFile] | None = File(default=None),  # or a JSON body {images_base64: [string]}
+    stream: Optional[str] = Query(default=None),  # ndjson | sse; default returns all results at once
+    knobs: dict = Depends(_request_knobs),
+    strategy: str = Depends(_request_strategy),
+    budget: float = Depends(_request_budget),
+):
+    if stream not in (None, "ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="stream must be 'ndjson' or 'sse'")
+
+    # Read every input up front (uploads are closed once the handler returns); per-item
+    # problems become item errors instead of failing the batch.
+    sources: list = []
+    if files:
+        for f in files:
+            try:
+                sources.append(await _read_file(f))
+            except HTTPException as e:
+                sources.append(e)
+    elif _is_json(request):
+        images = (await _read_json(request, "{images_base64: [string]}")).get("images_base64")
+        if not isinstance(images, list):
+            raise HTTPException(status_code=400, detail="Expected JSON {images_base64: [string]}")
+        for i, b64 in enumerate(images):
+            images[i] = None  # drop each string once decoded
+            try:
+                sources.append(_decode_b64_image(b64))
+            except HTTPException as e:
+                sources.append(e)
+    if not sources:
+        raise HTTPException(status_code=400, detail="Provide 'files' (multipart) or 'images_base64' (JSON).")
+    if len(sources) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} images per batch")
+    # The middleware charged one request; each further image costs extra
+    extra = (len(sources) - 1) * RATE_COST_BATCH_ITEM
+    if RATE_LIMITER is not None and extra > 0:
+        ok, headers = await RATE_LIMITER.hit(request.client.host if request.client else "unknown", extra)
+        if not ok:
+            RATE_LIMITED.inc()
+            raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+    deadline = time.monotonic() + budget
+    tasks = [asyncio.ensure_future(_batch_item(i, src, sem, knobs, strategy, deadline)) for i, src in enumerate(sources)]
+    if stream:
+        media = "text/event-stream" if stream == "sse" else "application/x-ndjson"
+        return StreamingResponse(_batch_stream(tasks, stream == "sse"), media_type=media)
+
+    results = await asyncio.gather(*tasks)
+    return {"results": results, "errors": sum(1 for r in results if not r["ok"])}
+
+# --- Async jobs: submit now, poll GET /jobs/{id} or receive a callback ---
+JOBS_BACKEND     = SETTINGS.jobs.backend  # memory | sqlite
+JOBS_DB          = SETTINGS.jobs.db
+JOBS_WORKERS     = SETTINGS.jobs.workers
+JOBS_MAX_QUEUE   = SETTINGS.jobs.max_queue
+JOBS_MAX_QUEUE_MB = SETTINGS.jobs.max_queue_mb  # image bytes waiting per process; 0 = no cap
+JOBS_LEASE_SEC   = SETTINGS.jobs.lease_sec  # a dead worker's running jobs are retried after this
+JOBS_TTL_SEC     = SETTINGS.jobs.ttl_sec
+# Comma-separated hosts allowed as callback targets; empty disables callbacks
+JOBS_CALLBACK_HOSTS = SETTINGS.jobs.callback_hosts
+
+async def _job_handler(job: dict) -> dict:
+    out, _ = await _analyze_image(job["image"], job["knobs"], job["strategy"], priority=PRIORITY_JOB)
+    return jsonable_encoder(out)
+
+JOB_RUNNER = JobRunner(
+    SQLiteJobStore(JOBS_DB) if JOBS_BACKEND == "sqlite" else MemoryJobStore(),
+    _job_handler,
+    workers=JOBS_WORKERS,
+    max_queue=JOBS_MAX_QUEUE,
+    max_bytes=int(JOBS_MAX_QUEUE_MB * 1024 * 1024),
+    lease_sec=JOBS_LEASE_SEC,
+    ttl_sec=JOBS_TTL_SEC,
+)
+
+class JobResp(BaseModel):
+    id: str
+    status: str  # queued | running | succeeded | failed
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[AnalyzeResp] = None
+    error: Optional[dict] = None  # {status, detail}
+    callback_status: Optional[str] = None  # delivered | failed
+
+def _job_view(job: dict) -> dict:
+    return {k: job.get(k) for k in JobResp.model_fields}
+
+@app.post("/jobs", response_model=JobResp, status_code=202)
+async def submit_job(
+    request: Request,
+    file: UploadFile | None = File(default=None),
+    callback_url_form: Optional[str] = Form(default=None, alias="callback_url"),
+    callback_url_q: Optional[str] = Query(default=None, alias="callback_url"),
+    knobs: dict = Depends(_request_knobs),
+    strategy: str = Depends(_request_strategy),
+):
+    callback_url = callback_url_form or callback_url_q
+    if callback_url:
+        u = urlparse(callback_url)
+        if u.scheme not in ("http", "https") or (u.hostname or "").lower() not in JOBS_CALLBACK_HOSTS:
+            raise HTTPException(status_code=400, detail="callback_url host is not allowed")
+
+    raw = await _read_image(request, file)
+
+    if JOB_RUNNER.full(len(raw)):
+        raise HTTPException(status_code=503, detail="Job queue is full; retry later",
+                            headers={"Retry-After": "30"})
+    job = await JOB_RUNNER.submit(raw, knobs, strategy, callback_url)
+    return _job_view(job)
+
+@app.get("/jobs/{job_id}", response_model=JobResp)
+async def get_job(job_id: str):
+    job = await JOB_RUNNER.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(job)
+
 # --- heuristics for second pass ---
-_PRICE_RE = re.compile(r"\$?\d{1,3}(?:[,\d]{0,3})?\.\d{2}")
 
 def _looks_like_many_prices(text: str) -> bool:
     # If OCR has many price patterns but the parsed result had <= 1 item, force stricter pass
-    return len(_PRICE_RE.findall(text)) >= 6  # tweak as needed
+    return len(PRICE_TOKEN.findall(text)) >= 6  # tweak as needed
 
 def _force_itemization_prompt(text: str) -> str:
     return (
@@ -0,0 +1,431 @@
+# Typed settings, read from the environment once (Settings.from_env) into frozen
+# objects: the upstreams (credentials, endpoints, the HTTP pools that reach them and
+# connection prewarming) at the top level, every other knob in a section named after
+# its env prefix (RATE_LIMIT_* -> limits, JOBS_* -> jobs, ...). Field names are the env
+# names, lowercased and without the prefix. A bad mode or backend name is an error
+# here; a missing upstream is not: problems() lists what is missing, and the server
+# reports it on /readyz and skips that upstream.
+from dataclasses import dataclass
+from typing import Mapping, Optional
+import os, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UPSTREAMS = ("azure_di", "azure_vision", "openai")
+ENGINE_STRATEGIES = ("sequential", "parallel", "hedged")
+
+
+def to_bool(v: Optional[str], default: bool = False) -> bool:
+    if v is None:
+        return default
+    clean = v.strip()
+    if "#" in clean:
+        clean = clean.split("#", 1)[0].strip()
+    s = clean.lower()
+    if s in {"true", "1", "yes", "y", "on"}:  return True
+    if s in {"false", "0", "no", "n", "off"}: return False
+    return default
+
+
+def _choice(env: Mapping[str, str], name: str, default: str, choices: tuple) -> str:
+    v = (env.get(name) or default).strip().lower()
+    if v not in choices:
+        raise RuntimeError(f"{name} must be one of {', '.join(choices)}")
+    return v
+
+
+@dataclass(frozen=True)
+class LimitsSettings:
+    # Rate limiting and request size
+    rate_limit: int
+    window_sec: int
+    backend: str  # memory | sqlite | redis
+    db: str
+    redis_url: str
+    max_keys: int
+    cost_default: float
+    cost_batch_item: float
+    costs: dict  # route -> tokens, from RATE_COSTS="/analyze-receipt=2,..."
+    max_image_bytes: int
+    body_slack_bytes: int  # multipart/JSON framing per image
+    batch_max_items: int
+    batch_concurrency: int  # per batch; upstream caps still apply
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "LimitsSettings":
+        costs = {}
+        for pair in (env.get("RATE_COSTS") or "").split(","):
+            if "=" in pair:
+                path, cost = pair.split("=", 1)
+                costs[path.strip()] = float(cost)
+        return cls(
+            rate_limit=int(env.get("RATE_LIMIT", "60")),
+            window_sec=int(env.get("RATE_WINDOW_SEC", "3600")),
+            backend=_choice(env, "RATE_LIMIT_BACKEND", "memory", ("memory", "sqlite", "redis")),
+            db=env.get("RATE_LIMIT_DB") or "ratelimit.sqlite3",
+            redis_url=env.get("RATE_LIMIT_REDIS_URL") or "redis://localhost:6379/0",
+            max_keys=int(env.get("RATE_LIMIT_MAX_KEYS", "100000")),
+            cost_default=float(env.get("RATE_COST_DEFAULT", "1")),
+            cost_batch_item=float(env.get("RATE_COST_BATCH_ITEM", "1")),
+            costs=costs,
+            max_image_bytes=int(env.get("MAX_IMAGE_BYTES", str(10 * 1024 * 1024))),
+            body_slack_bytes=int(env.get("BODY_SLACK_BYTES", str(64 * 1024))),
+            batch_max_items=int(env.get("BATCH_MAX_ITEMS", "40")),
+            batch_concurrency=int(env.get("BATCH_CONCURRENCY", "4")),
+        )
+
+
+@dataclass(frozen=True)
+class EnginesSettings:
+    strategy: str  # sequential | parallel | hedged
+    hedge_delay_sec: float
+    routing: str  # fixed | fastest
+    force_second_pass_min_items: int
+    di_min_item_confidence: float
+    di_merge_min_confidence: float
+    restaurant_include_tax_tip_items: bool
+    gpt_text_max_tokens: int  # 0 = model default
+    di_poll_first_delay_sec: float
+    di_poll_max_delay_sec: float
+    di_poll_backoff: float
+    di_poll_deadline_sec: float
+    upstream_concurrency: dict  # upstream -> max in-flight calls
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "EnginesSettings":
+        return cls(
+            strategy=_choice(env, "ENGINE_STRATEGY", "sequential", ENGINE_STRATEGIES),
+            hedge_delay_sec=float(env.get("HEDGE_DELAY_SEC", "8")),
+            routing=_choice(env, "ENGINE_ROUTING", "fixed", ("fixed", "fastest")),
+            force_second_pass_min_items=int(env.get("FORCE_SECOND_PASS_MIN_ITEMS", "2")),
+            di_min_item_confidence=float(env.get("DI_MIN_ITEM_CONFIDENCE", "0.65")),
+            di_merge_min_confidence=float(env.get("DI_MERGE_MIN_CONFIDENCE", "0.8")),
+            restaurant_include_tax_tip_items=to_bool(env.get("RESTAURANT_INCLUDE_TAX_TIP_ITEMS"), True),
+            gpt_text_max_tokens=int(env.get("GPT_TEXT_MAX_TOKENS", "0")),
+            di_poll_first_delay_sec=float(env.get("DI_POLL_FIRST_DELAY_SEC", "0.5")),
+            di_poll_max_delay_sec=float(env.get("DI_POLL_MAX_DELAY_SEC", "4")),
+            di_poll_backoff=float(env.get("DI_POLL_BACKOFF", "1.5")),
+            di_poll_deadline_sec=float(env.get("DI_POLL_DEADLINE_SEC", "30")),
+            upstream_concurrency={n: int(env.get(f"UPSTREAM_CONCURRENCY_{n.upper()}", "16")) for n in UPSTREAMS},
+        )
+
+
+@dataclass(frozen=True)
+class CacheSettings:
+    enabled: bool
+    max_entries: int
+    max_bytes: int
+    ttl_sec: int
+    db: Optional[str]  # e.g. ./cache.sqlite3
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "CacheSettings":
+        return cls(
+            enabled=to_bool(env.get("RESULT_CACHE_ENABLED"), True),
+            max_entries=int(env.get("RESULT_CACHE_MAX_ENTRIES", "512")),
+            max_bytes=int(env.get("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+            ttl_sec=int(env.get("RESULT_CACHE_TTL_SEC", "86400")),
+            db=env.get("RESULT_CACHE_DB") or None,
+        )
+
+
+@dataclass(frozen=True)
+class ImagesSettings:
+    preprocess: bool
+    prep_workers: int
+    jpeg_quality: int
+    grayscale: bool
+    max_side_di: int
+    max_side_vision: int
+    max_side_openai: int  # OpenAI scales to 2048 anyway
+    tiling: bool  # as asked for; the server also needs Pillow
+    tile_min_aspect: float
+    tile_aspect: float
+    tile_overlap: float
+    tile_max: int
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "ImagesSettings":
+        return cls(
+            preprocess=to_bool(env.get("IMAGE_PREPROCESS"), False),
+            prep_workers=int(env.get("IMAGE_PREP_WORKERS", "2")),
+            jpeg_quality=int(env.get("IMAGE_JPEG_QUALITY", "85")),
+            grayscale=to_bool(env.get("IMAGE_GRAYSCALE"), True),
+            max_side_di=int(env.get("IMAGE_MAX_SIDE_DI", "4000")),
+            max_side_vision=int(env.get("IMAGE_MAX_SIDE_VISION", "4000")),
+            max_side_openai=int(env.get("IMAGE_MAX_SIDE_OPENAI", "2048")),
+            tiling=to_bool(env.get("IMAGE_TILING"), False),
+            tile_min_aspect=float(env.get("IMAGE_TILE_MIN_ASPECT", "3")),
+            tile_aspect=float(env.get("IMAGE_TILE_ASPECT", "1.5")),
+            tile_overlap=float(env.get("IMAGE_TILE_OVERLAP", "0.15")),
+            tile_max=int(env.get("IMAGE_TILE_MAX", "6")),
+        )
+
+
+@dataclass(frozen=True)
+class PregateSettings:
+    mode: str  # off | shadow | route
+    min_side: int
+    strip_aspect: float
+    blur_var: float
+    min_contrast: float
+    strict_prices: int
+    log_path: Optional[str]  # JSON lines: features, prediction, actual engine
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "PregateSettings":
+        return cls(
+            mode=_choice(env, "PREGATE_MODE", "shadow", ("off", "shadow", "route")),
+            min_side=int(env.get("PREGATE_MIN_SIDE", "400")),
+            strip_aspect=float(env.get("PREGATE_STRIP_ASPECT", "3.0")),
+            blur_var=float(env.get("PREGATE_BLUR_VAR", "20")),
+            min_contrast=float(env.get("PREGATE_MIN_CONTRAST", "25")),
+            strict_prices=int(env.get("PREGATE_STRICT_PRICES", "15")),
+            log_path=env.get("PREGATE_LOG_PATH") or None,
+        )
+
+
+@dataclass(frozen=True)
+class OcrSettings:
+    compact: bool
+    head_lines: int
+    context_lines: int
+    token_budget: int  # 0 = no cap
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "OcrSettings":
+        return cls(
+            compact=to_bool(env.get("OCR_COMPACT"), True),
+            head_lines=int(env.get("OCR_HEAD_LINES", "2")),
+            context_lines=int(env.get("OCR_CONTEXT_LINES", "1")),
+            token_budget=int(env.get("OCR_TOKEN_BUDGET", "3000")),
+        )
+
+
+@dataclass(frozen=True)
+class TemplatesSettings:
+    mode: str  # off | shadow | on
+    min_samples: int
+    max_merchants: int
+    max_headers: int  # LRU of first-OCR-line -> merchant lookups
+    path: Optional[str]
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "TemplatesSettings":
+        return cls(
+            mode=_choice(env, "TEMPLATES_MODE", "shadow", ("off", "shadow", "on")),
+            min_samples=int(env.get("TEMPLATES_MIN_SAMPLES", "2")),
+            max_merchants=int(env.get("TEMPLATES_MAX_MERCHANTS", "5000")),
+            max_headers=int(env.get("TEMPLATES_MAX_HEADERS", "20000")),
+            path=env.get("TEMPLATES_PATH") or None,
+        )
+
+
+@dataclass(frozen=True)
+class CategoriesSettings:
+    path: str
+    locale: str
+    max_items: int
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "CategoriesSettings":
+        return cls(
+            path=env.get("CATEGORIES_PATH") or os.path.join(HERE, "categories.json"),
+            locale=(env.get("CATEGORIES_LOCALE") or "en").strip().lower(),
+            max_items=int(env.get("CATEGORIZE_MAX_ITEMS", "10000")),
+        )
+
+
+@dataclass(frozen=True)
+class AdmissionSettings:
+    max_active: int  # 0 = no admission control
+    max_queue: int
+    max_wait_sec: float
+    service_sec: float  # initial estimate of one run; then EWMA
+    default_budget_sec: float
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "AdmissionSettings":
+        return cls(
+            max_active=int(env.get("ADMISSION_MAX_ACTIVE", "24")),
+            max_queue=int(env.get("ADMISSION_MAX_QUEUE", "64")),
+            max_wait_sec=float(env.get("ADMISSION_MAX_WAIT_SEC", "30")),
+            service_sec=float(env.get("ADMISSION_SERVICE_SEC", "8")),
+            default_budget_sec=float(env.get("ADMISSION_DEFAULT_BUDGET_SEC", "60")),
+        )
+
+
+@dataclass(frozen=True)
+class ProfilingSettings:
+    admin_token: Optional[str]
+    dir: str
+    keep: int
+    sample_every: int  # 0 = only on request
+    interval_ms: float
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "ProfilingSettings":
+        return cls(
+            admin_token=env.get("ADMIN_TOKEN") or None,
+            dir=env.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "splitchamp-profiles"),
+            keep=int(env.get("PROFILE_KEEP", "50")),
+            sample_every=int(env.get("PROFILE_SAMPLE_EVERY", "0")),
+            interval_ms=float(env.get("PROFILE_INTERVAL_MS", "2")),
+        )
+
+
+@dataclass(frozen=True)
+class BreakerSettings:
+    window_sec: float
+    min_calls: int
+    error_rate: float
+    slow_call_sec: float
+    open_sec: float
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "BreakerSettings":
+        return cls(
+            window_sec=float(env.get("BREAKER_WINDOW_SEC", "60")),
+            min_calls=int(env.get("BREAKER_MIN_CALLS", "5")),
+            error_rate=float(env.get("BREAKER_ERROR_RATE", "0.5")),
+            slow_call_sec=float(env.get("BREAKER_SLOW_CALL_SEC", "30")),
+            open_sec=float(env.get("BREAKER_OPEN_SEC", "30")),
+        )
+
+
+@dataclass(frozen=True)
+class SettleSettings:
+    max_people: int
+    max_expenses: int
+    max_groups: int
+    exact_max: int
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "SettleSettings":
+        return cls(
+            max_people=int(env.get("SETTLE_MAX_PEOPLE", "50")),
+            max_expenses=int(env.get("SETTLE_MAX_EXPENSES", "10000")),
+            max_groups=int(env.get("SETTLE_MAX_GROUPS", "1000")),
+            exact_max=int(env.get("SETTLE_EXACT_MAX", "14")),
+        )
+
+
+@dataclass(frozen=True)
+class JobsSettings:
+    backend: str  # memory | sqlite
+    db: str
+    workers: int
+    max_queue: int
+    max_queue_mb: float  # image bytes waiting per process; 0 = no cap
+    lease_sec: float
+    ttl_sec: int
+    callback_hosts: frozenset  # empty disables callbacks
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str]) -> "JobsSettings":
+        return cls(
+            backend=_choice(env, "JOBS_BACKEND", "memory", ("memory", "sqlite")),
+            db=env.get("JOBS_DB") or "jobs.sqlite3",
+            workers=int(env.get("JOBS_WORKERS", "4")),
+            max_queue=int(env.get("JOBS_MAX_QUEUE", "1000")),
+            max_queue_mb=float(env.get("JOBS_MAX_QUEUE_MB", "256")),
+            lease_sec=float(env.get("JOBS_LEASE_SEC", "300")),
+            ttl_sec=int(env.get("JOBS_TTL_SEC", "86400")),
+            callback_hosts=frozenset(h.strip().lower() for h in (env.get("JOBS_CALLBACK_HOSTS") or "").split(",")
+                                     if h.strip()),
+        )
+
+
+_SECTIONS = {
+    "limits": LimitsSettings, "engines": EnginesSettings, "cache": CacheSettings, "images": ImagesSettings,
+    "pregate": PregateSettings, "ocr": OcrSettings, "templates": TemplatesSettings,
+    "categories": CategoriesSettings, "admission": AdmissionSettings, "profiling": ProfilingSettings,
+    "breaker": BreakerSettings, "settle": SettleSettings, "jobs": JobsSettings,
+}
+
+
+@dataclass(frozen=True)
+class Settings:
+    openai_key: str
+    openai_model: str
+    openai_base_url: str
+    allowed_origins: str
+    azure_use_receipt: bool
+    azure_use_read: bool
+    azure_di_endpoint: str
+    azure_di_key: str
+    azure_vision_endpoint: str
+    azure_vision_key: str
+    http_max_connections: int
+    http_max_keepalive: int
+    http_keepalive_expiry: float
+    prewarm_connections: int      # per configured upstream; 0 = no prewarming
+    prewarm_interval_sec: float   # keep-alive refresh; 0 = warm once at startup
+    prewarm_timeout_sec: float    # readiness does not wait longer for the first round
+    limits: LimitsSettings
+    engines: EnginesSettings
+    cache: CacheSettings
+    images: ImagesSettings
+    pregate: PregateSettings
+    ocr: OcrSettings
+    templates: TemplatesSettings
+    categories: CategoriesSettings
+    admission: AdmissionSettings
+    profiling: ProfilingSettings
+    breaker: BreakerSettings
+    settle: SettleSettings
+    jobs: JobsSettings
+
+    @classmethod
+    def from_env(cls, env: Mapping[str, str] = os.environ) -> "Settings":
+        return cls(
+            openai_key=env.get("OPENAI_API_KEY") or "",
+            openai_model=env.get("OPENAI_MODEL", "gpt-4o-mini"),  # vision + JSON mode
+            openai_base_url=(env.get("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/"),
+            allowed_origins=env.get("ALLOWED_ORIGINS", "*"),
+            azure_use_receipt=to_bool(env.get("AZURE_USE_RECEIPT"), True),
+            azure_use_read=to_bool(env.get("AZURE_USE_READ"), True),
+            azure_di_endpoint=(env.get("AZURE_DI_ENDPOINT") or "").rstrip("/"),
+            azure_di_key=env.get("AZURE_DI_KEY") or "",
+            azure_vision_endpoint=(env.get("AZURE_VISION_ENDPOINT") or "").rstrip("/"),
+            azure_vision_key=env.get("AZURE_VISION_KEY") or "",
+            http_max_connections=int(env.get("HTTP_MAX_CONNECTIONS", "100")),
+            http_max_keepalive=int(env.get("HTTP_MAX_KEEPALIVE", "20")),
+            http_keepalive_expiry=float(env.get("HTTP_KEEPALIVE_EXPIRY", "60")),
+            prewarm_connections=int(env.get("UPSTREAM_PREWARM_CONNECTIONS", "2")),
+            prewarm_interval_sec=float(env.get("UPSTREAM_PREWARM_INTERVAL_SEC", "30")),
+            prewarm_timeout_sec=float(env.get("UPSTREAM_PREWARM_TIMEOUT_SEC", "5")),
+            **{name: section.from_env(env) for name, section in _SECTIONS.items()},
+        )
+
+    @property
+    def openai_configured(self) -> bool:
+        return bool(self.openai_key)
+
+    @property
+    def di_configured(self) -> bool:
+        return bool(self.azure_di_endpoint and self.azure_di_key)
+
+    @property
+    def vision_configured(self) -> bool:
+        return bool(self.azure_vision_endpoint and self.azure_vision_key)
+
+    def upstream_urls(self) -> dict[str, str]:
+        # Base URL per configured upstream: what prewarming connects to
+        out = {}
+        if self.azure_use_receipt and self.di_configured:
+            out["azure_di"] = self.azure_di_endpoint
+        if self.azure_use_read and self.vision_configured:
+            out["azure_vision"] = self.azure_vision_endpoint
+        if self.openai_configured:
+            out["openai"] = self.openai_base_url
+        return out
+
+    def problems(self) -> list[str]:
+        out = []
+        if not self.openai_configured:
+            out.append("missing OPENAI_API_KEY")
+        if not self.azure_di_endpoint: out.append("missing AZURE_DI_ENDPOINT")
+        if not self.azure_di_key:      out.append("missing AZURE_DI_KEY")
+        if not self.azure_vision_endpoint: out.append("missing AZURE_VISION_ENDPOINT")
+        if not self.azure_vision_key:      out.append("missing AZURE_VISION_KEY")
+        return out
@@ -0,0 +1,314 @@
+# Settlement engine for /settle: balances in integer cents, then transfers.
+#
+# Expense shares follow src/lib/split.ts (sharesForExpense): even expenses split their
+# amount across splitAmong (or everyone); itemized ones split each item across its
+# splitAmong (or everyone) and spread tax + tip in proportion to each person's item
+# total. Every split hands out whole cents by largest remainder, so an expense's
+# shares add up to exactly what its payer is credited and balances sum to zero.
+#
+# A Ledger keeps the balances and the expenses behind them, so changing or removing
+# one expense is O(people in it) instead of a full recompute. Transfers come from
+# either the client's greedy matching (largest debtor pays largest creditor) or
+# min_transfers, which splits the balances into as many zero-sum groups as it can
+# find, since a group of k people settles in k-1 transfers: people who never share an
+# expense are settled apart, then equal and opposite balances are paired, then the
+# rest is partitioned exactly by subset DP up to exact_max people, else by triples.
+from collections import OrderedDict
+from typing import Iterable, Optional
+import threading
+
+MODES = ("greedy", "min_transfers")
+
+
+def to_cents(x) -> int:
+    return round(float(x or 0) * 100)
+
+
+def _split_even(cents: int, ids: list[str], out: dict) -> None:
+    q, r = divmod(cents, len(ids))
+    for k, pid in enumerate(ids):
+        out[pid] = out.get(pid, 0) + q + (1 if k < r else 0)
+
+
+def _split_weighted(cents: int, weights: dict[str, int], out: dict) -> None:
+    # Largest remainder; weights sum to > 0, ties go to the earlier id
+    total = sum(weights.values())
+    parts = []
+    given = 0
+    for k, (pid, w) in enumerate(weights.items()):
+        q, r = divmod(cents * w, total)
+        parts.append((-r, k, pid, q))
+        given += q
+    for j, (_, _, pid, q) in enumerate(sorted(parts)):
+        out[pid] = out.get(pid, 0) + q + (1 if j < cents - given else 0)
+
+
+def expense_delta(e: dict, everyone: list[str]) -> dict[str, int]:
+    # Balance change per person for one expense: payer +total, everyone sharing -share
+    owed: dict[str, int] = {}
+    items = e.get("items") or []
+    if e.get("splitMethod") == "itemized" and items:
+        base: dict[str, int] = {}
+        for it in items:
+            _split_even(to_cents(it.get("amount")), it.get("splitAmong") or everyone, base)
+        extra = to_cents(e.get("tax")) + to_cents(e.get("tip"))
+        total = sum(base.values()) + extra
+        owed = dict(base)
+        if extra:
+            if sum(base.values()) > 0:
+                _split_weighted(extra, base, owed)
+            else:  # nothing to weight by: split evenly so the expense still balances
+                _split_even(extra, list(base) or everyone, owed)
+    else:
+        total = to_cents(e.get("amount"))
+        _split_even(total, e.get("splitAmong") or everyone, owed)
+    delta = {pid: -c for pid, c in owed.items() if c}
+    delta[e["paidBy"]] = delta.get(e["paidBy"], 0) + total
+    return delta
+
+
+def _members(e: dict, everyone: list[str]) -> tuple:
+    # Payer first, then everyone the expense is split across
+    if e.get("splitMethod") == "itemized" and e.get("items"):
+        ids = [e["paidBy"]]
+        for it in e["items"]:
+            if not it.get("splitAmong"):
+                return (e["paidBy"], *everyone)
+            ids += it["splitAmong"]
+        return tuple(dict.fromkeys(ids))
+    return (e["paidBy"], *(e.get("splitAmong") or everyone))
+
+
+class Ledger:
+    def __init__(self, everyone: list[str]):
+        self.everyone = list(everyone)
+        self.balance: dict[str, int] = {pid: 0 for pid in everyone}
+        self.expenses: dict[str, dict] = {}
+        self._links: dict[tuple, int] = {}  # distinct member sets -> expenses with them
+        self._components: Optional[list[list[str]]] = None
+
+    def _apply(self, delta: dict[str, int], sign: int) -> None:
+        bal = self.balance
+        for pid, c in delta.items():
+            bal[pid] = bal.get(pid, 0) + sign * c
+
+    def _link(self, e: dict, sign: int) -> None:
+        # Components only change when a member set first appears or last goes away
+        ids = _members(e, self.everyone)
+        n = self._links.get(ids, 0) + sign
+        if n:
+            self._links[ids] = n
+        else:
+            del self._links[ids]
+        if n == (1 if sign > 0 else 0):
+            self._components = None
+
+    def upsert(self, e: dict) -> None:
+        # An expense's delta is a pure function of it and the participants, so the old
+        # one is recomputed to take it back out instead of being stored
+        old = self.expenses.get(e["id"])
+        if old is not None:
+            self._apply(expense_delta(old, self.everyone), -1)
+            self._link(old, -1)
+        self.expenses[e["id"]] = e
+        self._apply(expense_delta(e, self.everyone), 1)
+        self._link(e, 1)
+
+    def remove(self, expense_id: str) -> bool:
+        old = self.expenses.pop(expense_id, None)
+        if old is not None:
+            self._apply(expense_delta(old, self.everyone), -1)
+            self._link(old, -1)
+        return old is not None
+
+    @classmethod
+    def build(cls, everyone: list[str], expenses: Iterable[dict]) -> "Ledger":
+        # Same balances as upserting one by one, but even splits are summed per split group
+        # first: each member's share over all of a group's expenses is the sum of the
+        # quotients plus one cent for every expense whose remainder reaches past them.
+        led = cls(everyone)
+        led.expenses = {e["id"]: e for e in expenses}
+        bal = led.balance
+        groups: dict[tuple, list] = {}
+        for e in led.expenses.values():
+            led._link(e, 1)
+            if e.get("splitMethod") == "itemized" and e.get("items"):
+                led._apply(expense_delta(e, everyone), 1)
+                continue
+            total = to_cents(e.get("amount"))
+            group = tuple(e.get("splitAmong") or everyone)
+            bal[e["paidBy"]] = bal.get(e["paidBy"], 0) + total
+            g = groups.get(group)
+            if g is None:
+                g = groups[group] = [0, [0] * (len(group) + 1)]
+            q, r = divmod(total, len(group))
+            g[0] += q
+            g[1][r] += 1
+        for group, (quotients, by_remainder) in groups.items():
+            extra = 0
+            for i in range(len(group) - 1, -1, -1):
+                extra += by_remainder[i + 1]
+                bal[group[i]] = bal.get(group[i], 0) - quotients - extra
+        return led
+
+    def components(self) -> list[list[str]]:
+        # People linked by shared expenses; each component's balances sum to zero on their own
+        if self._components is None:
+            parent = {pid: pid for pid in self.balance}
+
+            def find(x):
+                while parent[x] != x:
+                    parent[x] = parent[parent[x]]
+                    x = parent[x]
+                return x
+
+            for ids in self._links:
+                root = find(ids[0])
+                for pid in ids[1:]:
+                    r = find(pid)
+                    if r != root:
+                        parent[r] = root
+            comps: dict[str, list[str]] = {}
+            for pid in self.balance:
+                comps.setdefault(find(pid), []).append(pid)
+            self._components = list(comps.values())
+        return self._components
+
+    def transfers(self, mode: str = "greedy", exact_max: int = 14) -> list[tuple[str, str, int]]:
+        # (from, to, cents); participant order breaks ties so results are deterministic
+        order = {pid: i for i, pid in enumerate(self.everyone)}
+        if mode == "greedy":
+            return _greedy([(pid, c) for pid, c in self.balance.items() if c], order)
+        out = []
+        for comp in self.components():
+            nonzero = [(pid, self.balance[pid]) for pid in comp if self.balance[pid]]
+            for group in _zero_sum_groups(nonzero, exact_max):
+                out += _greedy(group, order)
+        return out
+
+
+def _greedy(bal: list[tuple[str, int]], order: dict) -> list[tuple[str, str, int]]:
+    debtors = sorted(([-c, order.get(p, 0), p] for p, c in bal if c < 0), key=lambda x: (-x[0], x[1]))
+    creditors = sorted(([c, order.get(p, 0), p] for p, c in bal if c > 0), key=lambda x: (-x[0], x[1]))
+    out = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        pay = min(debtors[i][0], creditors[j][0])
+        out.append((debtors[i][2], creditors[j][2], pay))
+        debtors[i][0] -= pay
+        creditors[j][0] -= pay
+        if debtors[i][0] == 0:
+            i += 1
+        if creditors[j][0] == 0:
+            j += 1
+    return out
+
+
+def _zero_sum_groups(bal: list[tuple[str, int]], exact_max: int) -> list[list[tuple[str, int]]]:
+    groups: list[list[tuple[str, int]]] = []
+    rest = list(bal)
+    # Equal and opposite balances are always worth pairing (one transfer for two people)
+    by_amount: dict[int, list[int]] = {}
+    paired = set()
+    for k, (_, c) in enumerate(rest):
+        match = by_amount.get(-c)
+        if match:
+            m = match.pop()
+            groups.append([rest[m], rest[k]])
+            paired.update((m, k))
+        else:
+            by_amount.setdefault(c, []).append(k)
+    rest = [b for k, b in enumerate(rest) if k not in paired]
+    if len(rest) <= exact_max:
+        return groups + _exact_groups(rest)
+    groups += _triples(rest)
+    used = {id(b) for g in groups for b in g}
+    leftover = [b for b in rest if id(b) not in used]
+    if leftover:
+        groups.append(leftover)
+    return groups
+
+
+def _triples(bal: list[tuple[str, int]]) -> list[list[tuple[str, int]]]:
+    # One side's pair summing to the negation of a balance on the other side: 3 people, 2 transfers
+    groups = []
+    free = set(range(len(bal)))
+    singles: dict[int, list[int]] = {}
+    for k, (_, c) in enumerate(bal):
+        singles.setdefault(c, []).append(k)
+    for a in range(len(bal)):
+        for b in range(a + 1, len(bal)):
+            if a not in free or b not in free:
+                continue
+            ca, cb = bal[a][1], bal[b][1]
+            if (ca > 0) != (cb > 0):
+                continue
+            for k in singles.get(-(ca + cb), ()):
+                if k in free:
+                    groups.append([bal[a], bal[b], bal[k]])
+                    free -= {a, b, k}
+                    break
+    return groups
+
+
+def _exact_groups(bal: list[tuple[str, int]]) -> list[list[tuple[str, int]]]:
+    # Partition into the most zero-sum subsets: dp[mask] = best count using the people in
+    # mask, +1 whenever the mask itself sums to zero. O(2^n * n).
+    n = len(bal)
+    if n == 0:
+        return []
+    vals = [c for _, c in bal]
+    size = 1 << n
+    sums = [0] * size
+    dp = [0] * size
+    for m in range(1, size):
+        low = m & -m
+        sums[m] = sums[m ^ low] + vals[low.bit_length() - 1]
+        best = 0
+        x = m
+        while x:
+            b = x & -x
+            v = dp[m ^ b]
+            if v > best:
+                best = v
+            x ^= b
+        dp[m] = best + (1 if sums[m] == 0 else 0)
+    groups, cur, m = [], [], size - 1
+    while m:
+        need = dp[m] - (1 if sums[m] == 0 else 0)
+        x = m
+        while x:
+            b = x & -x
+            if dp[m ^ b] == need:
+                break
+            x ^= b
+        cur.append(bal[b.bit_length() - 1])
+        m ^= b
+        if sums[m] == 0:
+            groups.append(cur)
+            cur = []
+    return groups
+
+
+class LedgerCache:
+    # Ledgers by client-chosen group id (LRU), so later requests can send only the
+    # expenses that changed; one lock serializes updates
+    def __init__(self, max_groups: int = 1000):
+        self.max_groups = max_groups
+        self.lock = threading.Lock()
+        self._groups: OrderedDict[str, Ledger] = OrderedDict()
+
+    def get(self, group_id: str) -> Optional[Ledger]:
+        led = self._groups.get(group_id)
+        if led is not None:
+            self._groups.move_to_end(group_id)
+        return led
+
+    def put(self, group_id: str, led: Ledger) -> None:
+        self._groups[group_id] = led
+        self._groups.move_to_end(group_id)
+        while len(self._groups) > self.max_groups:
+            self._groups.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._groups)
@@ -0,0 +1,312 @@
+# Per-merchant receipt layouts learned from GPT text parses.
+#
+# Receipts from one chain share a layout: the same labels on the subtotal, tax, tip and
+# total lines, the same footer lines with amounts (balance, change, savings), and item
+# lines of the same shape ("<description> <price>", "<qty> X <description> <price>",
+# or the price alone on the line under the description). learn() takes the OCR text
+# and a parse that adds up, labels each priced line as item / total / tax / tip /
+# ignore and keeps the item line shapes as regexes. parse() reads a later receipt from
+# the same merchant with those labels and regexes; the caller checks that the result
+# adds up before using it, and otherwise falls back to GPT.
+#
+# Merchants are keyed on the normalized name without digits and '#' (store numbers).
+# A receipt whose merchant no engine has named yet is matched on its first OCR line.
+from collections import OrderedDict
+from typing import Optional
+import json, os, re
+
+from categorize import normalize
+from ocrtext import DATE as _DATE, PRICE as _PRICE
+
+_DIGITS = re.compile(r"\d+")
+_TOKEN = re.compile(r"\d+|\s+|[^\d\s]")
+KINDS = ("total", "tax", "tip", "ignore")
+MAX_LABELS = 64   # per kind and merchant
+MAX_SHAPES = 16
+
+
+def merchant_key(name: Optional[str]) -> str:
+    return " ".join(_DIGITS.sub(" ", normalize(name or "")).split())
+
+
+def _label_key(label: str) -> str:
+    return " ".join(_DIGITS.sub("#", normalize(label)).split())
+
+
+def _cents(amount: str) -> int:
+    digits = re.sub(r"\D", "", amount)
+    return -int(digits) if amount.startswith("-") else int(digits)
+
+
+def _general(s: str) -> str:
+    # Literal text between the fields: digit runs and whitespace may vary, the rest may not
+    out = []
+    for tok in _TOKEN.findall(s):
+        out.append(r"\d+" if tok[0].isdigit() else r"\s+" if tok.isspace() else re.escape(tok))
+    return "".join(out)
+
+
+def _priced_lines(text: str) -> list[tuple[str, int, str, re.Match, bool]]:
+    # (label, cents, line, price match, split) per line with a price. The last price on
+    # the line is the amount; a line that is only a price takes the line above as label.
+    out = []
+    above = None
+    for line in (l.strip() for l in text.splitlines()):
+        if not line:
+            continue
+        ms = list(_PRICE.finditer(line))
+        if not ms:
+            above = line
+            continue
+        m = ms[-1]
+        label = f"{line[:m.start()]} {line[m.end():]}".strip()
+        split = not _label_key(label) and above is not None
+        out.append((above if split else label, _cents(m.group()), line, m, split))
+        above = None
+    return out
+
+
+def _shape(line: str, m: re.Match, desc: str, split: bool) -> str:
+    amount = f"(?P<amount>{_PRICE.pattern})"
+    if split:
+        return f"^{_general(line[:m.start()])}{amount}{_general(line[m.end():])}$"
+    head = line[:m.start()]
+    i = head.lower().find(desc.lower()) if desc else -1
+    d0, d1 = (i, i + len(desc)) if i >= 0 else (0, len(head.rstrip()))
+    return (f"^{_general(head[:d0])}(?P<desc>.+?){_general(head[d1:])}{amount}"
+            f"{_general(line[m.end():])}$")
+
+
+class Template:
+    def __init__(self, merchant: str):
+        self.merchant = merchant
+        self.samples = 0
+        self.labels: dict[str, dict[str, int]] = {k: {} for k in KINDS}
+        self.shapes: dict[str, int] = {}  # regex -> item lines seen with it
+        self.hits = 0
+        self.rejects = 0
+        self._compiled: Optional[list[tuple[re.Pattern, bool]]] = None
+
+    def kind(self, key: str) -> Optional[str]:
+        best, n = None, 0
+        for kind in KINDS:
+            c = self.labels[kind].get(key, 0)
+            if c > n:
+                best, n = kind, c
+        return best
+
+    def _count(self, table: dict, key: str, cap: int) -> None:
+        if key in table or len(table) < cap:
+            table[key] = table.get(key, 0) + 1
+
+    def compiled(self) -> list[tuple[re.Pattern, bool]]:
+        if self._compiled is None:
+            order = sorted(self.shapes, key=self.shapes.get, reverse=True)
+            self._compiled = [(re.compile(s, re.IGNORECASE), "(?P<desc>" not in s) for s in order]
+        return self._compiled
+
+    def to_dict(self) -> dict:
+        return {"merchant": self.merchant, "samples": self.samples, "labels": self.labels,
+                "shapes": self.shapes, "hits": self.hits, "rejects": self.rejects}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Template":
+        t = cls(d["merchant"])
+        t.samples = d.get("samples", 0)
+        t.labels.update({k: dict(v) for k, v in (d.get("labels") or {}).items() if k in KINDS})
+        t.shapes = dict(d.get("shapes") or {})
+        t.hits, t.rejects = d.get("hits", 0), d.get("rejects", 0)
+        return t
+
+
+class TemplateStore:
+    def __init__(self, mode: str = "shadow", min_samples: int = 2, max_merchants: int = 5000,
+                 max_headers: int = 20000, path: Optional[str] = None, alpha: float = 0.2):
+        self.mode = mode          # off | shadow (parse and compare, GPT still answers) | on
+        self.routing = mode == "on"
+        self.min_samples = min_samples
+        self.max_merchants = max_merchants
+        self.max_headers = max_headers
+        self.path = path
+        self.alpha = alpha
+        self._t: OrderedDict[str, Template] = OrderedDict()
+        # merchant_key(first OCR line) -> merchant key, LRU: every receipt header OCR misread
+        # a new way adds an entry, so it is capped separately from the merchants
+        self._by_header: OrderedDict[str, str] = OrderedDict()
+        # hit = parse adopted in place of GPT (on); shadow_ok = parse added up but GPT answered
+        self.counts = {"none": 0, "hit": 0, "shadow_ok": 0, "reject": 0, "learned": 0}
+        self.shadow = {"agree": 0, "disagree": 0}
+        self.gpt_ms: Optional[float] = None  # EWMA of the GPT text passes a hit replaces
+        self.saved_ms = 0.0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                for key, d in data.get("templates", {}).items():
+                    self._t[key] = Template.from_dict(d)
+                self._by_header = OrderedDict(data.get("headers") or {})
+                self._trim_headers()
+            except (OSError, ValueError, KeyError) as e:
+                print("Template store load error:", e)
+
+    def _trim_headers(self) -> None:
+        while len(self._by_header) > self.max_headers:
+            self._by_header.popitem(last=False)
+
+    def _find(self, merchant: Optional[str], text: str) -> Optional[str]:
+        key = merchant_key(merchant)
+        if key in self._t:
+            return key
+        first = next((l for l in text.splitlines() if l.strip()), "")
+        header = merchant_key(first)
+        key = self._by_header.get(header)
+        if key is not None:
+            self._by_header.move_to_end(header)
+        return key
+
+    def learn(self, merchant: Optional[str], text: str, parsed: dict) -> bool:
+        # parsed must add up (items + tax + tip == total); the caller checks
+        if not isinstance(merchant, str):  # GPT output: null, a number, a list...
+            return False
+        key = merchant_key(merchant)
+        try:
+            total = round(float(parsed.get("total")) * 100)
+            tax = round(float(parsed.get("tax") or 0) * 100)
+            tip = round(float(parsed.get("tip") or 0) * 100)
+            items = [(str(it.get("description") or ""), round(float(it.get("amount") or 0) * 100))
+                     for it in parsed.get("items") or []]
+        except (AttributeError, TypeError, ValueError):
+            return False
+        if not key or not items:
+            return False
+        t = self._t.get(key)
+        if t is None:
+            t = self._t[key] = Template(merchant.strip())
+            while len(self._t) > self.max_merchants:
+                old, _ = self._t.popitem(last=False)
+                self._by_header = OrderedDict((h, k) for h, k in self._by_header.items() if k != old)
+        self._t.move_to_end(key)
+        for label, cents, line, m, split in _priced_lines(text):
+            words = set(normalize(label).split())
+            hit = next((j for j, (d, c) in enumerate(items)
+                        if c == cents and (split or words & set(normalize(d).split()))), None)
+            lkey = _label_key(label)
+            if hit is not None:
+                t._count(t.shapes, _shape(line, m, items.pop(hit)[0], split), MAX_SHAPES)
+            elif not lkey:
+                continue
+            elif cents == total:
+                t._count(t.labels["total"], lkey, MAX_LABELS)
+            elif tax and cents == tax:
+                t._count(t.labels["tax"], lkey, MAX_LABELS)
+            elif tip and cents == tip:
+                t._count(t.labels["tip"], lkey, MAX_LABELS)
+            else:
+                t._count(t.labels["ignore"], lkey, MAX_LABELS)
+        t._compiled = None
+        t.samples += 1
+        first = next((l for l in text.splitlines() if l.strip()), "")
+        header = merchant_key(first)
+        if header:
+            self._by_header[header] = key
+            self._by_header.move_to_end(header)
+            self._trim_headers()
+        self.counts["learned"] += 1
+        return True
+
+    def parse(self, merchant: Optional[str], text: str) -> tuple[Optional[dict], Optional[str]]:
+        # (parsed, merchant key), or (None, None) without a trained template
+        key = self._find(merchant, text)
+        t = self._t.get(key) if key else None
+        if t is None or t.samples < self.min_samples:
+            self.counts["none"] += 1
+            return None, None
+        items, tax, tip, total, unknown = [], 0, 0, None, 0
+        shapes = t.compiled()
+        for label, cents, line, _, split in _priced_lines(text):
+            kind = t.kind(_label_key(label))
+            if kind == "total":
+                total = cents if total is None else total
+            elif kind == "tax":
+                tax += cents
+            elif kind == "tip":
+                tip += cents
+            elif kind is None:
+                for rx, split_shape in shapes:
+                    m = rx.match(line) if split_shape == split else None
+                    if m is not None:
+                        desc = label if split else m.group("desc").strip()
+                        items.append({"description": desc, "amount": cents / 100})
+                        break
+                else:
+                    unknown += 1
+        date = _DATE.search(text)
+        return {
+            "merchant": t.merchant,
+            "date": date.group() if date else None,
+            "total": total / 100 if total is not None else None,
+            "tax": tax / 100,
+            "tip": tip / 100,
+            "items": items,
+            "unknown_lines": unknown,
+        }, key
+
+    def outcome(self, key: str, ok: bool, ms: float) -> str:
+        # The caller's totals check passed (ok) or not; only routing mode adopts the parse,
+        # so only there does it count as a hit. Returns the counter bumped.
+        result = ("hit" if self.routing else "shadow_ok") if ok else "reject"
+        t = self._t.get(key)
+        if t is not None:
+            if result == "hit":
+                t.hits += 1
+            elif result == "reject":
+                t.rejects += 1
+        self.counts[result] += 1
+        if result == "hit" and self.gpt_ms is not None:
+            self.saved_ms += max(0.0, self.gpt_ms - ms)
+        return result
+
+    def observe_gpt(self, ms: float) -> None:
+        self.gpt_ms = ms if self.gpt_ms is None else self.gpt_ms + self.alpha * (ms - self.gpt_ms)
+
+    def compare(self, template: dict, gpt: dict) -> bool:
+        # Shadow mode: does the template's parse match what GPT returned?
+        def sig(p):
+            try:
+                return (sorted(round(float(it.get("amount") or 0) * 100) for it in p.get("items") or []),
+                        round(float(p.get("total") or 0) * 100))
+            except (TypeError, ValueError):
+                return None
+        same = sig(template) == sig(gpt)
+        self.shadow["agree" if same else "disagree"] += 1
+        return same
+
+    def stats(self) -> dict:
+        tried = self.counts["hit"] + self.counts["shadow_ok"] + self.counts["reject"]
+        lookups = tried + self.counts["none"]
+        return {
+            "mode": self.mode,
+            "merchants": len(self._t),
+            "trained": sum(1 for t in self._t.values() if t.samples >= self.min_samples),
+            **self.counts,
+            "hit_rate": round(self.counts["hit"] / lookups, 3) if lookups else None,
+            "headers": len(self._by_header),
+            "shadow": dict(self.shadow),
+            "gpt_ms": round(self.gpt_ms) if self.gpt_ms is not None else None,
+            "saved_ms": round(self.saved_ms),
+        }
+
+    def size(self) -> int:
+        return len(self._t)
+
+    def close(self) -> None:
+        if not self.path:
+            return
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"templates": {k: t.to_dict() for k, t in self._t.items()},
+                           "headers": self._by_header}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Template store save error:", e)
@@ -0,0 +1,148 @@
+# Reading image uploads without redundant copies.
+#
+# BodyLimit rejects oversized request bodies while they stream in: a declared
+# Content-Length over the route's limit gets a 413 before any body is read, and
+# chunked bodies are cut off as soon as the running count passes it. Multipart files
+# are spooled to disk by Starlette above 1MB; read_upload checks their size before
+# pulling them into memory. JSON bodies are read into one growing buffer instead of
+# a chunk list plus a joined copy; parse_json leaves a large string field (the base64
+# image) in that buffer as a memoryview instead of copying it into a str, and
+# decode_b64 decodes it from there. Going the other way, b64_body base64-encodes an
+# image piecewise while the upstream request is being sent.
+from typing import AsyncIterator, Callable, Optional, Union
+import base64, binascii, json, re
+
+from starlette.requests import ClientDisconnect
+
+
+class TooLarge(Exception):
+    pass
+
+
+def b64_len(n: int) -> int:
+    # Length of the base64 encoding of n bytes
+    return (n + 2) // 3 * 4
+
+
+class BodyLimit:
+    # ASGI middleware; limit_for(path) -> max body bytes, or None for no limit. `detail`
+    # is the 413 message, the same one the app's handlers give for an oversized upload
+    def __init__(self, app, limit_for: Callable[[str], Optional[int]], detail: str = "Request body too large"):
+        self.app = app
+        self.limit_for = limit_for
+        self.detail = detail
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limit_for(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            return await _reject(send, self.detail)
+
+        seen = 0
+        rejected = False
+        started = False
+
+        async def limited_receive():
+            nonlocal seen, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            msg = await receive()
+            if msg["type"] == "http.request":
+                seen += len(msg.get("body", b""))
+                if seen > limit:
+                    rejected = True
+                    scope["body_too_large"] = True
+                    if not started:
+                        await _reject(send, self.detail)
+                    return {"type": "http.disconnect"}
+            return msg
+
+        async def guarded_send(msg):
+            nonlocal started
+            if rejected:
+                return  # our 413 already went out; drop the app's reply
+            started = True
+            await send(msg)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+
+async def _reject(send, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": 413,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()),
+                            (b"connection", b"close")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_upload(file, limit: int) -> bytes:
+    # UploadFile -> bytes, refusing files over limit before reading them
+    if file.size is not None and file.size > limit:
+        raise TooLarge()
+    data = await file.read(limit + 1)
+    if len(data) > limit:
+        raise TooLarge()
+    return data
+
+
+async def read_body(request, limit: int) -> bytearray:
+    buf = bytearray()
+    try:
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) > limit:
+                raise TooLarge()
+    except ClientDisconnect:
+        if request.scope.get("body_too_large"):  # cut off by BodyLimit, which already sent the 413
+            raise TooLarge()
+        raise
+    return buf
+
+
+def parse_json(buf: bytearray, blob: Optional[str] = None):
+    # json.loads(buf), except that a top-level string field `blob` without escapes comes
+    # back as a memoryview into buf. The rest of the document is parsed with that value
+    # blanked out, so anything unusual falls back to a plain parse.
+    if blob is not None:
+        m = re.search(rb'"%s"\s*:\s*"' % re.escape(blob.encode()), buf)
+        if m is not None:
+            start = m.end()
+            end = buf.find(b'"', start)
+            if end > 0 and buf.find(b"\\", start, end) < 0:
+                try:
+                    rest = json.loads(buf[:start] + buf[end:])
+                except ValueError:
+                    rest = None
+                if isinstance(rest, dict) and rest.get(blob) == "":
+                    rest[blob] = memoryview(buf)[start:end]
+                    return rest
+    return json.loads(buf)
+
+
+def decode_b64(s: Union[str, memoryview], limit: int) -> bytes:
+    # Raises TooLarge, or ValueError for invalid input. a2b_base64 reads a memoryview or
+    # an ASCII str in place, where b64decode would first copy it to bytes.
+    if len(s) * 3 // 4 > limit + 2:
+        raise TooLarge()
+    if isinstance(s, str) and not s.isascii():
+        raise ValueError("non-ASCII base64")
+    data = binascii.a2b_base64(s)
+    if not data:
+        raise ValueError("empty image")
+    if len(data) > limit:
+        raise TooLarge()
+    return data
+
+
+def b64_body(head: bytes, data: bytes, tail: bytes, chunk: int = 192 * 1024) -> tuple[int, AsyncIterator[bytes]]:
+    # (Content-Length, body) for head + base64(data) + tail; chunk must be a multiple of 3
+    async def gen():
+        yield head
+        view = memoryview(data)
+        for i in range(0, len(view), chunk):
+            yield base64.b64encode(view[i:i + chunk])
+        yield tail
+    return len(head) + b64_len(len(data)) + len(tail), gen()
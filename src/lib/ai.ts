@@ -1,5 +1,6 @@
 // src/lib/ai.ts
 import Constants from 'expo-constants';
+import { categorizeItem } from './split';
 
 export type ReceiptItem = {
   id?: string;
@@ -59,12 +60,13 @@ function coerceReceipt(data: any): ReceiptParse {
     throw new Error('AI response missing items[]');
   }
 
-  // normalize items and backfill id/category if missing
+  // normalize items and backfill id if missing; a missing category stays
+  // undefined so withCategories() can ask /categorize instead of guessing 'food'
   const items: ReceiptItem[] = parsed.items.map((it: any, i: number) => {
     const amount = coerceNum(it?.amount);
     const description = String(it?.description ?? `Item ${i + 1}`);
     const id = typeof it?.id === 'string' && it.id.length ? it.id : mkId(description, amount, i);
-    const category = (it?.category as ReceiptItem['category']) ?? 'food';
+    const category = (it?.category as ReceiptItem['category']) || undefined;
     return { id, description, amount, category };
   });
 
@@ -191,3 +193,56 @@ export async function analyzeReceipt(
     t.clear();
   }
 }
+
+/** Server-side categorization (same keyword dictionary as /analyze-receipt). */
+export async function categorizeDescriptions(
+  descriptions: string[],
+  locale?: string
+): Promise<NonNullable<ReceiptItem['category']>[]> {
+  if (!apiBase) {
+    const err: any = new Error('No API configured');
+    err.code = 'NO_API';
+    throw err;
+  }
+
+  const t = withTimeout(15_000);
+  try {
+    const res = await fetch(`${apiBase}/categorize`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', Accept: 'application/json' },
+      body: JSON.stringify(locale ? { descriptions, locale } : { descriptions }),
+      signal: t.signal,
+    });
+    if (!res.ok) {
+      const text = await readErrorBodySafely(res);
+      throw new Error(`Categorize failed: ${res.status} ${text}`);
+    }
+    const data = await res.json();
+    return Array.isArray(data?.categories) ? data.categories : [];
+  } finally {
+    t.clear();
+  }
+}
+
+/**
+ * Fills `category` on items that don't have one: server /categorize first,
+ * local keyword buckets (lib/split.ts) when the API is missing or unreachable.
+ * Items that already carry a category are returned unchanged.
+ */
+export async function withCategories<T extends ReceiptItem>(items: T[]): Promise<T[]> {
+  const missing = items.filter(it => !it.category);
+  if (!missing.length) return items;
+
+  let cats: NonNullable<ReceiptItem['category']>[] = [];
+  try {
+    cats = await categorizeDescriptions(missing.map(it => it.description));
+  } catch {
+    cats = []; // offline / NO_API → keyword fallback below
+  }
+  if (cats.length !== missing.length) {
+    cats = missing.map(it => categorizeItem(it.description));
+  }
+
+  let i = 0;
+  return items.map(it => (it.category ? it : { ...it, category: cats[i++] }));
+}
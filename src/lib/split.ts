@@ -71,7 +71,9 @@ const round2 = (n: number) => Math.round(n * 100) / 100;
 
 /* ----------------------------------------------------------------
  * OPTIONAL FALLBACK CATEGORIZATION
- * Use ONLY when backend doesn't provide `category`.
+ * Use ONLY when backend doesn't provide `category` and is unreachable;
+ * withCategories() in lib/ai.ts tries server /categorize first and falls
+ * back to categorizeItem() here.
  * ---------------------------------------------------------------- */
 
 /** Quick keyword buckets. Keep conservative to avoid mislabeling. */